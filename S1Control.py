@@ -7,10 +7,21 @@ import time
 import json
 import shutil
 import socket
+import select
+import queue
+import operator
+import asyncio
+import concurrent.futures
 import xmltodict
+import re
+import xml.parsers.expat
 import struct
 import csv
-import subprocess
+import zlib
+import lzma
+import pickle
+import sqlite3
+import tempfile
 import logging
 import serial
 import requests
@@ -24,9 +35,17 @@ from tkinter.ttk import Treeview
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 from PIL import Image
-from decimal import Decimal
 from plyer import notification as plyer_notification
 from dataclasses import dataclass
+from functools import lru_cache
+from collections import OrderedDict
+
+try:
+    # optional, for storing session results as parquet (see ResultsStore). without it, results are stored as npz.
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 from element_string_lists import (
     elementstr_symbolsonly,
     elementstr_namesonly,
@@ -39,16 +58,705 @@ __contact__ = "zhall@portaspecs.com"
 __version__ = "v1.1.2"  # v0.9.6 was the first GeRDA-control version
 __versiondate__ = "2024/07/10"
 
+# Consts for datatypes on recv
+COOKED_SPECTRUM = "1"
+RESULTS_SET = "2"
+RAW_SPECTRUM = "3"
+PDZ_FILENAME = "4"
+XML_PACKET = "5"
+XML_SUCCESS_RESPONSE = "5a"
+XML_APPS_PRESENT_RESPONSE = "5b"
+XML_ACTIVE_APP_RESPONSE = "5c"
+STATUS_CHANGE = "6"
+SPECTRUM_ENERGY_PACKET = "7"
+UNKNOWN_DATA = "0"
+
+# Reconnection after the instrument connection is lost: delay between attempts starts at INITIAL and doubles up to MAX.
+# if still not reconnected after GIVE_UP seconds, the session is saved and closed as before.
+RECONNECT_BACKOFF_INITIAL_S = 0.5
+RECONNECT_BACKOFF_MAX_S = 16
+RECONNECT_GIVE_UP_S = 600
+
+# live vitals, tracked per cooked spectrum packet by VitalsEngine. names used in its snapshots and per-phase summaries.
+VITALS_PUBLISH_INTERVAL_MS = 250  # how often the vitals display is updated
+VITALS_METRICS = (
+    "input_cps",
+    "output_cps",
+    "dead_time_percent",
+    "voltage_kV",
+    "current_uA",
+    "detector_temp_C",
+)
+
+
+# spectra sanity check: the energy above which this % of a spectrum's total counts lie should be below the source voltage (see sanityCheckSpectrum_SumMethod)
+SANITY_CHECK_THRESHOLD_PERCENT = 2
+
+# regions of interest (see ROIEngine): windows of +-(ROI_WIDTH_FWHM * detector FWHM at the line energy) around lines from all_xray_lines.
+# detector FWHM at other energies is scaled from its FWHM at Mn Kα (5.895keV), assuming Fano-limited resolution for a Si detector.
+ROI_DETECTOR_FWHM_MN_KA_EV = 140
+ROI_WIDTH_FWHM = 1.0
+ROI_BACKGROUND_CHANNELS = (
+    3  # channels either side of a roi, averaged for its linear background
+)
+ROI_DEFAULT_LINES = [
+    "K Kα",
+    "Ca Kα",
+    "Ti Kα",
+    "Mn Kα",
+    "Fe Kα",
+    "Ni Kα",
+    "Cu Kα",
+    "Zn Kα",
+    "Pb Lβ",
+    "Rb Kα",
+    "Sr Kα",
+    "Zr Kα",
+]
+
+# automatic peak search (see findPeaks): spectra are convolved with a negative second derivative of gaussian kernel of PEAK_SEARCH_SIGMA_CHANNELS,
+# and peaks are local maxima of the result at least PEAK_SEARCH_MIN_SIGNIFICANCE standard deviations (poisson counting statistics) above zero.
+PEAK_SEARCH_SIGMA_CHANNELS = 3
+PEAK_SEARCH_MIN_SIGNIFICANCE = 5
+PEAK_SEARCH_MIN_ENERGY_KEV = 1.0  # below this is the zero peak and noise
+# spectra convolved at a time, so the working arrays stay in cache
+PEAK_SEARCH_BLOCK_ROWS = 32
+# peaks are matched to lines within this many detector FWHM of them
+PEAK_MATCH_TOLERANCE_FWHM = 0.5
+
+# spectra of completed assays are kept compressed in the catalogue (see CookedSpectrum.compress), with the most recently used decompressed
+# counts/normalised arrays kept in an LRU cache (SPECTRUM_CACHE_ARRAYS arrays, i.e. about 8KB-16KB each) so reselecting recent assays is instant.
+SPECTRUM_COMPRESSION_CODEC = (
+    "zlib"  # "zlib" (fast) or "lzma" (a few % smaller, ~25x slower to compress)
+)
+SPECTRUM_COMPRESSION_LEVEL = 6
+SPECTRUM_CACHE_ARRAYS = 64
+
+# completed assays are stored on disk (see AssayCatalogue), with only this many of the most recently used kept loaded.
+CATALOGUE_CACHED_ASSAYS = 16
+# re-checking the session's spectra sanity loads this many assays from the catalogue at a time
+SANITY_RECHECK_CHUNK_ASSAYS = 256
+# every phase spectrum of the session is also archived uncompressed, in memory-mapped .npy files (see SpectraArchive)
+SPECTRA_ARCHIVE_MAX_PHASES = 4
+SPECTRA_ARCHIVE_INITIAL_ASSAYS = (
+    256  # file space is preallocated for this many assays, doubling when full
+)
+# the results of this many of the most recent distinct ResultsStore queries are kept, per session file, so repeating one only re-reads files that have changed
+RESULTS_STORE_CACHED_QUERIES = 16
+
+# other addresses an instrument may be found at, tried alongside the given one when connecting.
+INSTRUMENT_ENDPOINT_ALTERNATES = [
+    # In some VERY UNUSUAL cases, I have seen instuments come back from Bruker servicing with this IP changed to 190 instead of 192.
+    ("190.168.137.139", 55204),
+    # WIFI (Not Recommended - Also, DHCP will cause IP to change. Port may change as well?) Wifi is unreliable and prone to massive packet loss and delayed commands/info transmit.
+    # '192.168.153.167:55101' found to work for ruffo when on phone hotspot network.
+    ("192.168.153.167", 55101),
+]
+INSTRUMENT_ENDPOINT_PROBE_TIMEOUT_S = 0.5
+
+
+class FramedPacketReader:
+    """Reads Bruker OEM protocol packets (10-byte header, body, 4-byte footer) from a socket into a reusable preallocated buffer using recv_into.
+    read_packet() returns memoryview slices of the header, body and footer, so decoders can parse them without copying.
+    NOTE: the returned views are only valid until the next call to read_packet() - copy anything that needs to be kept (e.g. bytes(view))."""
+
+    HEADER_LEN = 10
+    FOOTER_LEN = 4
+
+    def __init__(self, sock: socket.socket, initial_size: int = 65536):
+        self.socket = sock
+        self._buffer = bytearray(initial_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # start of unconsumed data in buffer
+        self._end = 0  # end of valid data in buffer
+
+    def buffered(self) -> int:
+        """Returns number of bytes already received into the buffer but not yet handed out as a packet."""
+        return self._end - self._start
+
+    def _fill(self, needed: int):
+        """Receives from the socket until at least `needed` unconsumed bytes are in the buffer."""
+        if len(self._buffer) - self._start < needed:
+            _unconsumed = self._end - self._start
+            if needed > len(self._buffer):
+                # packet larger than buffer - allocate a new, larger buffer. (old views keep the old buffer alive until they are released)
+                _new_buffer = bytearray(max(needed, len(self._buffer) * 2))
+                _new_buffer[:_unconsumed] = self._view[self._start : self._end]
+                self._buffer = _new_buffer
+                self._view = memoryview(self._buffer)
+            else:
+                # not enough room left at the end of the buffer - move unconsumed bytes back to the start
+                self._buffer[:_unconsumed] = self._buffer[self._start : self._end]
+            self._start = 0
+            self._end = _unconsumed
+        while self._end - self._start < needed:
+            _n = self.socket.recv_into(self._view[self._end :])
+            if _n == 0:
+                raise Exception("XRF Socket connection broken")
+            self._end += _n
+
+    def read_packet(self) -> tuple[memoryview, memoryview, memoryview]:
+        """Blocks until a full packet has been received. Returns tuple of memoryviews (header, body, footer)."""
+        self._fill(self.HEADER_LEN)
+        _data_size = int.from_bytes(
+            self._view[self._start + 6 : self._start + self.HEADER_LEN], "little"
+        )
+        _packet_len = self.HEADER_LEN + _data_size + self.FOOTER_LEN
+        self._fill(_packet_len)
+        _s = self._start
+        _body_end = _s + self.HEADER_LEN + _data_size
+        _header = self._view[_s : _s + self.HEADER_LEN]
+        _body = self._view[_s + self.HEADER_LEN : _body_end]
+        _footer = self._view[_body_end : _s + _packet_len]
+        self._start += _packet_len
+        if self._start == self._end:
+            self._start = self._end = 0
+        return _header, _body, _footer
+
+
+class AsyncInstrumentConnection:
+    """asyncio based (StreamReader/StreamWriter) connection to the instrument, running its own event loop in a daemon thread.
+    All outgoing packets go through a single ordered writer queue, so sends from the Tk, GeRDA and listen threads can never interleave.
+    Received packets are read by an async packet iterator and handed to other threads through a thread-safe queue (received_packets).
+    """
+
+    def __init__(self, ip: str, port: int, connect_timeout: float = 5.0):
+        self.ip = ip
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.connected: bool = False
+        self.received_packets: queue.Queue = queue.Queue()
+        self._pending_packet: tuple = None
+        self._reader: asyncio.StreamReader = None
+        self._writer: asyncio.StreamWriter = None
+        self._write_queue: asyncio.Queue = None
+        self._tasks: list[asyncio.Task] = []
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            target=self._loop.run_forever, name="InstrumentConnectionLoop", daemon=True
+        )
+        self._loop_thread.start()
+        # metrics
+        self.connected_time: float = None
+        self.packets_received: int = 0
+        self.bytes_received: int = 0
+        self.packets_sent: int = 0
+        self.bytes_sent: int = 0
+        self.received_queue_max: int = 0
+        self.write_queue_max: int = 0
+
+    def connect(self):
+        """Opens the connection, blocking until connected. Raises on failure or timeout."""
+        try:
+            asyncio.run_coroutine_threadsafe(self._connect(), self._loop).result(
+                self.connect_timeout + 1
+            )
+        except Exception:
+            # wake any consumer so that it sees the connection as broken
+            self.received_packets.put(None)
+            raise
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, self.port), self.connect_timeout
+        )
+        self._write_queue = asyncio.Queue()
+        self._tasks = [
+            asyncio.create_task(self._write_loop()),
+            asyncio.create_task(self._receive_loop()),
+        ]
+        self.connected = True
+        self.connected_time = time.monotonic()
+
+    async def packets(self):
+        """async iterator of received (header, body, footer) packets. Stops when the connection is closed."""
+        while True:
+            try:
+                _header = await self._reader.readexactly(10)
+                _body = await self._reader.readexactly(
+                    int.from_bytes(_header[6:10], "little")
+                )
+                _footer = await self._reader.readexactly(4)
+            except asyncio.IncompleteReadError:
+                return
+            yield _header, _body, _footer
+
+    async def _receive_loop(self):
+        try:
+            async for _packet in self.packets():
+                self.packets_received += 1
+                self.bytes_received += len(_packet[1]) + 14
+                self.received_packets.put(_packet)
+                _queued = self.received_packets.qsize()
+                if _queued > self.received_queue_max:
+                    self.received_queue_max = _queued
+        except OSError as e:
+            print(f"Instrument connection receive loop ended. ({repr(e)})")
+        except asyncio.CancelledError:
+            pass  # connection closed by close()
+        finally:
+            self.connected = False
+            # None signals that the connection has been closed
+            self.received_packets.put(None)
+
+    async def _write_loop(self):
+        while True:
+            _data = await self._write_queue.get()
+            try:
+                self._writer.write(_data)
+                await self._writer.drain()
+            except OSError as e:
+                print(f"Instrument connection write failed. ({repr(e)})")
+                self.connected = False
+                return
+            self.packets_sent += 1
+            self.bytes_sent += len(_data)
+
+    def _queue_write(self, data: bytes):
+        self._write_queue.put_nowait(data)
+        if self._write_queue.qsize() > self.write_queue_max:
+            self.write_queue_max = self._write_queue.qsize()
+
+    def send(self, data: bytes):
+        """Queues a framed packet to be sent. Thread-safe; packets are written in the order they are queued."""
+        if not self.connected:
+            raise Exception("XRF Socket connection broken")
+        self._loop.call_soon_threadsafe(self._queue_write, data)
+
+    def wait_for_packet(self, timeout: float = None) -> bool:
+        """Blocks until a received packet is waiting, or until `timeout` (seconds) expires. Returns True if one is waiting (or the connection has closed)."""
+        if self._pending_packet is not None:
+            return True
+        try:
+            _packet = self.received_packets.get(
+                block=(timeout != 0), timeout=timeout or None
+            )
+        except queue.Empty:
+            return False
+        if _packet is None:
+            # connection closed - leave the sentinel for read_packet() to raise on
+            self.received_packets.put(None)
+            return True
+        self._pending_packet = _packet
+        return True
+
+    def read_packet(self) -> tuple[bytes, bytes, bytes]:
+        """Blocks until a packet has been received. Returns tuple (header, body, footer)."""
+        if self._pending_packet is not None:
+            _packet, self._pending_packet = self._pending_packet, None
+        else:
+            _packet = self.received_packets.get()
+        if _packet is None:
+            self.received_packets.put(None)
+            raise Exception("XRF Socket connection broken")
+        return _packet
+
+    def close(self, timeout: float = 2.0):
+        if self._loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(self._close(), self._loop).result(
+                    timeout
+                )
+            except Exception as e:
+                print(f"Instrument connection did not close cleanly. ({repr(e)})")
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _close(self):
+        for _task in self._tasks:
+            _task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        self.connected = False
+
+    def metrics(self) -> dict:
+        """Returns dict of connection throughput metrics."""
+        _elapsed = (
+            (time.monotonic() - self.connected_time) if self.connected_time else 0
+        )
+        return {
+            "connected": self.connected,
+            "seconds_connected": _elapsed,
+            "packets_received": self.packets_received,
+            "bytes_received": self.bytes_received,
+            "packets_sent": self.packets_sent,
+            "bytes_sent": self.bytes_sent,
+            "packets_received_per_s": self.packets_received / _elapsed
+            if _elapsed
+            else 0,
+            "bytes_received_per_s": self.bytes_received / _elapsed if _elapsed else 0,
+            "received_queue_max": self.received_queue_max,
+            "write_queue_max": self.write_queue_max,
+        }
+
+
+# .s1rec session recordings: 16 byte file header (magic, format version, wall clock start time as "<d"),
+# then one record per framed packet: "<dBI" (seconds since recording started (monotonic), direction, frame length), followed by the frame bytes.
+S1REC_MAGIC = b"S1REC\x00\x01\x00"
+S1REC_FILE_HEADER_FORMAT = "<8sd"
+S1REC_RECORD_FORMAT = "<dBI"
+S1REC_RECEIVED = 0
+S1REC_SENT = 1
+
+
+class PacketRecorder:
+    """Records every framed packet sent to / received from the instrument to an append-only .s1rec file, with monotonic timestamps and direction.
+    Thread-safe. see PacketReplayer to play a recording back."""
+
+    def __init__(self, path: str, flush_interval_s: float = 1.0):
+        self.path = path
+        self._file = open(path, "xb")
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last_flush = self._start
+        self.flush_interval_s = flush_interval_s
+        self.packets_recorded: int = 0
+        self.bytes_recorded: int = 0
+        self._file.write(
+            struct.pack(S1REC_FILE_HEADER_FORMAT, S1REC_MAGIC, time.time())
+        )
+
+    def record(self, direction: int, *parts):
+        """Appends one framed packet, given as one or more bytes-like parts (e.g. header, body, footer views) which are written without being joined."""
+        _length = sum(len(_part) for _part in parts)
+        with self._lock:
+            if self._file is None:
+                return
+            _now = time.monotonic()
+            self._file.write(
+                struct.pack(S1REC_RECORD_FORMAT, _now - self._start, direction, _length)
+            )
+            for _part in parts:
+                self._file.write(_part)
+            self.packets_recorded += 1
+            self.bytes_recorded += _length
+            if _now - self._last_flush > self.flush_interval_s:
+                # so that a recording is still useful if the program crashes
+                self._file.flush()
+                self._last_flush = _now
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def readRecording(path: str):
+    """Generator of (seconds since recording start, direction, frame bytes) records from a .s1rec file."""
+    _file_header_len = struct.calcsize(S1REC_FILE_HEADER_FORMAT)
+    _record_header_len = struct.calcsize(S1REC_RECORD_FORMAT)
+    with open(path, "rb") as _file:
+        _magic, _ = struct.unpack(
+            S1REC_FILE_HEADER_FORMAT, _file.read(_file_header_len)
+        )
+        if _magic != S1REC_MAGIC:
+            raise ValueError(f"{path} is not an S1Control session recording (.s1rec)")
+        while True:
+            _record_header = _file.read(_record_header_len)
+            if len(_record_header) < _record_header_len:
+                return  # end of file (or a partly written last record)
+            _t, _direction, _length = struct.unpack(S1REC_RECORD_FORMAT, _record_header)
+            _frame = _file.read(_length)
+            if len(_frame) < _length:
+                return
+            yield _t, _direction, _frame
+
+
+class PacketReplayer:
+    """Plays back the received packets of a .s1rec recording through a local socketpair, so they go through the normal receive_data() -> dispatcher path.
+    speed: multiple of the recorded timing to replay at (<=0 for as fast as possible). Commands sent during replay are read and discarded."""
+
+    def __init__(self, path: str, speed: float = 1.0):
+        self.path = path
+        self.speed = speed
+        self.packets_replayed: int = 0
+        self.command_bytes_discarded: int = 0
+        self.finished = threading.Event()
+        self._replay_socket: socket.socket = None
+
+    def start(self) -> socket.socket:
+        """Starts replaying in a background thread. Returns the socket to read the replayed packets from (and send commands to)."""
+        _instrument_socket, self._replay_socket = socket.socketpair()
+        threading.Thread(target=self._replay, daemon=True).start()
+        threading.Thread(target=self._discard_commands, daemon=True).start()
+        return _instrument_socket
+
+    def _replay(self):
+        _t0 = time.monotonic()
+        for _t, _direction, _frame in readRecording(self.path):
+            if _direction != S1REC_RECEIVED:
+                continue
+            if self.speed > 0:
+                _wait = _t0 + (_t / self.speed) - time.monotonic()
+                if _wait > 0:
+                    time.sleep(_wait)
+            try:
+                self._replay_socket.sendall(_frame)
+            except OSError:
+                return
+            self.packets_replayed += 1
+        # socket is left open, so the listen loop doesn't treat the end of the recording as a lost connection
+        print(f"Replay of {self.path} complete ({self.packets_replayed} packets).")
+        self.finished.set()
+
+    def _discard_commands(self):
+        while True:
+            try:
+                _data = self._replay_socket.recv(65536)
+            except OSError:
+                return
+            if not _data:
+                return
+            self.command_bytes_discarded += len(_data)
+
+
+class PacketDispatcher:
+    """Maps received packets to handler functions, replacing a linear if/elif chain with O(1) dict lookups.
+    Handlers are registered against a key of (datatype, root tag, @parameter), where root tag and @parameter (lowercase) come from the parsed xml.
+    If there is no handler for the exact key, the (datatype, root tag, None) and then (datatype, None, None) handlers are tried as fallbacks.
+    Packets that no registered handler (exact or fallback) covers are counted per key in unknown_counts, and calls/time taken are recorded per handler."""
+
+    def __init__(self, fallback=None):
+        self.handlers: dict[tuple, callable] = {}
+        self.fallback = fallback  # used if no handler is found at all
+        self.unknown_counts: dict[tuple, int] = {}
+        self.handler_calls: dict[str, int] = {}
+        self.handler_seconds_total: dict[str, float] = {}
+        self.handler_seconds_max: dict[str, float] = {}
+        # optional listener(parameter, data), called for every Response packet with a @parameter (e.g. BrukerInstrument.resolve_query)
+        self.response_listener = None
+
+    def register(self, datatype: str, root: str, parameter: str, handler):
+        """Registers handler(data) for packets of datatype with the given root tag and @parameter. None for root/parameter matches any."""
+        _parameter = parameter.lower() if parameter is not None else None
+        self.handlers[(datatype, root, _parameter)] = handler
+
+    @staticmethod
+    def packet_key(data, datatype: str) -> tuple:
+        """Returns the dispatch key (datatype, root tag, @parameter) for a received packet."""
+        if isinstance(data, (StatusPacket, ResultsPacket)):
+            return (
+                datatype,
+                data.root,
+                data.parameter.lower() if data.parameter is not None else None,
+            )
+        if not isinstance(data, dict) or not data:
+            # binary packets (spectra etc.) - nothing to inspect
+            return (datatype, None, None)
+        _root = next(iter(data))
+        if datatype == STATUS_CHANGE:
+            # status packets with child elements (simple ones are StatusPackets) go to the general status handler, whatever their @parameter,
+            # as the handlers for specific parameters expect a StatusPacket
+            return (datatype, _root, None)
+        _element = data[_root]
+        _parameter = _element.get("@parameter") if isinstance(_element, dict) else None
+        if _parameter is not None:
+            _parameter = _parameter.lower()
+        return (datatype, _root, _parameter)
+
+    def find_handler(self, key: tuple):
+        _handler = self.handlers.get(key)
+        if _handler is not None:
+            return _handler
+        _handler = self.handlers.get((key[0], key[1], None))
+        if _handler is None:
+            _handler = self.handlers.get((key[0], None, None))
+        if _handler is None:
+            # only packets no registered handler covers are unknown (not those meant for a catch-all, e.g. configure responses)
+            self.unknown_counts[key] = self.unknown_counts.get(key, 0) + 1
+            _handler = self.fallback
+        return _handler
+
+    def dispatch(self, data, datatype: str):
+        """Calls the handler registered for this packet, timing it."""
+        _key = self.packet_key(data, datatype)
+        _handler = self.find_handler(_key)
+        if _handler is None:
+            return
+        _t0 = time.perf_counter()
+        _handler(data)
+        _elapsed = time.perf_counter() - _t0
+        if (
+            self.response_listener is not None
+            and _key[1] == "Response"
+            and _key[2] is not None
+        ):
+            # after the handler, so that anything waiting on the response sees the state it set
+            self.response_listener(_key[2], data)
+        _name = _handler.__name__
+        self.handler_calls[_name] = self.handler_calls.get(_name, 0) + 1
+        self.handler_seconds_total[_name] = (
+            self.handler_seconds_total.get(_name, 0) + _elapsed
+        )
+        if _elapsed > self.handler_seconds_max.get(_name, 0):
+            self.handler_seconds_max[_name] = _elapsed
+
+    def handler_stats(self) -> pd.DataFrame:
+        """Returns DataFrame of calls, total and mean/max time (ms) per handler, slowest total first."""
+        _stats = pd.DataFrame(
+            {
+                "Calls": self.handler_calls,
+                "Total (ms)": {
+                    _k: _v * 1000 for _k, _v in self.handler_seconds_total.items()
+                },
+                "Max (ms)": {
+                    _k: _v * 1000 for _k, _v in self.handler_seconds_max.items()
+                },
+            }
+        )
+        _stats["Mean (ms)"] = _stats["Total (ms)"] / _stats["Calls"]
+        return _stats.sort_values("Total (ms)", ascending=False)
+
+
+# root tag and (optional) parameter attribute of an xml packet, read straight from the bytes without parsing the whole document
+_XML_ROOT_TAG_PATTERN = re.compile(rb"<(?![?!])([A-Za-z_][\w.\-]*)([^>]*)>")
+_XML_PARAMETER_ATTR_PATTERN = re.compile(rb'\bparameter\s*=\s*"([^"]*)"')
+
+
+def classifyXMLPacket(body) -> tuple[str, str]:
+    """Returns tuple (root tag, parameter attribute) of an xml packet body (bytes or memoryview). parameter is None if the root has none."""
+    _match = _XML_ROOT_TAG_PATTERN.search(body)
+    if _match is None:
+        return None, None
+    _parameter_match = _XML_PARAMETER_ATTR_PATTERN.search(_match.group(2))
+    return (
+        _match.group(1).decode("utf-8"),
+        _parameter_match.group(1).decode("utf-8") if _parameter_match else None,
+    )
+
+
+@dataclass
+class StatusPacket:
+    """Status change packet (<Status parameter="...">text</Status>), decoded by decodeStatusPacket"""
+
+    parameter: str  # e.g. 'Assay', 'Phase Change', 'Armed'
+    text: str  # e.g. 'Start', 'Complete', 'Yes'
+    root = "Status"
+
+
+@dataclass
+class ResultsPacket:
+    """Results packet (<Data>), decoded by decodeResultsPacket straight into typed arrays."""
+
+    analysis_mode: str
+    elements_present: (
+        bool  # False if the instrument reported no results (i.e. calculation error)
+    )
+    z: np.ndarray  # atomic numbers (int)
+    compounds: list[str]
+    concentrations: np.ndarray  # wt%
+    errors: np.ndarray  # wt%, 1SD
+    grades: list[
+        tuple[str, float]
+    ]  # (grade, match value), for LIBRARY SEARCH analysis mode
+    root = "Data"
+    parameter = None
+
+
+_SIMPLE_STATUS_PATTERN = re.compile(
+    rb'<Status\s+parameter\s*=\s*"([^"&]*)"\s*>([^<&]*)</Status>'
+)
+
+
+def decodeStatusPacket(body) -> StatusPacket:
+    """Decodes a simple status change packet straight from the bytes.
+    Returns None if it is not a simple <Status parameter="...">text</Status> packet (e.g. has child elements or entities)."""
+    _match = _SIMPLE_STATUS_PATTERN.search(body)
+    if _match is None:
+        return None
+    return StatusPacket(
+        parameter=_match.group(1).decode("utf-8"),
+        text=_match.group(2).decode("utf-8").strip(),
+    )
+
+
+def decodeResultsPacket(body) -> ResultsPacket:
+    """Decodes a results (<Data>) packet with a streaming expat parser, writing typed values directly (no intermediate dict tree).
+    Missing values within an ElementData entry are filled with NaN / 0."""
+    _z: list[int] = []
+    _compounds: list[str] = []
+    _concentrations: list[float] = []
+    _errors: list[float] = []
+    _grades: list[str] = []
+    _match_values: list[float] = []
+    _text: list[str] = []
+    _state = {"analysis_mode": "", "elements_present": False, "in_element_data": False}
+
+    def _start(name, attrs):
+        _text.clear()
+        if name == "ElementData":
+            _state["in_element_data"] = True
+        elif name == "Elements":
+            _state["elements_present"] = True
+
+    def _end(name):
+        _value = "".join(_text).strip()
+        _text.clear()
+        if _state["in_element_data"]:
+            if name == "AtomicNumber":
+                _z.append(int(_value))
+            elif name == "Compound":
+                _compounds.append(_value)
+            elif name == "Concentration":
+                _concentrations.append(float(_value))
+            elif name == "Error":
+                _errors.append(float(_value))
+            elif name == "ElementData":
+                _state["in_element_data"] = False
+                # pad any values missing from this entry, so all columns stay aligned
+                _n = max(len(_z), len(_compounds), len(_concentrations), len(_errors))
+                _z.extend([0] * (_n - len(_z)))
+                _compounds.extend([""] * (_n - len(_compounds)))
+                _concentrations.extend([np.nan] * (_n - len(_concentrations)))
+                _errors.extend([np.nan] * (_n - len(_errors)))
+        elif name == "AnalysisMode":
+            _state["analysis_mode"] = _value
+        elif name == "Grade":
+            _grades.append(_value)
+        elif name == "MatchValue":
+            _match_values.append(float(_value))
+
+    _parser = xml.parsers.expat.ParserCreate()
+    _parser.StartElementHandler = _start
+    _parser.EndElementHandler = _end
+    _parser.CharacterDataHandler = _text.append
+    _parser.Parse(body, True)
+
+    return ResultsPacket(
+        analysis_mode=_state["analysis_mode"],
+        elements_present=_state["elements_present"] and len(_z) > 0,
+        z=np.array(_z, dtype=int),
+        compounds=_compounds,
+        concentrations=np.array(_concentrations, dtype=float),
+        errors=np.array(_errors, dtype=float),
+        grades=list(zip(_grades, _match_values)),
+    )
+
 
 class BrukerInstrument:
-    def __init__(self):
+    def __init__(
+        self,
+        ip: str = "192.168.137.139",
+        port: int = 55204,
+        use_asyncio: bool = False,
+        probe_alternates: bool = True,
+        replay: PacketReplayer = None,
+    ):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.ip = "192.168.137.139"
-        self.port = 55204  # 55204
-        # CONNECTION DETAILS FOR WIFI  (Not Recommended - Also, DHCP will cause IP to change. Port may change as well?) Wifi is unreliable and prone to massive packet loss and delayed commands/info transmit.
-        # XRF_IP_WIFI = "192.168.153.167"  # '192.168.153.167:55101' found to work for ruffo when on phone hotspot network. both values may change depending on network settings?
-        # XRF_PORT_WIFI = 55101
-        # XRF_IP_USB_ALTERNATE = "190.168.137.139"  # In some VERY UNUSUAL cases, I have seen instuments come back from Bruker servicing with this IP changed to 190 instead of 192. Worth checking if it breaks.
+        self.reader = FramedPacketReader(self.socket)
+        # optional asyncio transport (see AsyncInstrumentConnection), used instead of self.socket if use_asyncio is True.
+        self.use_asyncio = use_asyncio
+        self.connection: AsyncInstrumentConnection = None
+        self._send_lock = threading.Lock()
+        self.ip = ip
+        self.port = port  # 55204
+        # a different address (e.g. ancillary/S1Simulator.py on 127.0.0.1) can be given with the --instrument=host:port argument
+        # unless probe_alternates is False, the last endpoints that worked and INSTRUMENT_ENDPOINT_ALTERNATES (USB alternate, Wi-Fi) are tried at the same time, and ip/port are updated to whichever connects.
+        self.probe_alternates = probe_alternates
 
         # vars
         self.instr_currentapplication = None
@@ -97,6 +805,12 @@ class BrukerInstrument:
         self.instr_currentassayspecenergies = []
         self.instr_currentassaylegends = []
         self.instr_currentassayresults: pd.DataFrame = None
+        self.instr_currentassaytimeresolved: list[TimeResolvedSpectrumBuffer] = []
+        # count rate, dead time etc. statistics of current assay phase
+        self.vitals = VitalsEngine()
+        # region of interest counts of every assay phase in the catalogue
+        self.roi_engine = ROIEngine()
+        self.current_timeresolved_buffer: TimeResolvedSpectrumBuffer = None  # current phase's buffer, if keeping time-resolved spectra (see startTimeResolvedPhase)
         self.instr_assayisrunning: bool = False
         self.instr_currentnosetemp = None
         self.instr_currentnosepressure = None
@@ -107,42 +821,65 @@ class BrukerInstrument:
         self.assay_phase_spectrumpacketcounter: int = 0
         self.current_working_spectra = []
         self.current_working_specenergies = []
-        self.assay_catalogue = []
+        self.assay_catalogue = AssayCatalogue()  # see initialiseAssayCatalogue
+        self.spectra_archive = SpectraArchive()
+        self.results_store = ResultsStore()
         self.assay_catalogue_num = 1
         self.instr_currentambtemp: str = ""
         self.instr_currentambtemp_F: str = ""
         self.instr_currentdettemp: str = ""
         self.instr_totalspecchannels = 2048
         self.specchannelsarray = np.array(list(range(0, self.instr_totalspecchannels)))
-
-        self.open_tcp_connection(self.ip, self.port, instant_connect=False)
+        self.instr_currentphasedurations: list = []  # durations (s) of phases for current application, as strings
+        self.current_working_spectrum_info: CookedSpectrum = (
+            None  # the last spectrum recieved (header values accessible dict-style)
+        )
+        # listen loop backlog counters. a 'burst' is all packets handled between waits on the socket.
+        self.listen_packets_received: int = 0
+        self.listen_burst_packets: int = 0
+        self.listen_burst_max: int = 0
+        self.listen_backlog_packets_drained: int = 0
+        # outstanding queries, keyed by lowercase parameter. resolved (oldest first) by resolve_query() when the matching Response arrives.
+        self.pending_queries: dict[str, list[concurrent.futures.Future]] = {}
+        self._pending_queries_lock = threading.Lock()
+        self.query_retries_total: int = 0
+        # reconnection metrics. latency = connection lost -> socket reopened, outage = connection lost -> session resynchronised.
+        self.reconnect_count: int = 0
+        self.reconnect_attempts_total: int = 0
+        self.reconnect_latencies_s: list[float] = []
+        self.outage_durations_s: list[float] = []
+        self.last_assay_start_args: dict = None  # instrument_StartAssay arguments of the last assay, so it can be repeated if interrupted
+        # session recording (see start_recording) and replay. when replaying a recording, no connection to an instrument is made.
+        self.recorder: PacketRecorder = None
+        self.replay = replay
+
+        if self.replay is not None:
+            self.socket = self.replay.start()
+            self.reader = FramedPacketReader(self.socket)
+        else:
+            self.open_tcp_connection(self.ip, self.port, instant_connect=False)
 
     def open_tcp_connection(
         self, connection_ip: str, connection_port: int, instant_connect: bool = False
     ):
-        # try:
-        #     ping_result = os.system("ping -n 1 -w 40 " + XRF_IP_USB)
-        #     print('normal ping failed')
-        if instant_connect:
-            ping_result = True
+        """Connects to the instrument. TCP connections to all candidate endpoints (see instrumentEndpointCandidates) are tried at once, and the first to connect is used.
+        if instant_connect or probe_alternates is False, only the given endpoint is tried."""
+        if instant_connect or not self.probe_alternates:
+            _endpoints = [(connection_ip, connection_port)]
         else:
-            ping_result = universalPing(connection_ip, 1)
-        # print(f'ping = {ping}')
-        # xrf.connect((XRF_IP_USB, XRF_PORT_USB))
-        if not ping_result:
+            _endpoints = instrumentEndpointCandidates(connection_ip, connection_port)
+        _endpoint, _socket = probeInstrumentEndpoints(_endpoints)
+        if _socket is None and not instant_connect:
             if messagebox.askyesno(
                 f"Connection Problem - S1Control {__version__}",
                 f"S1Control has not recieved a response from the instrument at {connection_ip}, and is unable to connect. Would you like to continue trying to connect?",
             ):
                 connection_attempt_count = 0
-                while not ping_result:
-                    # ping will only equal 0 if there are no errors or timeouts
-                    ping_result = universalPing(connection_ip, 1)
-                    # os.system('ping -n 1 -w 40 '+XRF_IP_USB)
+                while _socket is None:
                     time.sleep(0.1)
-                    # print(f'ping = {universalPing}')
+                    _endpoint, _socket = probeInstrumentEndpoints(_endpoints)
                     connection_attempt_count += 1
-                    if connection_attempt_count >= 5:
+                    if _socket is None and connection_attempt_count >= 5:
                         if messagebox.askyesno(
                             f"Connection Problem - S1Control {__version__}",
                             f"S1Control has still not recieved a response from the instrument at {connection_ip}, and is still unable to connect. Would you like to continue trying to connect?",
@@ -150,48 +887,134 @@ class BrukerInstrument:
                             connection_attempt_count = 0
                         else:
                             raise SystemExit(0)
-                            closeAllThreads()
-                            gui.destroy()
             else:
                 raise SystemExit(0)
-                closeAllThreads()
-                gui.destroy()
 
+        if _socket is None:
+            print(
+                "Connection Error. Check instrument has booted to login screen and is properly connected before restarting the program."
+            )
+            return
+        if _endpoint != (connection_ip, connection_port):
+            print(f"Instrument found at {_endpoint[0]}:{_endpoint[1]}")
+        self.ip, self.port = _endpoint
         try:
-            self.socket.connect((connection_ip, connection_port))
+            if self.use_asyncio:
+                _socket.close()
+                self.connection = AsyncInstrumentConnection(self.ip, self.port)
+                self.connection.connect()
+            else:
+                self.socket = _socket
+                self.reader = FramedPacketReader(_socket)
         except Exception as e:
             print(
                 f"Connection Error. Check instrument has booted to login screen and is properly connected before restarting the program. ({repr(e)})"
             )
 
+    def reconnect(self, timeout: float = 5.0):
+        """Replaces a lost connection with a new one to the same address, without the interactive ping/retry prompts of open_tcp_connection. Raises if the instrument can't be reached."""
+        if self.replay is not None:
+            raise ConnectionError("A replayed session can't be reconnected")
+        try:
+            if self.connection is not None:
+                self.connection.close()
+            self.socket.close()
+        except Exception as e:
+            print(f"Error closing lost instrument connection. ({repr(e)})")
+        if self.use_asyncio:
+            self.connection = AsyncInstrumentConnection(
+                self.ip, self.port, connect_timeout=timeout
+            )
+            self.connection.connect()
+        else:
+            _socket = socket.create_connection((self.ip, self.port), timeout=timeout)
+            _socket.settimeout(None)
+            self.socket = _socket
+            self.reader = FramedPacketReader(_socket)
+
+    def start_recording(self, path: str):
+        """Starts recording all packets sent and received to a new .s1rec file at path (see PacketRecorder)."""
+        self.stop_recording()
+        self.recorder = PacketRecorder(path)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def fail_pending_queries(self, exception: Exception):
+        """Fails all pending query futures (e.g. when the connection is lost), so nothing waits on them until they time out."""
+        with self._pending_queries_lock:
+            _pending = [
+                _f for _futures in self.pending_queries.values() for _f in _futures
+            ]
+            self.pending_queries.clear()
+        for _future in _pending:
+            if not _future.done():
+                _future.set_exception(exception)
+
+    def reconnect_stats(self) -> dict:
+        """Returns dict of reconnection metrics for this session."""
+        return {
+            "reconnects": self.reconnect_count,
+            "attempts": self.reconnect_attempts_total,
+            "latency_s_max": max(self.reconnect_latencies_s, default=0),
+            "outage_s_max": max(self.outage_durations_s, default=0),
+            "outage_s_total": sum(self.outage_durations_s),
+        }
+
     def close_tcp_connection(self):
+        if self.connection is not None:
+            self.connection.close()
         self.socket.close()
         printAndLog("Instrument Connection Closed.", "WARNING")
 
-    def receive_chunks(self, expected_len) -> bytes:
-        """intermediate function used by receive_data"""
-        chunks = []
-        recv_len = 0
-        while recv_len < expected_len:
-            chunk = self.socket.recv(expected_len - recv_len)
-            if chunk == b"":
-                raise Exception("XRF Socket connection broken")
-            chunks.append(chunk)
-            recv_len = recv_len + len(chunk)
-        return b"".join(chunks)
+    def wait_for_data(self, timeout: float = None) -> bool:
+        """Blocks until the instrument socket has data waiting to be read, or until `timeout` (seconds) expires.
+        Returns True if data is waiting. If the socket is in a bad state, returns True so that receive_data() can raise the error."""
+        if self.connection is not None:
+            return self.connection.wait_for_packet(timeout)
+        if self.reader.buffered():
+            return True
+        try:
+            _readable, _, _ = select.select([self.socket], [], [], timeout)
+        except (OSError, ValueError):
+            return True
+        return bool(_readable)
+
+    def data_is_waiting(self) -> bool:
+        """Returns True if there is data already waiting in the receive buffer (does not block)."""
+        return self.wait_for_data(timeout=0)
+
+    def record_listen_burst(self):
+        """Called by the listen loop each time the receive buffer has been fully drained.
+        Packets handled after the first one in a burst were backlog that would previously have waited behind the 100ms sleep."""
+        if self.listen_burst_packets > 1:
+            self.listen_backlog_packets_drained += self.listen_burst_packets - 1
+        if self.listen_burst_packets > self.listen_burst_max:
+            self.listen_burst_max = self.listen_burst_packets
+        self.listen_burst_packets = 0
 
     def receive_data(self) -> tuple[dict, str]:
         """Receives data waiting in buffer from the connected instrument.
         structure is handled via indicator bytes in header.
-        Returns tuple of the receieved data (as an OrderedDict), and the datatype code (see constants)"""
-        _header = self.receive_chunks(10)
-        _data_size = int.from_bytes(_header[6:10], "little")
-        _data = self.receive_chunks(_data_size)
-        _footer = self.receive_chunks(4)
+        Returns tuple of the receieved data (as an OrderedDict), and the datatype code (see constants).
+        Binary packets (spectra, spectrum energies) are returned as a memoryview into the reader buffer, which is only valid until the next call."""
+        if self.connection is not None:
+            _header, _data, _footer = self.connection.read_packet()
+        else:
+            _header, _data, _footer = self.reader.read_packet()
+        if self.recorder is not None:
+            self.recorder.record(S1REC_RECEIVED, _header, _data, _footer)
+        _packet_type = _header[4:6]
 
-        if _header[4:6] == b"\x17\x80":  # 5 - XML PACKET (Usually results?)
+        if _packet_type == b"\x17\x80":  # 5 - XML PACKET (Usually results?)
             _datatype = XML_PACKET
-            _data = _data.decode("utf-8")
+            # check root tag first, so results packets can go straight to their own decoder
+            _root, _ = classifyXMLPacket(_data)
+            if _root == "Data":
+                return decodeResultsPacket(_data), _datatype
+            _data = str(_data, "utf-8")
             # print(data)
             _data = xmltodict.parse(_data)
             if (
@@ -216,39 +1039,58 @@ class BrukerInstrument:
             return _data, _datatype
 
         # 1 - COOKED SPECTRUM
-        elif _header[4:6] == b"\x01\x80":
+        elif _packet_type == b"\x01\x80":
             _datatype = COOKED_SPECTRUM
             return _data, _datatype
         # 2 - RESULTS SET (don't really know when this is used?)    // Deprecated?
-        elif _header[4:6] == b"\x02\x80":
+        elif _packet_type == b"\x02\x80":
             _datatype = RESULTS_SET
-            return _data, _datatype
+            return bytes(_data), _datatype
         # 3 - RAW SPECTRUM  // Deprecated?
-        elif _header[4:6] == b"\x03\x80":
+        elif _packet_type == b"\x03\x80":
             _datatype = RAW_SPECTRUM
             return _data, _datatype
         # 4 - PDZ FILENAME // Deprecated, no longer works :(
-        elif _header[4:6] == b"\x04\x80":
+        elif _packet_type == b"\x04\x80":
             _datatype = PDZ_FILENAME
-            return _data, _datatype
+            return bytes(_data), _datatype
         # 6 - STATUS CHANGE     (i.e. trigger pulled/released, assay start/stop/complete, phase change, etc.)
-        elif _header[4:6] == b"\x18\x80":
+        elif _packet_type == b"\x18\x80":
             _datatype = STATUS_CHANGE
+            _status = decodeStatusPacket(_data)
+            if _status is not None:
+                return _status, _datatype
+            # anything other than a simple status change (e.g. application selection)
             _data = (
-                _data.decode("utf-8")
+                str(_data, "utf-8")
                 .replace("\n", "")
                 .replace("\r", "")
                 .replace("\t", "")
             )
             _data = xmltodict.parse(_data)
+            _element = _data.get("Status")
+            if (
+                isinstance(_element, dict)
+                and "@parameter" in _element
+                and all(_k.startswith("@") or _k == "#text" for _k in _element)
+            ):
+                # still just a status change, only one the pattern doesn't cover (e.g. an extra attribute, or an entity in the text)
+                return (
+                    StatusPacket(
+                        parameter=_element["@parameter"],
+                        text=(_element.get("#text") or "").strip(),
+                    ),
+                    _datatype,
+                )
             return _data, _datatype
         # 7 - SPECTRUM ENERGY PACKET
-        elif _header[4:6] == b"\x0b\x80":
+        elif _packet_type == b"\x0b\x80":
             _datatype = SPECTRUM_ENERGY_PACKET
             return _data, _datatype
         # 0 - UNKNOWN DATA
         else:
             _datatype = UNKNOWN_DATA
+            _header, _data = bytes(_header), bytes(_data)
             printAndLog(f"****debug: unknown datatype. {_header=}, {_data=}")
             return _data, _datatype
 
@@ -260,10 +1102,94 @@ class BrukerInstrument:
             + _msg.encode("utf-8")
             + b"\x06\x2a\xff\xff"
         )
-        sent = self.socket.sendall(_msg_data)
+        if self.recorder is not None:
+            self.recorder.record(S1REC_SENT, _msg_data)
+        if self.connection is not None:
+            self.connection.send(_msg_data)
+            return
+        # lock so that commands sent from different threads (Tk, GeRDA, listen loop) can't interleave
+        with self._send_lock:
+            sent = self.socket.sendall(_msg_data)
         if sent == 0:
             raise Exception("XRF Socket connection broken")
 
+    def query(
+        self, parameter: str, command: str, timeout: float = 3.0, retries: int = 2
+    ) -> concurrent.futures.Future:
+        """Sends a query command and returns a Future, resolved with the parsed Response (whatever receive_data returned) when a Response with matching @parameter arrives.
+        If no response arrives within `timeout` seconds the command is re-sent, up to `retries` times, after which the Future fails with TimeoutError.
+        Queries for different parameters don't wait on each other, so independent queries can all be sent at once and then waited on together."""
+        _future = concurrent.futures.Future()
+        _key = parameter.lower()
+        with self._pending_queries_lock:
+            self.pending_queries.setdefault(_key, []).append(_future)
+        try:
+            self.send_command(command)
+        except Exception:
+            self._forget_query(_key, _future)
+            raise
+        self._schedule_query_timeout(_key, _future, command, timeout, retries)
+        return _future
+
+    def _schedule_query_timeout(
+        self,
+        key: str,
+        future: concurrent.futures.Future,
+        command: str,
+        timeout: float,
+        retries: int,
+    ):
+        _timer = threading.Timer(
+            timeout,
+            self._query_timed_out,
+            args=(key, future, command, timeout, retries),
+        )
+        _timer.daemon = True
+        _timer.start()
+
+    def _query_timed_out(
+        self,
+        key: str,
+        future: concurrent.futures.Future,
+        command: str,
+        timeout: float,
+        retries: int,
+    ):
+        if future.done():
+            return
+        if retries > 0:
+            self.query_retries_total += 1
+            print(f"No response to query '{key}' after {timeout}s, re-sending.")
+            try:
+                self.send_command(command)
+            except Exception as e:
+                print(f"Query '{key}' could not be re-sent. ({repr(e)})")
+            else:
+                self._schedule_query_timeout(key, future, command, timeout, retries - 1)
+                return
+        if self._forget_query(key, future):
+            # (if it wasn't pending any more, resolve_query() got to it first)
+            future.set_exception(TimeoutError(f"No response to query '{key}'"))
+
+    def _forget_query(self, key: str, future: concurrent.futures.Future) -> bool:
+        """Removes a query from pending_queries. Returns False if it was no longer pending."""
+        with self._pending_queries_lock:
+            _pending = self.pending_queries.get(key, [])
+            if future in _pending:
+                _pending.remove(future)
+                return True
+        return False
+
+    def resolve_query(self, parameter: str, data):
+        """Resolves the oldest pending query for `parameter` (lowercase) with the received response data. Called by the packet dispatcher for every Response packet."""
+        with self._pending_queries_lock:
+            _pending = self.pending_queries.get(parameter)
+            if not _pending:
+                return
+            _future = _pending.pop(0)
+        if not _future.done():
+            _future.set_result(data)
+
     # Commands
     def command_login(self):
         self.send_command("<Command>Login</Command>")
@@ -281,51 +1207,58 @@ class BrukerInstrument:
 
     # Queries
     def query_login_state(self):
-        self.send_command('<Query parameter="Login State"/>')
+        return self.query("Login State", '<Query parameter="Login State"/>')
 
     def query_armed_state(self):
-        self.send_command('<Query parameter="Armed State"/>')
+        return self.query("Armed State", '<Query parameter="Armed State"/>')
 
     def query_instrument_definition(self):
-        self.send_command('<Query parameter="Instrument Definition"/>')
+        return self.query(
+            "Instrument Definition", '<Query parameter="Instrument Definition"/>'
+        )
 
     def query_all_applications(self):
-        self.send_command('<Query parameter="Applications"/>')
+        return self.query("Applications", '<Query parameter="Applications"/>')
 
     def query_current_application_incl_methods(self):
-        self.send_command(
-            '<Query parameter="ActiveApplication">Include Methods</Query>'
+        return self.query(
+            "ActiveApplication",
+            '<Query parameter="ActiveApplication">Include Methods</Query>',
         )
 
     def query_methods_for_current_application(self):
-        self.send_command('<Query parameter="Method"></Query>')
+        return self.query("Method", '<Query parameter="Method"></Query>')
 
     def query_current_application_prefs(self):
-        self.send_command('<Query parameter="User Preferences"></Query>')
+        return self.query(
+            "User Preferences", '<Query parameter="User Preferences"></Query>'
+        )
 
     def query_current_application_phase_times(self):
-        self.send_command('<Query parameter="Phase Times"/>')
+        return self.query("Phase Times", '<Query parameter="Phase Times"/>')
 
     def query_software_version(self):
-        self.send_command('<Query parameter="Version"/>')
+        return self.query("Version", '<Query parameter="Version"/>')
 
     def query_nose_temp(self):
-        self.send_command('<Query parameter="Nose Temperature"/>')
+        return self.query("Nose Temperature", '<Query parameter="Nose Temperature"/>')
 
     def query_nose_pressure(self):
-        self.send_command('<Query parameter="Nose Pressure"/>')
+        return self.query("Nose Pressure", '<Query parameter="Nose Pressure"/>')
 
     def query_edit_fields(self):
-        self.send_command('<Query parameter="Edit Fields"/>')
+        return self.query("Edit Fields", '<Query parameter="Edit Fields"/>')
 
     def query_proximity_required(self):
-        self.send_command('<Query parameter="Proximity Required"/>')
+        return self.query(
+            "Proximity Required", '<Query parameter="Proximity Required"/>'
+        )
 
     def query_store_results(self):
-        self.send_command('<Query parameter="Store Results"/>')
+        return self.query("Store Results", '<Query parameter="Store Results"/>')
 
     def query_store_spectra(self):
-        self.send_command('<Query parameter="Store Spectra"/>')
+        return self.query("Store Spectra", '<Query parameter="Store Spectra"/>')
 
     # Configuration commands
     def configure_transmit_elemental_results_enable(self):
@@ -382,6 +1315,9 @@ class Assay:
     temps: str
     note: str
     sanity_check_passed: str  # 'PASS', 'FAIL', or 'N/A'
+    timeresolved: list = None  # TimeResolvedSpectrumBuffer of each phase, if 'Keep Time-Resolved Spectra' was on. otherwise None
+    peaks: pd.DataFrame = None  # labelled peaks found in each phase (see labelPeaks)
+    vitals: list = None  # summary dict of count rate, dead time, live time etc. for each phase (see VitalsEngine.end_phase)
 
 
 @dataclass
@@ -397,17 +1333,100 @@ class Illumination:
     actualcounts: int  # actual tuned counts value at specififed current
 
 
-def universalPing(host, num_tries):
-    """
-    Returns True if host (str) responds to a ping request.
-    Remember that a host may not respond to a ping (ICMP) request even if the host name is valid.
+def probeInstrumentEndpoints(
+    endpoints: list[tuple[str, int]],
+    timeout: float = INSTRUMENT_ENDPOINT_PROBE_TIMEOUT_S,
+) -> tuple[tuple[str, int], socket.socket]:
+    """Tries TCP connections to all (ip, port) endpoints at once. Doesn't rely on ICMP (ping) being allowed.
+    Returns tuple of the endpoint used and its connected socket, or (None, None) if none connected within timeout (s).
+    endpoints are in order of preference: one that connects is only used once all endpoints before it have failed,
+    so that e.g. a proxy accepting connections on an alternate address can't win over the instrument on the given address.
     """
-    num_tries = str(num_tries)
-    # Option for the number of packets as a function of
-    param = "-n" if sys.platform.startswith("win") else "-c"
-    # Building the command. Ex: "ping -c 1 google.com"
-    command = ["ping", param, num_tries, host]
-    return subprocess.call(command) == 0
+    if not endpoints:
+        return None, None
+    _executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(endpoints))
+    _probes = [
+        _executor.submit(socket.create_connection, _endpoint, timeout)
+        for _endpoint in endpoints
+    ]
+    _winner = None
+    for _ in concurrent.futures.as_completed(_probes):
+        # the most preferred probe that hasn't failed. used as soon as it has connected.
+        _best = next(
+            (_p for _p in _probes if not _p.done() or _p.exception() is None), None
+        )
+        if _best is None:
+            break
+        if _best.done():
+            _winner = _best
+            break
+    _executor.shutdown(wait=False)
+    # close any other connections that succeed, as and when they do
+    for _probe in _probes:
+        if _probe is not _winner:
+            _probe.add_done_callback(
+                lambda p: p.result().close() if p.exception() is None else None
+            )
+    if _winner is None:
+        return None, None
+    _socket = _winner.result()
+    _socket.settimeout(None)
+    return endpoints[_probes.index(_winner)], _socket
+
+
+def parseInstrumentAddress(address: str, default_port: int = 55204) -> tuple[str, int]:
+    """Returns (host, port) from an address given as 'host:port' or just 'host' (using default_port). Raises ValueError if it can't be parsed."""
+    _host, _separator, _port = address.strip().rpartition(":")
+    if not _separator:
+        _host, _port = _port, str(default_port)
+    if not _host or not _port.isdigit() or not 0 < int(_port) < 65536:
+        raise ValueError(f"'{address}' is not a valid instrument address")
+    return _host, int(_port)
+
+
+def instrumentEndpointCachePath() -> str:
+    return rf"{os.getcwd()}/instrument-endpoints.json"
+
+
+def loadInstrumentEndpointCache() -> dict:
+    """Returns dict of {serial number: {'ip', 'port', 'last_connected'}} of the endpoints instruments were last connected on."""
+    try:
+        with open(instrumentEndpointCachePath(), "r") as _cachefile:
+            return json.load(_cachefile)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Instrument endpoint cache could not be read. ({repr(e)})")
+        return {}
+
+
+def rememberInstrumentEndpoint(serial_number: str, ip: str, port: int):
+    """Saves the endpoint an instrument was connected on, so it's tried first next time."""
+    if serial_number in (None, "UNKNOWN"):
+        return
+    _cache = loadInstrumentEndpointCache()
+    _cache[serial_number] = {"ip": ip, "port": port, "last_connected": time.time()}
+    try:
+        with open(instrumentEndpointCachePath(), "w") as _cachefile:
+            json.dump(_cache, _cachefile, indent=4)
+    except Exception as e:
+        print(f"Instrument endpoint cache could not be saved. ({repr(e)})")
+
+
+def instrumentEndpointCandidates(ip: str, port: int) -> list[tuple[str, int]]:
+    """Returns list of (ip, port) endpoints to try when connecting: the given endpoint, then cached endpoints (most recently connected first), then INSTRUMENT_ENDPOINT_ALTERNATES."""
+    _cached = sorted(
+        loadInstrumentEndpointCache().values(),
+        key=lambda e: e.get("last_connected", 0),
+        reverse=True,
+    )
+    _candidates = [(ip, port)]
+    for _endpoint in [(_e["ip"], int(_e["port"])) for _e in _cached] + list(
+        INSTRUMENT_ENDPOINT_ALTERNATES
+    ):
+        if _endpoint not in _candidates:
+            _candidates.append(_endpoint)
+    return _candidates
 
 
 def instrument_StartAssay(
@@ -417,6 +1436,13 @@ def instrument_StartAssay(
     customassay_current: float = None,
     customassay_duration: int = None,
 ):
+    pxrf.last_assay_start_args = {
+        "customassay": customassay,
+        "customassay_filter": customassay_filter,
+        "customassay_voltage": customassay_voltage,
+        "customassay_current": customassay_current,
+        "customassay_duration": customassay_duration,
+    }
     pxrf.instr_assayisrunning = True
     printAndLog(f"Starting Assay # {str(pxrf.assay_catalogue_num).zfill(4)}", "INFO")
     unselectAllAssays()
@@ -503,7 +1529,7 @@ def instrument_SetImportantStartupConfigurables():
     # enable transmission of trigger pull, assay complete messages, etc. necessary for basic function.
     pxrf.configure_transmit_status_messages_enable()
     # Enable transmission of elemental results, disables transmission of grade ID / passfail results
-    pxrf.configure_transmit_elemental_results_enable
+    pxrf.configure_transmit_elemental_results_enable()
     # Enable transmission of trigger pull/release and assay start/stop status messages
     pxrf.configure_transmit_spectra_enable()
     # printAndLog('Instrument Transmit settings have been configured automatically to allow program functionality.')
@@ -688,11 +1714,14 @@ def elementSymboltoName(sym: str):
         return "Error: Symbol too long"
 
 
-def instrument_GetInfo():
-    pxrf.query_instrument_definition()
-    pxrf.query_all_applications()
-    pxrf.query_current_application_incl_methods()
-    pxrf.query_software_version()
+def instrument_GetInfo() -> list[concurrent.futures.Future]:
+    """Queries instrument definition, applications, current application and software version. Returns the query futures (see waitForQueries)."""
+    return [
+        pxrf.query_instrument_definition(),
+        pxrf.query_all_applications(),
+        pxrf.query_current_application_incl_methods(),
+        pxrf.query_software_version(),
+    ]
 
 
 def printInstrumentInfo():
@@ -835,16 +1864,159 @@ def initialiseLogFile():
         )
 
 
-def instrument_GetStates():
-    pxrf.query_login_state()
-    pxrf.query_armed_state()
-    gui.after(800, getOtherStates)
+def initialiseAssayCatalogue(folder: str = None):
+    """Opens the assay catalogue and spectra archive files for this session in folder (default /Catalogues), named like the log file (see AssayCatalogue, SpectraArchive),
+    and starts storing the session's results in the results store (/Results/Store, see ResultsStore)."""
+    if folder is None:
+        folder = rf"{os.getcwd()}/Catalogues"
+    try:
+        pxrf.assay_catalogue.open(
+            rf"{folder}/S1Control_Catalogue_{datetimeString}_{pxrf.instr_serialnumber}"
+        )
+    except Exception as e:
+        printAndLog(
+            f"Assay catalogue could not be created, a temporary one will be used. ({repr(e)})",
+            "ERROR",
+        )
+    try:
+        pxrf.spectra_archive.open(
+            rf"{folder}/S1Control_Spectra_{datetimeString}_{pxrf.instr_serialnumber}"
+        )
+    except Exception as e:
+        printAndLog(
+            f"Spectra archive could not be created, spectra will not be archived. ({repr(e)})",
+            "ERROR",
+        )
+    try:
+        pxrf.results_store.open(
+            rf"{os.getcwd()}/Results/Store",
+            f"{datetimeString}_{pxrf.instr_serialnumber}",
+        )
+    except Exception as e:
+        printAndLog(
+            f"Results store could not be opened, results will only be saved to CSV. ({repr(e)})",
+            "ERROR",
+        )
+
+
+def findSessionToResume(path: str = None) -> tuple[str, str]:
+    """Returns tuple (catalogue path, datetime string) of the session to resume: the catalogue at path (with or without .sqlite),
+    or if path is None, the latest catalogue in /Catalogues for the connected instrument. Returns (None, None) if there isn't one."""
+    if path is None:
+        _folder = rf"{os.getcwd()}/Catalogues"
+        _suffix = f"_{pxrf.instr_serialnumber}.sqlite"
+        _names = sorted(
+            _name
+            for _name in (os.listdir(_folder) if os.path.exists(_folder) else [])
+            if _name.startswith("S1Control_Catalogue_") and _name.endswith(_suffix)
+        )
+        if not _names:
+            return None, None
+        path = rf"{_folder}/{_names[-1]}"
+    path = path.removesuffix(".sqlite")
+    _match = re.fullmatch(
+        r"S1Control_Catalogue_(\d{8}-\d{6})_(.+)", os.path.basename(path)
+    )
+    if not os.path.exists(f"{path}.sqlite") or _match is None:
+        return None, None
+    if _match.group(2) != pxrf.instr_serialnumber:
+        printAndLog(
+            f"Session {os.path.basename(path)} was with instrument {_match.group(2)}, not {pxrf.instr_serialnumber}, so can't be resumed.",
+            "WARNING",
+        )
+        return None, None
+    return path, _match.group(1)
+
+
+def resumeSession(path: str = None) -> bool:
+    """Carries on a previous session (see findSessionToResume) instead of starting a new one: its catalogue and spectra archive are reopened and appended to,
+    and results/assay CSVs carry on in the same files. Only the assay summaries are read (see AssayCatalogue.summaries) to refill the assays table,
+    assays themselves are loaded from disk when selected. The ROI table catches up when the next assay completes.
+    Returns False (and nothing is changed) if there is no session to resume."""
+    global datetimeString
+    _t0 = time.perf_counter()
+    _path, _datetimeString = findSessionToResume(path)
+    if _path is None:
+        printAndLog("No previous session found to resume.", "WARNING")
+        return False
+    _newDatetimeString = datetimeString
+    datetimeString = _datetimeString
+    initialiseAssayCatalogue(os.path.dirname(_path))
+    if os.path.normpath(pxrf.assay_catalogue.path or "") != os.path.normpath(_path):
+        printAndLog(f"Session {os.path.basename(_path)} could not be resumed.", "ERROR")
+        pxrf.assay_catalogue.close()
+        pxrf.spectra_archive.close()
+        datetimeString = _newDatetimeString
+        return False
+    pxrf.assay_catalogue_num = len(pxrf.assay_catalogue) + 1
+    for _summary in pxrf.assay_catalogue.summaries():
+        assaysTable.insert(parent="", index="end", iid=_summary[0], values=_summary)
+
+    # new results are added to the results csv's rows, as read back from it. rows are only appended while the columns stay the same,
+    # otherwise the whole file is rewritten (see IncrementalCSVWriter), so it's read as text to be written back exactly as it was.
+    _resultsFilePath = rf"{os.getcwd()}/Results/S1Control_Results_{datetimeString}_{pxrf.instr_serialnumber}.csv"
+    if os.path.exists(_resultsFilePath):
+        try:
+            csv_writers[_resultsFilePath] = IncrementalCSVWriter(
+                _resultsFilePath,
+                pd.read_csv(_resultsFilePath, dtype=str, keep_default_na=False),
+            )
+        except Exception as e:
+            printAndLog(
+                f"Results CSV of resumed session could not be read, it will be restarted. ({repr(e)})",
+                "ERROR",
+            )
+
+    if len(pxrf.assay_catalogue) and doAutoPlotSpectra_var.get():
+        assaysTable.selection_set(assaysTable.get_children()[-1])
+    assaysTable.yview_moveto(1)
+    printAndLog(
+        f"Resumed session {datetimeString}: {len(pxrf.assay_catalogue)} assays ({time.perf_counter() - _t0:.2f}s).",
+        "INFO",
+    )
+    return True
+
+
+def instrument_GetStates() -> list[concurrent.futures.Future]:
+    """Queries login/armed states and instrument settings. Returns the query futures (see waitForQueries)."""
+    return [
+        pxrf.query_login_state(),
+        pxrf.query_armed_state(),
+    ] + getOtherStates()
+
+
+def getOtherStates() -> list[concurrent.futures.Future]:
+    return [
+        pxrf.query_proximity_required(),
+        pxrf.query_store_results(),
+        pxrf.query_store_spectra(),
+    ]
 
 
-def getOtherStates():
-    pxrf.query_proximity_required()
-    pxrf.query_store_results()
-    pxrf.query_store_spectra()
+def waitForQueries(
+    futures: list[concurrent.futures.Future], timeout: float = 10.0
+) -> bool:
+    """Blocks until all query futures are resolved (or have failed), or until timeout (s). Returns True if all were answered.
+    Must not be called from the listen loop thread, as that is what resolves them. If called from the main thread, the gui is kept updating while waiting."""
+    _deadline = time.monotonic() + timeout
+    _on_main_thread = threading.current_thread() is threading.main_thread()
+    while True:
+        _remaining = _deadline - time.monotonic()
+        _done, _not_done = concurrent.futures.wait(
+            futures, timeout=min(0.05, _remaining) if _on_main_thread else _remaining
+        )
+        if not _not_done or _remaining <= 0:
+            break
+        if _on_main_thread:
+            gui.update()
+    _all_answered = not _not_done
+    for _future in _done:
+        if _future.exception() is not None:
+            print(f"Instrument query failed. ({repr(_future.exception())})")
+            _all_answered = False
+    if _not_done:
+        print(f"{len(_not_done)} instrument queries still unanswered after {timeout}s.")
+    return _all_answered
 
 
 # XRF Listen Loop Functions
@@ -878,1077 +2050,1999 @@ def xrfListenLoopThread_Check():
 
 
 def xrfListenLoop():
-    """main listen and action loop for responding to data from instrument in realtime. to be run in own thread."""
+    """main listen and action loop for responding to data from instrument in realtime. to be run in own thread.
+    Blocks until the instrument socket is readable, then handles every packet already waiting in the buffer before blocking again.
+    """
     while True:
+        if not pxrf.data_is_waiting():
+            # buffer drained - record the backlog that was just handled, then block until more data arrives.
+            pxrf.record_listen_burst()
+            while not pxrf.wait_for_data(timeout=0.5):
+                # timeout only so that thread_halt is still checked while the instrument is quiet
+                if thread_halt:
+                    break
+
+        if thread_halt:
+            break
+
         try:
             data, datatype = pxrf.receive_data()
         except Exception as e:
             printAndLog(repr(e))
             printAndLog("XRF CONNECTION LOST", "ERROR")
+            if reconnectInstrument():
+                continue
             onInstrDisconnect()
-
-        if thread_halt:
             break
 
+        pxrf.listen_packets_received += 1
+        pxrf.listen_burst_packets += 1
+
         # print(data)
+        packet_dispatcher.dispatch(data, datatype)
 
-        # 6 - STATUS CHANGE
-        if datatype == STATUS_CHANGE:
-            if "@parameter" in data["Status"]:  #   basic status change
-                statusparam = data["Status"]["@parameter"]
-                statustext = data["Status"]["#text"]
-
-                printAndLog(f"Status Change: {statusparam} {statustext}")
-
-                if statusparam == "Assay" and statustext == "Start":
-                    pxrf.instr_currentphase = 0
-                    if pxrf.instr_currentapplication != "Custom Spectrum":
-                        # only need to calculate assay total set time if it ISN'T a custom spectrum assay. if it is, it is set in startAssay()
-                        pxrf.instr_currentphaselength_s = int(
-                            phasedurations[pxrf.instr_currentphase]  # noqa: F821
-                        )
-                        pxrf.assay_time_total_set_seconds = 0
-                        for dur in phasedurations:  # noqa: F821
-                            pxrf.assay_time_total_set_seconds += int(dur)
-                    else:
-                        pxrf.instr_currentphaselength_s = int(
-                            customspectrum_duration_entry.get()
-                        )
-                        pxrf.assay_time_total_set_seconds = (
-                            pxrf.instr_currentphaselength_s
-                        )
-                        phasedurations = ["0"]
-                    pxrf.assay_start_time = time.time()
-                    pxrf.instr_assayisrunning = True
-                    pxrf.assay_phase_spectrumpacketcounter = 0
-
-                    # set variables for assay
-                    pxrf.instr_currentassayspectra = []
-                    pxrf.instr_currentassayspecenergies = []
-                    pxrf.instr_currentassaylegends = []
-                    pxrf.instr_currentassayresults = default_assay_results_df
-
-                    xraysonbar.start()
-
-                    if doAutoPlotSpectra_var.get():
-                        clearCurrentSpectra()
-
-                elif statusparam == "Assay" and statustext == "Complete":
-                    pxrf.assay_end_time = time.time()
-                    # instr_assayisrunning = False
-
-                    # print(spectra)
-                    try:
-                        pxrf.instr_currentassayspectra.append(
-                            pxrf.current_working_spectra[-1]
-                        )
-                        pxrf.instr_currentassayspecenergies.append(
-                            pxrf.current_working_specenergies[-1]
-                        )  # noqa: F823
-                        # legend = f"Phase {instr_currentphase+1}: {txt['sngHVADC']}kV, {round(float(txt['sngCurADC']),2)}\u03bcA"
-                        legend = f"Phase {pxrf.instr_currentphase+1}({pxrf.instr_currentphaselength_s}s): {txt['sngHVADC']}kV, {round(float(txt['sngCurADC']),2)}\u03bcA {txt['fltDescription']}"  # noqa: F821
-                        pxrf.instr_currentassaylegends.append(legend)
-                        # plotSpectrum(spectra[-1], specenergies[-1], plotphasecolours[instr_currentphase],legend)
-                    except Exception as e:
-                        printAndLog(
-                            f"Issue with Spectra experienced after completion of Assay. {(repr(e))}",
-                            "WARNING",
-                        )
+        # statusUpdateCheck()
+        # try:
+        #     print(f"{sys. getsizeof(assay_catalogue)=}")
+        # except:
+        #     pass
 
-                    # REPORT TEMPS EACH ASSAY COMPLETE
-                    assay_finaltemps = f"Detector {pxrf.instr_currentdettemp}°C, Ambient {pxrf.instr_currentambtemp}°C"
-                    # if detector temp or ambient temp are out of range, change colour of message.
-                    temp_msg_colour = "BASIC"  # set as default
-                    try:
-                        if (
-                            float(pxrf.instr_currentdettemp) > (-25)
-                            or float(pxrf.instr_currentdettemp) < (-29)
-                            or float(pxrf.instr_currentambtemp) > (65)
-                        ):
-                            temp_msg_colour = "ERROR"
-                            printAndLog(
-                                f"ERROR: Instrument Temperatures appear to be FAR outside of the normal range! {assay_finaltemps}",
-                                logbox_colour_tag="ERROR",
-                            )
 
-                        elif (
-                            float(pxrf.instr_currentdettemp) > (-26)
-                            or float(pxrf.instr_currentdettemp) < (-28)
-                            or float(pxrf.instr_currentambtemp) > (55)
-                        ):
-                            printAndLog(
-                                f"WARNING: Instrument Temperatures appear to be outside of the normal range! {assay_finaltemps}",
-                                logbox_colour_tag="WARNING",
-                            )
-                        else:
-                            printAndLog(f"Temps: {assay_finaltemps}", "BASIC")
-                    except Exception as e:  # likely no spectra packets sent
-                        print(
-                            f"Temps check failed, likely due to no spectra packets sent. ({repr(e)})"
-                        )
-                        printAndLog(f"Temps: {assay_finaltemps}", temp_msg_colour)
-                    # printAndLog(f'Amb Temp F: {instr_currentambtemp_F}°F')
-                    # instrument_QueryNoseTemp()
-
-                    # add full assay with all phases to table and catalogue. this 'assay complete' response is usually recieved at very end of assay, when all other values are in place.
-                    if pxrf.instr_currentassayresults.equals(default_assay_results_df):
-                        completeAssay(
-                            pxrf.instr_currentapplication,
-                            pxrf.instr_currentmethod,
-                            pxrf.assay_time_total_set_seconds,
-                            default_assay_results_df,
-                            pxrf.instr_currentassayspectra,
-                            pxrf.instr_currentassayspecenergies,
-                            pxrf.instr_currentassaylegends,
-                            assay_finaltemps,
-                        )
-                    else:
-                        completeAssay(
-                            pxrf.instr_currentapplication,
-                            pxrf.instr_currentmethod,
-                            pxrf.assay_time_total_set_seconds,
-                            pxrf.instr_currentassayresults,
-                            pxrf.instr_currentassayspectra,
-                            pxrf.instr_currentassayspecenergies,
-                            pxrf.instr_currentassaylegends,
-                            assay_finaltemps,
-                        )
+def reconnectInstrument() -> bool:
+    """Called from the listen loop when the instrument connection is lost. Retries the connection with exponential backoff, then resynchronises the session.
+    Returns True once reconnected, or False if RECONNECT_GIVE_UP_S passed (or the program is closing) without reconnecting."""
+    _lost_time = time.monotonic()
+    _assay_was_running = pxrf.instr_assayisrunning
+    pxrf.fail_pending_queries(ConnectionError("Instrument connection lost"))
+    _delay = RECONNECT_BACKOFF_INITIAL_S
+    _attempts = 0
+    while True:
+        _attempts += 1
+        pxrf.reconnect_attempts_total += 1
+        try:
+            pxrf.reconnect()
+            break
+        except Exception as e:
+            print(f"Reconnection attempt {_attempts} failed. ({repr(e)})")
+        if time.monotonic() - _lost_time + _delay > RECONNECT_GIVE_UP_S:
+            printAndLog(
+                f"Unable to reconnect to the instrument after {_attempts} attempts.",
+                "ERROR",
+            )
+            return False
+        printAndLog(
+            f"Instrument connection lost, retrying in {_delay:.1f}s...", "WARNING"
+        )
+        _retry_time = time.monotonic() + _delay
+        while time.monotonic() < _retry_time:
+            if thread_halt:
+                return False
+            time.sleep(0.1)
+        _delay = min(_delay * 2, RECONNECT_BACKOFF_MAX_S)
+    _latency = time.monotonic() - _lost_time
+    pxrf.reconnect_count += 1
+    pxrf.reconnect_latencies_s.append(_latency)
+    printAndLog(
+        f"Instrument reconnected after {_latency:.1f}s ({_attempts} attempts). Resynchronising...",
+        "WARNING",
+    )
+    # re-send configuration and re-query state. the answers arrive through this (listen loop) thread, so are waited on elsewhere.
+    instrument_SetImportantStartupConfigurables()
+    _queries = instrument_GetStates() + [
+        pxrf.query_current_application_incl_methods(),
+        pxrf.query_current_application_phase_times(),
+    ]
+    threading.Thread(
+        target=resynchroniseAfterReconnect,
+        args=(_queries, _lost_time, _assay_was_running),
+        daemon=True,
+    ).start()
+    return True
+
+
+def resynchroniseAfterReconnect(
+    queries: list[concurrent.futures.Future],
+    lost_time: float,
+    assay_was_running: bool,
+):
+    """Waits for the state queries sent after reconnecting, then logs back in and repeats the assay that was interrupted (if any), so that consecutive assays / GeRDA sequences carry on."""
+    if not waitForQueries(queries):
+        printAndLog(
+            "Not all instrument states could be re-queried after reconnecting.",
+            "WARNING",
+        )
+    if not pxrf.instr_isloggedin:
+        pxrf.command_login()
+    if assay_was_running and pxrf.last_assay_start_args is not None:
+        printAndLog(
+            "The assay in progress when the connection was lost has been discarded, and will be repeated.",
+            "WARNING",
+        )
+        instrument_StartAssay(**pxrf.last_assay_start_args)
+    _outage = time.monotonic() - lost_time
+    pxrf.outage_durations_s.append(_outage)
+    printAndLog(
+        f"Instrument session resynchronised. Outage duration: {_outage:.1f}s", "INFO"
+    )
 
-                    # reset variables for next assay
-                    pxrf.instr_currentassayspectra = []
-                    pxrf.instr_currentassayspecenergies = []
-                    pxrf.instr_currentassaylegends = []
-                    pxrf.instr_currentassayresults = default_assay_results_df
-                    pxrf.instr_assayrepeatsleft -= 1
-                    if pxrf.instr_assayrepeatsleft <= 0:
-                        printAndLog("All Assays complete.")
-                        notifyAllAssaysComplete(
-                            pxrf.instr_assayrepeatschosenforcurrentrun
-                        )
-                        assayprogressbar.set(1)
-                        ui_EndOfAssaysReset()
-                    elif pxrf.instr_assayrepeatsleft > 0:
-                        printAndLog(
-                            f"Consecutive Assays remaining: {pxrf.instr_assayrepeatsleft} more."
-                        )
-                        # if custom spectrum is selected, need to re-provide the parameters, as it is not an actual application on the instrument.
-                        if applicationselected_stringvar.get() == "Custom Spectrum":
-                            instrument_StartAssay(
-                                customassay=True,
-                                customassay_filter=customspectrum_filter_dropdown.get(),
-                                customassay_voltage=int(
-                                    customspectrum_voltage_entry.get()
-                                ),
-                                customassay_current=float(
-                                    customspectrum_current_entry.get()
-                                ),
-                                customassay_duration=int(
-                                    customspectrum_duration_entry.get()
-                                ),
-                            )
-                        else:
-                            instrument_StartAssay()
-                    pxrf.instr_assayisrunning = False
-                    xraysonbar.stop()
-                    # instr_currentphase = 0
-
-                elif statusparam == "Phase Change":
-                    pxrf.instr_assayisrunning = True
-                    # print(f'spec packets this phase: {assay_phase_spectrumpacketcounter}')
-                    pxrf.assay_phase_spectrumpacketcounter = 0
-                    pxrf.instr_currentphaselength_s = int(
-                        phasedurations[pxrf.instr_currentphase]
-                    )
-                    # try:
-                    pxrf.current_working_spectra[-1]["normalised_data"] = (
-                        normaliseSpectrum(
-                            pxrf.current_working_spectra[-1]["data"],
-                            pxrf.current_working_spectra[-1]["fTDur"],
-                        )
-                    )
-                    pxrf.instr_currentassayspectra.append(
-                        pxrf.current_working_spectra[-1]
-                    )
-                    pxrf.instr_currentassayspecenergies.append(
-                        pxrf.current_working_specenergies[-1]
-                    )
-                    legend = f"Phase {pxrf.instr_currentphase+1}({pxrf.instr_currentphaselength_s}s): {txt['sngHVADC']}kV, {round(float(txt['sngCurADC']),2)}\u03bcA {txt['fltDescription']}"  # noqa: F821
-                    # legend = f"Phase {instr_currentphase+1}: {txt['sngHVADC']}kV, {round(float(txt['sngCurADC']),2)}\u03bcA"
-                    pxrf.instr_currentassaylegends.append(legend)
-
-                    # printAndLog(f'Temps: Detector {instr_currentdettemp}°C, Ambient {instr_currentambtemp}°F')
-
-                    if doAutoPlotSpectra_var.get():
-                        plotSpectrum(
-                            pxrf.current_working_spectra[-1],
-                            pxrf.current_working_specenergies[-1],
-                            plotphasecolours[pxrf.instr_currentphase],
-                            legend,
-                        )
-                    # except: printAndLog('Issue with Spectra experienced after completion of Phase.')
-                    pxrf.instr_currentphase += 1
-                    pxrf.instr_currentphaselength_s = int(
-                        phasedurations[pxrf.instr_currentphase]
-                    )
 
-                elif statusparam == "Armed" and statustext == "No":
-                    pxrf.instr_isarmed = False
-                elif statusparam == "Armed" and statustext == "Yes":
-                    pxrf.instr_isarmed = True
-                    pxrf.instr_isloggedin = True
+# XRF Packet Handlers - registered with the PacketDispatcher in buildPacketDispatcher(). each takes the received data for one packet.
 
-            elif (
-                "Application Selection" in data["Status"]
-            ):  # new application selected DOESN"T WORK? only plays if selected on instr screen?
-                printAndLog("New Application Selected.")
-                # override rechecking these values IF custom selected.
-                if applicationselected_stringvar.get() != "Custom Spectrum":
-                    # sendCommand(xrf, bruker_query_currentapplicationinclmethods)
-                    pxrf.query_current_application_incl_methods()
-                # gui.after(200,ui_UpdateCurrentAppAndPhases)
-                # need to find way of queuing app checker
-
-            # printAndLog(data)
-
-        elif datatype == COOKED_SPECTRUM:  # COOKED SPECTRUM
-            txt, pxrf.current_working_spectra = setSpectrum(data)
-            pxrf.assay_phase_spectrumpacketcounter += 1
-            # printAndLog(f'New cooked Spectrum Info: {txt}')
-            # printAndLog(f"New cooked Spectrum")
-
-            if doDisplayVitals_var.get():
-                # if option box is checked for 'Display Count Rate and Dead Time %', and if so, update relevant display widget
-                updateCurrentVitalsDisplay(pxrf.current_working_spectra)
-
-        elif datatype == PDZ_FILENAME:  # PDZ FILENAME // Deprecated, no longer works :(
-            printAndLog(f"New PDZ: {data}")
 
-        elif (
-            datatype == RESULTS_SET
-        ):  # RESULTS SET (don't really know when this is used?)
-            # printAndLog(etree'.tostring(data, pretty_print=True))
-            printAndLog(data)
-
-        elif datatype == RAW_SPECTRUM:  # RAW SPECTRA
-            # data = hashlib.md5(data).hexdigest()
-            printAndLog("Raw spectrum!")
-            txt, pxrf.current_working_spectra = setSpectrum(data)
-            # printAndLog(data)
-
-        # 5 - XML PACKET
-        elif datatype == XML_PACKET:
-            if (
-                ("Response" in data)
-                and ("@parameter" in data["Response"])
-                and (data["Response"]["@parameter"] == "instrument definition")
-                and (data["Response"]["@status"] == "success")
-            ):
-                # All IDF data:
-                idf: dict = data["Response"]["InstrumentDefinition"]
-                # from pprint import pprint
-                # pprint(idf)
-
-                # Broken Down:
-                pxrf.instr_model = idf.get("Model", "N/A")
-                pxrf.instr_serialnumber = idf.get("SerialNumber", "N/A")
-                pxrf.instr_buildnumber = idf.get("BuildNumber", "N/A")
-                pxrf.instr_detectortype = pxrf.instr_buildnumber[0:3]
-
-                instr_detector = idf.get("Detector", "N/A")
-
-                if instr_detector != "N/A":
-                    pxrf.instr_detectormodel = instr_detector.get(
-                        "DetectorModel", "N/A"
-                    )
-                    if pxrf.instr_detectortype[1] in "PMK":
-                        # Older detectors with Beryllium windows. eg SPX, SMA, SK6, etc
-                        pxrf.instr_detectorwindowtype = "Beryllium"
-                        pxrf.instr_detectorwindowthickness = (
-                            instr_detector.get("BerylliumWindowThicknessInuM", "?")
-                            + "\u03bcM"
-                        )
-                    elif pxrf.instr_detectortype[1] in "G":
-                        pxrf.instr_detectorwindowtype = "Graphene"
-                        pxrf.instr_detectorwindowthickness = (
-                            instr_detector.get("GrapheneWindowThicknessInuM", "?")
-                            + "\u03bcM"
-                        )
-                        # In case instrument def is wrong (eg. Martin has graphene det, but only beryllium thickness listed)
-                    pxrf.instr_detectorresolution = (
-                        instr_detector.get("TypicalResolutionIneV", "?") + "eV"
-                    )
-                    pxrf.instr_detectormaxTemp = (
-                        instr_detector.get("OperatingTempMaxInC", "?") + "°C"
-                    )
-                    pxrf.instr_detectorminTemp = (
-                        instr_detector.get("OperatingTempMinInC", "?") + "°C"
-                    )
-                else:
-                    pxrf.instr_detectormodel = "N/A"
-                    pxrf.instr_detectorwindowtype = "N/A"
-                    pxrf.instr_detectorwindowthickness = "N/A"
-                    pxrf.instr_detectorresolution = "N/A"
-                    pxrf.instr_detectormaxTemp = "N/A"
-                    pxrf.instr_detectorminTemp = "N/A"
-
-                instr_source: dict = idf.get("XrayTube", "N/A")
-                # from pprint import pprint
-                # pprint(instr_source)
-                if instr_source != "N/A":
-                    instr_sourceoplimits: dict = instr_source.get(
-                        "OperatingLimits", "N/A"
-                    )
-                    pxrf.instr_sourcemanufacturer = instr_source.get(
-                        "Manufacturer", "N/A"
-                    )
-                    pxrf.instr_sourcetargetZ = instr_source.get(
-                        "TargetElementNumber", 0
-                    )
-                    pxrf.instr_sourcetargetSymbol = elementZtoSymbol(
-                        int(pxrf.instr_sourcetargetZ)
-                    )
-                    pxrf.instr_sourcetargetName = elementZtoName(
-                        int(pxrf.instr_sourcetargetZ)
-                    )
-                    if instr_sourceoplimits != "N/A":
-                        pxrf.instr_sourcemaxV = (
-                            instr_sourceoplimits.get("MaxHighVoltage", "?") + "kV"
-                        )
-                        pxrf.instr_sourceminV = (
-                            instr_sourceoplimits.get("MinHighVoltage", "?") + "kV"
-                        )
-                        pxrf.instr_sourcemaxI = (
-                            instr_sourceoplimits.get("MaxAnodeCurrentInuA", "?")
-                            + "\u03bcA"
-                        )
-                        pxrf.instr_sourceminI = (
-                            instr_sourceoplimits.get("MinAnodeCurrentInuA", "?")
-                            + "\u03bcA"
-                        )
-                        pxrf.instr_sourcemaxP = (
-                            instr_sourceoplimits.get("MaxOutputPowerInmW", "?") + "mW"
-                        )
-                    else:
-                        printAndLog(
-                            "IDF: NO OP LIMITS FOUND: Instrument Definition File does not report any xTube Operating Limits. This is normal for some older instruments.",
-                            "WARNING",
-                        )
-                        pxrf.instr_sourcemaxV = "N/A"
-                        pxrf.instr_sourceminV = "N/A"
-                        pxrf.instr_sourcemaxI = "N/A"
-                        pxrf.instr_sourceminI = "N/A"
-                        pxrf.instr_sourcemaxP = "N/A"
-
-                    # get illuminations
-                    instr_rawilluminationdefs: list[dict] = instr_source.get(
-                        "IlluminationDefinition", "N/A"
-                    )
-                    # only proceed with processing illuminations IF it hasn't been done already.
-                    if (
-                        instr_rawilluminationdefs != "N/A"
-                        and pxrf.instr_illuminations == []
-                    ):
-                        for entry in instr_rawilluminationdefs:
-                            # first, fix 'AnodeCurrent', which is a dict.
-                            anodecurrent_dict: dict = entry.get(
-                                "AnodeCurrent", {"#text": "0.0", "@default": "Yes"}
-                            )
-                            # an entry in this list is NOT NECESSARILY JUST ONE ILLUMINATION. IF TWO ILLUMINATIONS ARE IDENTICAL IN ALL, THEN THEY CAN BE ONE ENTRY IN THE IDF ILLUMINATIONDEFINITION WITH 2 ID FIELDS. IN THIS CASE, THEY WILL APPEAR IN THE DICT WITH A LIST OF NAMES UNDER THE 'ID' ENTRY!!!
-                            # so, first check for  list type in ID entry, if no list then make a list of len 1, then can just iterate over list either way:
-                            if isinstance(entry.get("ID"), list):
-                                # if multiple 'ID' values in this entry, use list.
-                                id_list = entry.get("ID")
-                            else:
-                                # if only 1 ID in entry, treat as a list anyway for ease of reusing code
-                                id_list = [entry.get("ID")]
-                            # then, iterate over list of id(s) and assign to Illumination dataclass.
-                            for _id in id_list:
-                                # create new Illumination dataclass object and add to list of illuminations
-                                pxrf.instr_illuminations.append(
-                                    Illumination(
-                                        name=str(_id),
-                                        voltage=int(entry.get("HighVoltage", 0)),
-                                        current=float(anodecurrent_dict.get("#text")),
-                                        current_isdefault=(
-                                            False
-                                            if (
-                                                anodecurrent_dict.get("#text").lower()
-                                                == "no"
-                                            )
-                                            else True
-                                        ),
-                                        filterposition=str(
-                                            entry.get("FilterPosition") or ""
-                                        ),  # if no filter specified, then entry.get('FilterPosition') returns None, so the or statement is used.
-                                        testsample=str(entry.get("TestSample", "")),
-                                        countrange_min=int(
-                                            entry.get("CountRangeMin", 0)
-                                        ),
-                                        countrange_max=int(
-                                            entry.get("CountRangeMax", 0)
-                                        ),
-                                        actualcounts=int(entry.get("ActualCounts", 0)),
-                                    )
-                                )
-                        # after all illuminations have been scanned, sort the list of illuminations.
-                        pxrf.instr_illuminations.sort(key=lambda x: x.name)
-                        # print("illuminations SORTED")
-                        # for illum in instr_illuminations:
-                        #     print(
-                        #         f"{illum.name}: {illum.voltage=}, {illum.current=}, {illum.current_isdefault=}, {illum.filterposition=}, {illum.testsample=}, {illum.countrange_min=}, {illum.countrange_max=}, {illum.actualcounts=}............"
-                        #     )
+def logStatusChange(data: StatusPacket):
+    printAndLog(f"Status Change: {data.parameter} {data.text}")
 
-                else:
-                    pxrf.instr_sourcemanufacturer = "N/A"
-                    pxrf.instr_sourcetargetZ = "N/A"
-                    pxrf.instr_sourcetargetSymbol = "N/A"
-                    pxrf.instr_sourcetargetName = "N/A"
-                    pxrf.instr_sourcemaxV = "N/A"
-                    pxrf.instr_sourceminV = "N/A"
-                    pxrf.instr_sourcemaxI = "N/A"
-                    pxrf.instr_sourceminI = "N/A"
-                    pxrf.instr_sourcemaxP = "N/A"
 
-                try:
-                    pxrf.instr_sourcespotsize = idf["SpotSize"]["Size"] + "mm"
-                except Exception as e:
-                    pxrf.instr_sourcespotsize = "N/A"
-                    print(
-                        f"Could not retrieve instrument spot size from IDF. ({repr(e)})"
-                    )
+# 6 - STATUS CHANGE
+def xrfHandle_StatusAssay(data: StatusPacket):
+    """Status packet, parameter 'Assay' (i.e. assay start/complete)"""
+    logStatusChange(data)
+    if data.text == "Start":
+        xrfHandle_AssayStart(data)
+    elif data.text == "Complete":
+        xrfHandle_AssayComplete(data)
 
-                pxrf.instr_sourcehaschangeablecollimator = idf.get(
-                    "HasChangeableCollimator", "N/A"
-                )
 
-                pxrf.instr_filterspresent = []
-                for filterdesc_dict in idf["Filter"]["FilterPosition"]:
-                    try:
-                        pxrf.instr_filterspresent.append(filterdesc_dict["#text"])
-                    except Exception as e:
-                        print(f"Could not get filter description from IDF. ({repr(e)})")
-                        pxrf.instr_filterspresent.append("")
+def xrfHandle_AssayStart(data: StatusPacket):
+    pxrf.instr_currentphase = 0
+    if pxrf.instr_currentapplication != "Custom Spectrum":
+        # only need to calculate assay total set time if it ISN'T a custom spectrum assay. if it is, it is set in startAssay()
+        pxrf.instr_currentphaselength_s = int(
+            pxrf.instr_currentphasedurations[pxrf.instr_currentphase]
+        )
+        pxrf.assay_time_total_set_seconds = 0
+        for dur in pxrf.instr_currentphasedurations:
+            pxrf.assay_time_total_set_seconds += int(dur)
+    else:
+        pxrf.instr_currentphaselength_s = int(customspectrum_duration_entry.get())
+        pxrf.assay_time_total_set_seconds = pxrf.instr_currentphaselength_s
+        pxrf.instr_currentphasedurations = ["0"]
+    pxrf.assay_start_time = time.time()
+    pxrf.instr_assayisrunning = True
+    pxrf.assay_phase_spectrumpacketcounter = 0
 
-                try:
-                    pxrf.instr_firmwareSUPversion = idf["SUP"]["FirmwareVersion"]
-                except Exception as e:
-                    pxrf.instr_firmwareSUPversion = "N/A"
-                    print(
-                        f"Could not retrieve instrument SuP version from IDF. ({repr(e)})"
-                    )
-                try:
-                    pxrf.instr_firmwareUUPversion = idf["UUP"]["FirmwareVersion"]
-                except Exception as e:
-                    pxrf.instr_firmwareUUPversion = "N/A"
-                    print(
-                        f"Could not retrieve instrument UuP version from IDF. ({repr(e)})"
-                    )
-                try:
-                    pxrf.instr_firmwareXILINXversion = idf["DPP"][
-                        "XilinxFirmwareVersion"
-                    ]
-                except Exception as e:
-                    pxrf.instr_firmwareXILINXversion = "N/A"
-                    print(
-                        f"Could not retrieve instrument Xilinx version from IDF. ({repr(e)})"
-                    )
-                try:
-                    pxrf.instr_firmwareOMAPkernelversion = idf["OMAP"]["KernelVersion"]
-                except Exception as e:
-                    pxrf.instr_firmwareOMAPkernelversion = "N/A"
-                    print(
-                        f"Could not retrieve instrument OMAP kernel version from IDF. ({repr(e)})"
-                    )
+    # set variables for assay
+    pxrf.instr_currentassayspectra = []
+    pxrf.instr_currentassayspecenergies = []
+    pxrf.instr_currentassaylegends = []
+    pxrf.instr_currentassayresults = default_assay_results_df
+    pxrf.instr_currentassaytimeresolved = []
+    startTimeResolvedPhase()
+    pxrf.vitals.start_assay()
 
-                # a = globals()
-                # for i in a:
-                #     printAndLog(i, ':', a[i])
+    xraysonbar.start()
 
-                # Print Important info to Console
-                printAndLog(f"Model: {pxrf.instr_model}")
-                printAndLog(f"Serial Number: {pxrf.instr_serialnumber}")
-                printAndLog(f"Build Number: {pxrf.instr_buildnumber}")
-                try:
-                    printAndLog(f"Software: S1 Version {pxrf.instr_softwareS1version}")
-                except Exception as e:
-                    # This is in case the ver isn't retrieved or reported early enough. lazy, but oh well. It stops it failing or doublereporting
-                    print(f"S1 Software version has not been checked yet. ({repr(e)})")
+    if doAutoPlotSpectra_var.get():
+        clearCurrentSpectra()
 
-                printAndLog(
-                    f"Firmware: SuP {pxrf.instr_firmwareSUPversion}, UuP {pxrf.instr_firmwareUUPversion}"
-                )
-                printAndLog(f"Detector: {pxrf.instr_detectormodel}")
-                printAndLog(
-                    f"Detector Specs: {pxrf.instr_detectortype} - {pxrf.instr_detectorwindowthickness} {pxrf.instr_detectorwindowtype} window, {pxrf.instr_detectorresolution} resolution, operating temps {pxrf.instr_detectormaxTemp} - {pxrf.instr_detectorminTemp}"
-                )
-                printAndLog(
-                    f"Source: {pxrf.instr_sourcemanufacturer} {pxrf.instr_sourcemaxP}"
-                )
-                printAndLog(f"Source Target: {pxrf.instr_sourcetargetName}")
-                printAndLog(
-                    f"Source Spot Size: {pxrf.instr_sourcespotsize} (Changeable: {pxrf.instr_sourcehaschangeablecollimator})"
-                )
-                printAndLog(
-                    f"Source Voltage Range: {pxrf.instr_sourceminV} - {pxrf.instr_sourcemaxV}"
-                )
-                printAndLog(
-                    f"Source Current Range: {pxrf.instr_sourceminI} - {pxrf.instr_sourcemaxI}"
-                )
 
-            elif ("Data" in data) and (data["Data"]["Elements"] is None):
-                printAndLog(
-                    "WARNING: Calculation Error has occurred, no results provided by instrument. If this is unexpected, try Rebooting.",
-                    "WARNING",
-                )
+def xrfHandle_AssayComplete(data: StatusPacket):
+    """Assay Complete status. usually recieved at very end of assay, when all other values (spectra, results) are in place."""
+    pxrf.assay_end_time = time.time()
+    # instr_assayisrunning = False
+    endTimeResolvedPhase()
+    pxrf.vitals.end_phase()
 
-            # Results packet?
-            elif ("Data" in data) and ("ElementData" in data["Data"]["Elements"]):
-                instr_currentassayresults_analysismode = data["Data"]["AnalysisMode"]
-                # print(instr_currentassayresults_analysismode)
-                elementdata = data["Data"]["Elements"]["ElementData"]
-                # print(type(elementdata))
-                if isinstance(elementdata, dict):
-                    elementdata = [elementdata]
-                    # in case of some calibrations that only report 1 element conc. input needs to be list!
-                # convert units if necessary (default units used by instrument is %)
-                if displayunits_var.get() == "ppm":
-                    # ppm conversion, multiply by 10000000 to convert from wt%
-                    instr_currentassayresults_chemistry = list(
-                        map(
-                            lambda x: {
-                                "Z": int(x["AtomicNumber"]["#text"]),
-                                "Compound": x["Compound"],
-                                "Concentration": np.around(
-                                    float(x["Concentration"]) * 10000, 0
-                                ),
-                                "Error(1SD)": np.around(float(x["Error"]) * 10000, 0),
-                            },
-                            elementdata,
-                        )
-                    )
+    # print(spectra)
+    try:
+        pxrf.instr_currentassayspectra.append(pxrf.current_working_spectra[-1])
+        pxrf.instr_currentassayspecenergies.append(
+            pxrf.current_working_specenergies[-1]
+        )
+        # legend = f"Phase {instr_currentphase+1}: {pxrf.current_working_spectrum_info['sngHVADC']}kV, {round(float(pxrf.current_working_spectrum_info['sngCurADC']),2)}\u03bcA"
+        legend = f"Phase {pxrf.instr_currentphase+1}({pxrf.instr_currentphaselength_s}s): {pxrf.current_working_spectrum_info['sngHVADC']}kV, {round(float(pxrf.current_working_spectrum_info['sngCurADC']),2)}\u03bcA {pxrf.current_working_spectrum_info['fltDescription']}"
+        pxrf.instr_currentassaylegends.append(legend)
+        # plotSpectrum(spectra[-1], specenergies[-1], plotphasecolours[instr_currentphase],legend)
+    except Exception as e:
+        printAndLog(
+            f"Issue with Spectra experienced after completion of Assay. {(repr(e))}",
+            "WARNING",
+        )
 
-                elif displayunits_var.get() == "ppb":
-                    # ppb conversion, multiply by 10000000 to convert from wt%
-                    instr_currentassayresults_chemistry = list(
-                        map(
-                            lambda x: {
-                                "Z": int(x["AtomicNumber"]["#text"]),
-                                "Compound": x["Compound"],
-                                "Concentration": np.around(
-                                    float(x["Concentration"]) * 10000000, 0
-                                ),
-                                "Error(1SD)": np.around(
-                                    float(x["Error"]) * 10000000, 0
-                                ),
-                            },
-                            elementdata,
-                        )
-                    )
+    # REPORT TEMPS EACH ASSAY COMPLETE
+    assay_finaltemps = (
+        f"Detector {pxrf.instr_currentdettemp}°C, Ambient {pxrf.instr_currentambtemp}°C"
+    )
+    # if detector temp or ambient temp are out of range, change colour of message.
+    temp_msg_colour = "BASIC"  # set as default
+    try:
+        if (
+            float(pxrf.instr_currentdettemp) > (-25)
+            or float(pxrf.instr_currentdettemp) < (-29)
+            or float(pxrf.instr_currentambtemp) > (65)
+        ):
+            temp_msg_colour = "ERROR"
+            printAndLog(
+                f"ERROR: Instrument Temperatures appear to be FAR outside of the normal range! {assay_finaltemps}",
+                logbox_colour_tag="ERROR",
+            )
 
-                elif displayunits_var.get() == "%":
-                    # units are in wt% by default on instr, BUT need to round to 4 decimal places for easy eyeballing ppm conv.
-                    instr_currentassayresults_chemistry = list(
-                        map(
-                            lambda x: {
-                                "Z": int(x["AtomicNumber"]["#text"]),
-                                "Compound": x["Compound"],
-                                "Concentration": np.around(
-                                    float(x["Concentration"]), 4
-                                ),
-                                "Error(1SD)": np.around(float(x["Error"]), 4),
-                            },
-                            elementdata,
-                        )
-                    )
+        elif (
+            float(pxrf.instr_currentdettemp) > (-26)
+            or float(pxrf.instr_currentdettemp) < (-28)
+            or float(pxrf.instr_currentambtemp) > (55)
+        ):
+            printAndLog(
+                f"WARNING: Instrument Temperatures appear to be outside of the normal range! {assay_finaltemps}",
+                logbox_colour_tag="WARNING",
+            )
+        else:
+            printAndLog(f"Temps: {assay_finaltemps}", "BASIC")
+    except Exception as e:  # likely no spectra packets sent
+        print(f"Temps check failed, likely due to no spectra packets sent. ({repr(e)})")
+        printAndLog(f"Temps: {assay_finaltemps}", temp_msg_colour)
+    # printAndLog(f'Amb Temp F: {instr_currentambtemp_F}°F')
+    # instrument_QueryNoseTemp()
+
+    # add full assay with all phases to table and catalogue. this 'assay complete' response is usually recieved at very end of assay, when all other values are in place.
+    if pxrf.instr_currentassayresults.equals(default_assay_results_df):
+        completeAssay(
+            pxrf.instr_currentapplication,
+            pxrf.instr_currentmethod,
+            pxrf.assay_time_total_set_seconds,
+            default_assay_results_df,
+            pxrf.instr_currentassayspectra,
+            pxrf.instr_currentassayspecenergies,
+            pxrf.instr_currentassaylegends,
+            assay_finaltemps,
+            pxrf.instr_currentassaytimeresolved,
+            pxrf.vitals.phase_summaries,
+        )
+    else:
+        completeAssay(
+            pxrf.instr_currentapplication,
+            pxrf.instr_currentmethod,
+            pxrf.assay_time_total_set_seconds,
+            pxrf.instr_currentassayresults,
+            pxrf.instr_currentassayspectra,
+            pxrf.instr_currentassayspecenergies,
+            pxrf.instr_currentassaylegends,
+            assay_finaltemps,
+            pxrf.instr_currentassaytimeresolved,
+            pxrf.vitals.phase_summaries,
+        )
+
+    # reset variables for next assay
+    pxrf.instr_currentassayspectra = []
+    pxrf.instr_currentassayspecenergies = []
+    pxrf.instr_currentassaylegends = []
+    pxrf.instr_currentassayresults = default_assay_results_df
+    pxrf.instr_assayrepeatsleft -= 1
+    if pxrf.instr_assayrepeatsleft <= 0:
+        printAndLog("All Assays complete.")
+        notifyAllAssaysComplete(pxrf.instr_assayrepeatschosenforcurrentrun)
+        assayprogressbar.set(1)
+        ui_EndOfAssaysReset()
+    elif pxrf.instr_assayrepeatsleft > 0:
+        printAndLog(
+            f"Consecutive Assays remaining: {pxrf.instr_assayrepeatsleft} more."
+        )
+        # if custom spectrum is selected, need to re-provide the parameters, as it is not an actual application on the instrument.
+        if applicationselected_stringvar.get() == "Custom Spectrum":
+            instrument_StartAssay(
+                customassay=True,
+                customassay_filter=customspectrum_filter_dropdown.get(),
+                customassay_voltage=int(customspectrum_voltage_entry.get()),
+                customassay_current=float(customspectrum_current_entry.get()),
+                customassay_duration=int(customspectrum_duration_entry.get()),
+            )
+        else:
+            instrument_StartAssay()
+    pxrf.instr_assayisrunning = False
+    xraysonbar.stop()
+    # instr_currentphase = 0
 
-                pxrf.instr_currentassayresults = pd.DataFrame.from_dict(
-                    instr_currentassayresults_chemistry
-                )
 
-                if instr_currentassayresults_analysismode == "LIBRARY SEARCH":
-                    try:
-                        gradedata = data["Data"]["Grades"]["GradeData"]
-                        if isinstance(gradedata, dict):
-                            gradedata = [gradedata]
-                        instr_currentassayresults_grades = list(
-                            map(
-                                lambda x: {
-                                    "Grade": x["Grade"]["#text"],
-                                    "Match Value": float(x["MatchValue"]),
-                                },
-                                gradedata,
-                            )
-                        )
-                        instr_currentassayresults_grades_df = pd.DataFrame.from_dict(
-                            instr_currentassayresults_grades
-                        )
-                        printAndLog(
-                            f"Assay # {str(pxrf.assay_catalogue_num).zfill(4)} Grade Matches:",
-                            logbox_colour_tag="INFO",
-                        )
-                        printAndLog(instr_currentassayresults_grades_df)
-                    except Exception:
-                        printAndLog(
-                            "Grade Result display error occurred.",
-                            logbox_colour_tag="WARNING",
-                        )
+def xrfHandle_StatusPhaseChange(data: StatusPacket):
+    logStatusChange(data)
+    pxrf.instr_assayisrunning = True
+    # print(f'spec packets this phase: {assay_phase_spectrumpacketcounter}')
+    pxrf.assay_phase_spectrumpacketcounter = 0
+    pxrf.instr_currentphaselength_s = int(
+        pxrf.instr_currentphasedurations[pxrf.instr_currentphase]
+    )
+    endTimeResolvedPhase()
+    pxrf.vitals.end_phase()
+    # try:
+    pxrf.current_working_spectra[-1]["normalised_data"] = normaliseSpectrum(
+        pxrf.current_working_spectra[-1]["data"],
+        pxrf.current_working_spectra[-1]["fTDur"],
+    )
+    pxrf.instr_currentassayspectra.append(pxrf.current_working_spectra[-1])
+    pxrf.instr_currentassayspecenergies.append(pxrf.current_working_specenergies[-1])
+    legend = f"Phase {pxrf.instr_currentphase+1}({pxrf.instr_currentphaselength_s}s): {pxrf.current_working_spectrum_info['sngHVADC']}kV, {round(float(pxrf.current_working_spectrum_info['sngCurADC']),2)}\u03bcA {pxrf.current_working_spectrum_info['fltDescription']}"
+    # legend = f"Phase {instr_currentphase+1}: {pxrf.current_working_spectrum_info['sngHVADC']}kV, {round(float(pxrf.current_working_spectrum_info['sngCurADC']),2)}\u03bcA"
+    pxrf.instr_currentassaylegends.append(legend)
 
-                # printAndLog(instr_currentassayresults)
+    # printAndLog(f'Temps: Detector {instr_currentdettemp}°C, Ambient {instr_currentambtemp}°F')
 
-            # Phase timings for current application
-            elif (
-                ("Response" in data)
-                and ("@parameter" in data["Response"])
-                and (data["Response"]["@parameter"] == "phase times")
-                and (data["Response"]["@status"] == "success")
-            ):
-                pxrf.instr_currentapplication = data["Response"]["Application"]
-                phaselist = data["Response"]["PhaseList"]["Phase"]
-                # printAndLog(f'phaselist len = {len(phaselist)}')
-                phasenums = []
-                phasenames = []
-                phasedurations = []
-                try:
-                    for phase in phaselist:
-                        phasenums.append(phase["@number"])
-                        phasenames.append(phase["Name"])
-                        phasedurations.append(phase["Duration"])
-                except Exception as e:
-                    print(f"Phase duration processing loop failed. ({repr(e)})")
-                    phasenums.append(phaselist["@number"])
-                    phasenames.append(phaselist["Name"])
-                    phasedurations.append(phaselist["Duration"])
+    if doAutoPlotSpectra_var.get():
+        plotSpectrum(
+            pxrf.current_working_spectra[-1],
+            pxrf.current_working_specenergies[-1],
+            plotphasecolours[pxrf.instr_currentphase],
+            legend,
+        )
+    # except: printAndLog('Issue with Spectra experienced after completion of Phase.')
+    pxrf.instr_currentphase += 1
+    pxrf.instr_currentphaselength_s = int(
+        pxrf.instr_currentphasedurations[pxrf.instr_currentphase]
+    )
+    startTimeResolvedPhase()
 
-                pxrf.instr_currentphases = list(
-                    zip(phasenums, phasenames, phasedurations)
-                )
-                pxrf.instr_phasecount = len(pxrf.instr_currentphases)
-                pxrf.instr_estimatedrealisticassaytime = 0
-                for dur in phasedurations:
-                    # add ~4 seconds per phase for general slowness and processing time on S1 titan, Tracer, CTX.
-                    pxrf.instr_estimatedrealisticassaytime += int(dur) + 4
 
-                # printAndLog(f'Current Phases: {instr_currentphases}')
-                ui_UpdateCurrentAppAndPhases()
+def xrfHandle_StatusArmed(data: StatusPacket):
+    logStatusChange(data)
+    if data.text == "No":
+        pxrf.instr_isarmed = False
+    elif data.text == "Yes":
+        pxrf.instr_isarmed = True
+        pxrf.instr_isloggedin = True
 
-            # Response detailing the current 'Edit Fields' aka edit info fields aka notes.
-            elif (
-                ("Response" in data)
-                and ("@parameter" in data["Response"])
-                and "edit fields" in data["Response"]["@parameter"]
-            ):
-                try:
-                    instr_editfielddata = data["Response"]["EditFieldList"]
-                except KeyError:
-                    instr_editfielddata = None
-                printAndLog("Info-Fields Data Retrieved.")
-                if instr_editfielddata is None:
-                    printAndLog(
-                        "NOTE: The Bruker OEM Protocol does not allow info-fields with blank values to be communicated over the protocol. If you cannot retrieve your info-fields properly, try filling the fields with some text on the instrument, then try retrieving it again.",
-                        "INFO",
-                    )
-                else:
-                    if isinstance(instr_editfielddata["EditField"], list):
-                        instr_editfielddata = instr_editfielddata["EditField"]
-                    elif isinstance(instr_editfielddata["EditField"], dict):
-                        instr_editfielddata = [instr_editfielddata["EditField"]]
-                    fillEditInfoFields(instr_editfielddata)
-
-            # INFO/WARNING - e.g. Sent when active app is changed or user adjusts settings in spectrometer mode setup screen. It displays the hardware configuration required by the active instrument setup.
-            elif "InfoReport" in data:
-                # printAndLog(data)
-                TxMsgID = data["InfoReport"]["@TxMsgID"]
-                isuseracknowldegable = data["InfoReport"][
-                    "@UserAckable"
-                ]  # 'Yes' or 'No'
-                infomsg = data["InfoReport"]["#text"]
-                # e.g. "Nose Door Open. Close it to Continue."
-                printAndLog(
-                    f"Instrument INFO/WARNING: {infomsg}",
-                    logbox_colour_tag="WARNING",
-                    notify_slack=True,
+
+def xrfHandle_StatusOther(data):
+    """fallback for Status packets with no registered handler. data is a StatusPacket for basic status changes, otherwise the parsed xml dict."""
+    if isinstance(data, StatusPacket):  #   basic status change
+        logStatusChange(data)
+    elif (
+        "Application Selection" in data["Status"]
+    ):  # new application selected DOESN"T WORK? only plays if selected on instr screen?
+        printAndLog("New Application Selected.")
+        # override rechecking these values IF custom selected.
+        if applicationselected_stringvar.get() != "Custom Spectrum":
+            # sendCommand(xrf, bruker_query_currentapplicationinclmethods)
+            pxrf.query_current_application_incl_methods()
+        # gui.after(200,ui_UpdateCurrentAppAndPhases)
+        # need to find way of queuing app checker
+
+
+# 1 - COOKED SPECTRUM
+def xrfHandle_CookedSpectrum(data):
+    pxrf.current_working_spectrum_info, pxrf.current_working_spectra = setSpectrum(data)
+    pxrf.assay_phase_spectrumpacketcounter += 1
+    if pxrf.current_timeresolved_buffer is not None:
+        pxrf.current_timeresolved_buffer.append(pxrf.current_working_spectrum_info)
+    # printAndLog(f"New cooked Spectrum")
+
+    # vitals are always tracked (for the phase summaries), and displayed by publishVitals if option box is checked for 'Display Count Rate and Dead Time %'
+    pxrf.vitals.update(pxrf.current_working_spectrum_info)
+
+
+# 4 - PDZ FILENAME // Deprecated, no longer works :(
+def xrfHandle_PDZFilename(data):
+    printAndLog(f"New PDZ: {data}")
+
+
+# 3 - RAW SPECTRUM
+def xrfHandle_RawSpectrum(data):
+    # data = hashlib.md5(data).hexdigest()
+    printAndLog("Raw spectrum!")
+    pxrf.current_working_spectrum_info, pxrf.current_working_spectra = setSpectrum(data)
+
+
+# 2 - RESULTS SET (don't really know when this is used?)    // Deprecated?
+def xrfHandle_ResultsSet(data):
+    # printAndLog(etree'.tostring(data, pretty_print=True))
+    printAndLog(data)
+
+
+# 7 - SPECTRUM ENERGY PACKET, contains the SpecEnergy structure, cal info (The instrument will transmit a SPECTRUM_ENERGY packet inmmediately before transmitting it’s associated COOKED_SPECTRUM packet. The SpecEnergy iPacketCount member contains an integer that associates the SpecEnergy values with the corresponding COOKED_SPECTRUM packet via the iPacket_Cnt member of the s1_cooked_header structure.)
+def xrfHandle_SpectrumEnergy(data):
+    pxrf.current_working_specenergies = setSpecEnergy(data)
+
+
+# 5 - XML PACKET
+def xrfHandle_InstrumentDefinition(data: dict):
+    if data["Response"]["@status"] != "success":
+        xrfHandle_UncategorisedXML(data)
+        return
+    # All IDF data:
+    idf: dict = data["Response"]["InstrumentDefinition"]
+    # from pprint import pprint
+    # pprint(idf)
+
+    # Broken Down:
+    pxrf.instr_model = idf.get("Model", "N/A")
+    pxrf.instr_serialnumber = idf.get("SerialNumber", "N/A")
+    pxrf.instr_buildnumber = idf.get("BuildNumber", "N/A")
+    pxrf.instr_detectortype = pxrf.instr_buildnumber[0:3]
+
+    instr_detector = idf.get("Detector", "N/A")
+
+    if instr_detector != "N/A":
+        pxrf.instr_detectormodel = instr_detector.get("DetectorModel", "N/A")
+        if pxrf.instr_detectortype[1] in "PMK":
+            # Older detectors with Beryllium windows. eg SPX, SMA, SK6, etc
+            pxrf.instr_detectorwindowtype = "Beryllium"
+            pxrf.instr_detectorwindowthickness = (
+                instr_detector.get("BerylliumWindowThicknessInuM", "?") + "\u03bcM"
+            )
+        elif pxrf.instr_detectortype[1] in "G":
+            pxrf.instr_detectorwindowtype = "Graphene"
+            pxrf.instr_detectorwindowthickness = (
+                instr_detector.get("GrapheneWindowThicknessInuM", "?") + "\u03bcM"
+            )
+            # In case instrument def is wrong (eg. Martin has graphene det, but only beryllium thickness listed)
+        pxrf.instr_detectorresolution = (
+            instr_detector.get("TypicalResolutionIneV", "?") + "eV"
+        )
+        pxrf.instr_detectormaxTemp = (
+            instr_detector.get("OperatingTempMaxInC", "?") + "°C"
+        )
+        pxrf.instr_detectorminTemp = (
+            instr_detector.get("OperatingTempMinInC", "?") + "°C"
+        )
+    else:
+        pxrf.instr_detectormodel = "N/A"
+        pxrf.instr_detectorwindowtype = "N/A"
+        pxrf.instr_detectorwindowthickness = "N/A"
+        pxrf.instr_detectorresolution = "N/A"
+        pxrf.instr_detectormaxTemp = "N/A"
+        pxrf.instr_detectorminTemp = "N/A"
+
+    instr_source: dict = idf.get("XrayTube", "N/A")
+    # from pprint import pprint
+    # pprint(instr_source)
+    if instr_source != "N/A":
+        instr_sourceoplimits: dict = instr_source.get("OperatingLimits", "N/A")
+        pxrf.instr_sourcemanufacturer = instr_source.get("Manufacturer", "N/A")
+        pxrf.instr_sourcetargetZ = instr_source.get("TargetElementNumber", 0)
+        pxrf.instr_sourcetargetSymbol = elementZtoSymbol(int(pxrf.instr_sourcetargetZ))
+        pxrf.instr_sourcetargetName = elementZtoName(int(pxrf.instr_sourcetargetZ))
+        if instr_sourceoplimits != "N/A":
+            pxrf.instr_sourcemaxV = (
+                instr_sourceoplimits.get("MaxHighVoltage", "?") + "kV"
+            )
+            pxrf.instr_sourceminV = (
+                instr_sourceoplimits.get("MinHighVoltage", "?") + "kV"
+            )
+            pxrf.instr_sourcemaxI = (
+                instr_sourceoplimits.get("MaxAnodeCurrentInuA", "?") + "\u03bcA"
+            )
+            pxrf.instr_sourceminI = (
+                instr_sourceoplimits.get("MinAnodeCurrentInuA", "?") + "\u03bcA"
+            )
+            pxrf.instr_sourcemaxP = (
+                instr_sourceoplimits.get("MaxOutputPowerInmW", "?") + "mW"
+            )
+        else:
+            printAndLog(
+                "IDF: NO OP LIMITS FOUND: Instrument Definition File does not report any xTube Operating Limits. This is normal for some older instruments.",
+                "WARNING",
+            )
+            pxrf.instr_sourcemaxV = "N/A"
+            pxrf.instr_sourceminV = "N/A"
+            pxrf.instr_sourcemaxI = "N/A"
+            pxrf.instr_sourceminI = "N/A"
+            pxrf.instr_sourcemaxP = "N/A"
+
+        # get illuminations
+        instr_rawilluminationdefs: list[dict] = instr_source.get(
+            "IlluminationDefinition", "N/A"
+        )
+        # only proceed with processing illuminations IF it hasn't been done already.
+        if instr_rawilluminationdefs != "N/A" and pxrf.instr_illuminations == []:
+            for entry in instr_rawilluminationdefs:
+                # first, fix 'AnodeCurrent', which is a dict.
+                anodecurrent_dict: dict = entry.get(
+                    "AnodeCurrent", {"#text": "0.0", "@default": "Yes"}
                 )
-                if isuseracknowldegable == "Yes":
-                    pxrf.acknowledge_error(TxMsgID)
-                    printAndLog(
-                        "Info/Warning Acknowledgment Sent. Attempting to resume..."
-                    )
+                # an entry in this list is NOT NECESSARILY JUST ONE ILLUMINATION. IF TWO ILLUMINATIONS ARE IDENTICAL IN ALL, THEN THEY CAN BE ONE ENTRY IN THE IDF ILLUMINATIONDEFINITION WITH 2 ID FIELDS. IN THIS CASE, THEY WILL APPEAR IN THE DICT WITH A LIST OF NAMES UNDER THE 'ID' ENTRY!!!
+                # so, first check for  list type in ID entry, if no list then make a list of len 1, then can just iterate over list either way:
+                if isinstance(entry.get("ID"), list):
+                    # if multiple 'ID' values in this entry, use list.
+                    id_list = entry.get("ID")
                 else:
-                    printAndLog(
-                        "WARNING: Info/Warning Message Cannot be Acknowledged Remotely. Please evaluate info/warning on instrument.",
-                        logbox_colour_tag="WARNING",
-                    )
-                if "Backscatter Limit Failure::Count Rate too Low" in infomsg:
-                    # cancel repeat assays? 20240227 nat has expressed preference for this to NOT happen, so will be commented until it can be turned into a toggle!
-                    # instr_assayrepeatsleft = 0
-                    if gerdaCNC is not None:
-                        printAndLog(
-                            "'Count Rate Too Low' error occurred. Remaining GeRDA sample assays will be cancelled.",
-                            logbox_colour_tag="ERROR",
-                        )
-                        gerdaCNC.stop_sample_sequence_immediately(
-                            reason="Count Rate Error"
+                    # if only 1 ID in entry, treat as a list anyway for ease of reusing code
+                    id_list = [entry.get("ID")]
+                # then, iterate over list of id(s) and assign to Illumination dataclass.
+                for _id in id_list:
+                    # create new Illumination dataclass object and add to list of illuminations
+                    pxrf.instr_illuminations.append(
+                        Illumination(
+                            name=str(_id),
+                            voltage=int(entry.get("HighVoltage", 0)),
+                            current=float(anodecurrent_dict.get("#text")),
+                            current_isdefault=(
+                                False
+                                if (anodecurrent_dict.get("#text").lower() == "no")
+                                else True
+                            ),
+                            filterposition=str(
+                                entry.get("FilterPosition") or ""
+                            ),  # if no filter specified, then entry.get('FilterPosition') returns None, so the or statement is used.
+                            testsample=str(entry.get("TestSample", "")),
+                            countrange_min=int(entry.get("CountRangeMin", 0)),
+                            countrange_max=int(entry.get("CountRangeMax", 0)),
+                            actualcounts=int(entry.get("ActualCounts", 0)),
                         )
-                    # else:
-                    #     printAndLog(
-                    #         "'Count Rate Too Low' error occurred. Remaining repeat assays will NOT be cancelled.",
-                    #         logbox_colour_tag="ERROR",
-                    #     )
-                    #     # i.e. GeRDA is not being used
-
-            # ERROR HAS OCCURRED
-            elif "ErrorReport" in data:
-                # Must respond to these. If an acknowledgement message is not received within 5 seconds ofthe initial transmission the message will be retransmitted. This process continues until an acknowledge is received or the message is transmitted 5 times.
-                TxMsgID = data["ErrorReport"]["@TxMsgID"]
-                isuseracknowldegable = data["ErrorReport"][
-                    "@UserAckable"
-                ]  # 'Yes' or 'No'
-                ErrorMsg = data["ErrorReport"]["#text"]
-                # e.g. "System temperature out of range."
-                printAndLog(
-                    f"Instrument ERROR: {ErrorMsg}",
-                    logbox_colour_tag="ERROR",
-                    notify_slack=True,
-                )
-                if isuseracknowldegable == "Yes":
-                    pxrf.acknowledge_error(TxMsgID)
-                    printAndLog("Error Acknowledgment Sent. Attempting to resume...")
-                else:
-                    printAndLog(
-                        "ERROR: Error Message Cannot be Acknowledged Remotely. Please evaluate error on instrument."
                     )
+            # after all illuminations have been scanned, sort the list of illuminations.
+            pxrf.instr_illuminations.sort(key=lambda x: x.name)
+            # print("illuminations SORTED")
+            # for illum in instr_illuminations:
+            #     print(
+            #         f"{illum.name}: {illum.voltage=}, {illum.current=}, {illum.current_isdefault=}, {illum.filterposition=}, {illum.testsample=}, {illum.countrange_min=}, {illum.countrange_max=}, {illum.actualcounts=}............"
+            #     )
 
-            else:
-                printAndLog(f"WARNING: Uncategorised XML Packet Recieved: {data}")
+    else:
+        pxrf.instr_sourcemanufacturer = "N/A"
+        pxrf.instr_sourcetargetZ = "N/A"
+        pxrf.instr_sourcetargetSymbol = "N/A"
+        pxrf.instr_sourcetargetName = "N/A"
+        pxrf.instr_sourcemaxV = "N/A"
+        pxrf.instr_sourceminV = "N/A"
+        pxrf.instr_sourcemaxI = "N/A"
+        pxrf.instr_sourceminI = "N/A"
+        pxrf.instr_sourcemaxP = "N/A"
 
-        # 5a - RESPONSE XML PACKET, 'logged in' response etc, usually.
-        elif datatype == XML_SUCCESS_RESPONSE:
-            if ("@parameter" in data["Response"]) and (
-                "login state" in data["Response"]["@parameter"]
-            ):
-                if data["Response"]["#text"] == "Yes":
-                    pxrf.instr_isloggedin = True
-                elif data["Response"]["#text"] == "No":
-                    pxrf.instr_isloggedin = False
-                    pxrf.instr_isarmed = False
-
-            elif ("@parameter" in data["Response"]) and (
-                "armed state" in data["Response"]["@parameter"]
-            ):
-                if data["Response"]["#text"] == "Yes":
-                    # print(data)
-                    pxrf.instr_isarmed = True
-                elif data["Response"]["#text"] == "No":
-                    pxrf.instr_isarmed = False
-
-            elif ("@parameter" in data["Response"]) and (
-                "nose temperature" in data["Response"]["@parameter"]
-            ):
-                pxrf.instr_currentnosetemp = data["Response"]["#text"]
-                printAndLog(f"Nose Temperature: {pxrf.instr_currentnosetemp}°C")
+    try:
+        pxrf.instr_sourcespotsize = idf["SpotSize"]["Size"] + "mm"
+    except Exception as e:
+        pxrf.instr_sourcespotsize = "N/A"
+        print(f"Could not retrieve instrument spot size from IDF. ({repr(e)})")
 
-            elif ("@parameter" in data["Response"]) and (
-                "nose pressure" in data["Response"]["@parameter"]
-            ):
-                pxrf.instr_currentnosepressure = data["Response"]["#text"]
-                printAndLog(f"Nose Pressure: {pxrf.instr_currentnosepressure}mBar")
+    pxrf.instr_sourcehaschangeablecollimator = idf.get("HasChangeableCollimator", "N/A")
 
-            # Response confirming app change
-            elif ("#text" in data["Response"]) and (
-                "Application successfully set to" in data["Response"]["#text"]
-            ):
-                try:
-                    s = data["Response"]["#text"].split("::")[-1]
-                    # gets app name from #text string like 'Configure:Application successfully set to::Geo'
-                    printAndLog(f"Application Changed to '{s}'")
-                except Exception as e:
-                    print(
-                        f"Application set response message parsing failed. ({repr(e)})"
-                    )
-                # sendCommand(xrf, bruker_query_currentapplicationinclmethods)
-                pxrf.query_current_application_incl_methods()
-                pxrf.query_current_application_phase_times()
-                # ui_UpdateCurrentAppAndPhases()
+    pxrf.instr_filterspresent = []
+    for filterdesc_dict in idf["Filter"]["FilterPosition"]:
+        try:
+            pxrf.instr_filterspresent.append(filterdesc_dict["#text"])
+        except Exception as e:
+            print(f"Could not get filter description from IDF. ({repr(e)})")
+            pxrf.instr_filterspresent.append("")
 
-            # phase times set response
-            elif (
-                ("@parameter" in data["Response"])
-                and ("phase times" in data["Response"]["@parameter"])
-                and ("#text" in data["Response"])
-            ):
-                printAndLog(f"{data['Response']['#text']}")
-                pxrf.query_current_application_phase_times()
+    try:
+        pxrf.instr_firmwareSUPversion = idf["SUP"]["FirmwareVersion"]
+    except Exception as e:
+        pxrf.instr_firmwareSUPversion = "N/A"
+        print(f"Could not retrieve instrument SuP version from IDF. ({repr(e)})")
+    try:
+        pxrf.instr_firmwareUUPversion = idf["UUP"]["FirmwareVersion"]
+    except Exception as e:
+        pxrf.instr_firmwareUUPversion = "N/A"
+        print(f"Could not retrieve instrument UuP version from IDF. ({repr(e)})")
+    try:
+        pxrf.instr_firmwareXILINXversion = idf["DPP"]["XilinxFirmwareVersion"]
+    except Exception as e:
+        pxrf.instr_firmwareXILINXversion = "N/A"
+        print(f"Could not retrieve instrument Xilinx version from IDF. ({repr(e)})")
+    try:
+        pxrf.instr_firmwareOMAPkernelversion = idf["OMAP"]["KernelVersion"]
+    except Exception as e:
+        pxrf.instr_firmwareOMAPkernelversion = "N/A"
+        print(
+            f"Could not retrieve instrument OMAP kernel version from IDF. ({repr(e)})"
+        )
 
-            # s1 version response
-            elif ("@parameter" in data["Response"]) and (
-                data["Response"]["@parameter"] == "version"
-            ):
-                try:
-                    pxrf.instr_softwareS1version = data["Response"]["#text"]
-                except Exception as e:
-                    print(f"s1 version message parsing failed ({repr(e)})")
-                    pxrf.instr_softwareS1version = "UNKNOWN"
-                if pxrf.s1vermanuallyrequested:
-                    printAndLog(f"Software: S1 Version {pxrf.instr_softwareS1version}")
-
-            # Secondary Response for Assay Start and Stop for some instruments??? Idk why, should NOT RELY ON
-            elif ("#text" in data["Response"]) and (
-                "Assay St" in data["Response"]["#text"]
-            ):
-                if data["Response"]["#text"] == "Assay Start":
-                    printAndLog("Response: Assay Start")
-                    pxrf.instr_assayisrunning = True
-                elif data["Response"]["#text"] == "Assay Stop":
-                    printAndLog("Response: Assay Stop")
-                    # instr_assayisrunning = False
-
-            # Response Success log in OR already logged in
-            elif (
-                ("#text" in data["Response"])
-                and ("@status" in data["Response"])
-                and ("ogged in as" in data["Response"]["#text"])
-                and ("success" in data["Response"]["@status"])
-            ):
-                pxrf.instr_isloggedin = True
-                printAndLog(
-                    f"{data['Response']['@status']}: {data['Response']['#text']}"
-                )
+    # a = globals()
+    # for i in a:
+    #     printAndLog(i, ':', a[i])
 
-            # Transmit results configuration change response ({'Response': {'@parameter': 'transmit spectra', '@status': 'success', '#text': 'Transmit Spectra configuration updated'}})
-            elif (
-                ("@parameter" in data["Response"])
-                and ("@status" in data["Response"])
-                and ("#text" in data["Response"])
-                and ("transmit" in data["Response"]["@parameter"])
-            ):
-                printAndLog(
-                    f"{data['Response']['@status']}: {data['Response']['#text']}"
-                )
+    # Print Important info to Console
+    printAndLog(f"Model: {pxrf.instr_model}")
+    printAndLog(f"Serial Number: {pxrf.instr_serialnumber}")
+    printAndLog(f"Build Number: {pxrf.instr_buildnumber}")
+    try:
+        printAndLog(f"Software: S1 Version {pxrf.instr_softwareS1version}")
+    except Exception as e:
+        # This is in case the ver isn't retrieved or reported early enough. lazy, but oh well. It stops it failing or doublereporting
+        print(f"S1 Software version has not been checked yet. ({repr(e)})")
 
-            # Respose to if query if result files are stored on instrument (csv, tsv, etc)
-            elif (
-                ("@parameter" in data["Response"])
-                and ("@status" in data["Response"])
-                and ("#text" in data["Response"])
-                and ("store results" in data["Response"]["@parameter"])
-            ):
-                if data["Response"]["#text"] in ["Yes", "yes"]:
-                    storeresultsoninstrument_var.set(True)
-                elif data["Response"]["#text"] in ["No", "no"]:
-                    storeresultsoninstrument_var.set(False)
-                else:
-                    printAndLog(
-                        f"{data['Response']['@status']}: {data['Response']['#text']}"
-                    )
+    printAndLog(
+        f"Firmware: SuP {pxrf.instr_firmwareSUPversion}, UuP {pxrf.instr_firmwareUUPversion}"
+    )
+    printAndLog(f"Detector: {pxrf.instr_detectormodel}")
+    printAndLog(
+        f"Detector Specs: {pxrf.instr_detectortype} - {pxrf.instr_detectorwindowthickness} {pxrf.instr_detectorwindowtype} window, {pxrf.instr_detectorresolution} resolution, operating temps {pxrf.instr_detectormaxTemp} - {pxrf.instr_detectorminTemp}"
+    )
+    printAndLog(f"Source: {pxrf.instr_sourcemanufacturer} {pxrf.instr_sourcemaxP}")
+    printAndLog(f"Source Target: {pxrf.instr_sourcetargetName}")
+    printAndLog(
+        f"Source Spot Size: {pxrf.instr_sourcespotsize} (Changeable: {pxrf.instr_sourcehaschangeablecollimator})"
+    )
+    printAndLog(
+        f"Source Voltage Range: {pxrf.instr_sourceminV} - {pxrf.instr_sourcemaxV}"
+    )
+    printAndLog(
+        f"Source Current Range: {pxrf.instr_sourceminI} - {pxrf.instr_sourcemaxI}"
+    )
 
-            # Respose to if query if spectra files are stored on instrument (pdz)
-            elif (
-                ("@parameter" in data["Response"])
-                and ("@status" in data["Response"])
-                and ("#text" in data["Response"])
-                and ("store spectra" in data["Response"]["@parameter"])
-            ):
-                if data["Response"]["#text"] in ["Yes", "yes"]:
-                    storespectraoninstrument_var.set(True)
-                elif data["Response"]["#text"] in ["No", "no"]:
-                    storespectraoninstrument_var.set(False)
-                else:
-                    printAndLog(
-                        f"{data['Response']['@status']}: {data['Response']['#text']}"
-                    )
 
-            # Response to proximity sensor query
-            elif (
-                ("@parameter" in data["Response"])
-                and ("@status" in data["Response"])
-                and ("#text" in data["Response"])
-                and ("proximity required" in data["Response"]["@parameter"])
-            ):
-                if data["Response"]["#text"] in ["Yes", "yes"]:
-                    proximitysensor_var.set(True)
-                elif data["Response"]["#text"] in ["No", "no"]:
-                    proximitysensor_var.set(False)
-                else:
-                    printAndLog(
-                        f"{data['Response']['@status']}: {data['Response']['#text']}"
-                    )
+def xrfHandle_Results(data: ResultsPacket):
+    """Results packet (<Data>)"""
+    if not data.elements_present:
+        printAndLog(
+            "WARNING: Calculation Error has occurred, no results provided by instrument. If this is unexpected, try Rebooting.",
+            "WARNING",
+        )
+        return
+    # convert units if necessary (default units used by instrument is %)
+    if displayunits_var.get() == "ppm":
+        # ppm conversion, multiply by 10000 to convert from wt%
+        _unit_multiplier, _decimals = 10000, 0
+    elif displayunits_var.get() == "ppb":
+        # ppb conversion, multiply by 10000000 to convert from wt%
+        _unit_multiplier, _decimals = 10000000, 0
+    else:
+        # units are in wt% by default on instr, BUT need to round to 4 decimal places for easy eyeballing ppm conv.
+        _unit_multiplier, _decimals = 1, 4
 
-            # Catchall for OTHER unimportant responses confirming configure changes (like time and date set, etc)
-            elif ("#text" in data["Response"]) and (
-                "Configure:" in data["Response"]["#text"]
-            ):
-                printAndLog(
-                    f"{data['Response']['@status']}: {data['Response']['@parameter']}: {data['Response']['#text']}"
-                )
+    pxrf.instr_currentassayresults = pd.DataFrame(
+        {
+            "Z": data.z,
+            "Compound": data.compounds,
+            "Concentration": np.around(
+                data.concentrations * _unit_multiplier, _decimals
+            ),
+            "Error(1SD)": np.around(data.errors * _unit_multiplier, _decimals),
+        }
+    )
+
+    if data.analysis_mode == "LIBRARY SEARCH":
+        try:
+            instr_currentassayresults_grades_df = pd.DataFrame(
+                data.grades, columns=["Grade", "Match Value"]
+            )
+            printAndLog(
+                f"Assay # {str(pxrf.assay_catalogue_num).zfill(4)} Grade Matches:",
+                logbox_colour_tag="INFO",
+            )
+            printAndLog(instr_currentassayresults_grades_df)
+        except Exception:
+            printAndLog(
+                "Grade Result display error occurred.",
+                logbox_colour_tag="WARNING",
+            )
+
+
+def xrfHandle_PhaseTimes(data: dict):
+    """Phase timings for current application"""
+    if data["Response"]["@status"] != "success":
+        xrfHandle_UncategorisedXML(data)
+        return
+    pxrf.instr_currentapplication = data["Response"]["Application"]
+    phaselist = data["Response"]["PhaseList"]["Phase"]
+    # printAndLog(f'phaselist len = {len(phaselist)}')
+    phasenums = []
+    phasenames = []
+    phasedurations = []
+    try:
+        for phase in phaselist:
+            phasenums.append(phase["@number"])
+            phasenames.append(phase["Name"])
+            phasedurations.append(phase["Duration"])
+    except Exception as e:
+        print(f"Phase duration processing loop failed. ({repr(e)})")
+        phasenums.append(phaselist["@number"])
+        phasenames.append(phaselist["Name"])
+        phasedurations.append(phaselist["Duration"])
+
+    pxrf.instr_currentphases = list(zip(phasenums, phasenames, phasedurations))
+    pxrf.instr_phasecount = len(pxrf.instr_currentphases)
+    pxrf.instr_estimatedrealisticassaytime = 0
+    for dur in phasedurations:
+        # add ~4 seconds per phase for general slowness and processing time on S1 titan, Tracer, CTX.
+        pxrf.instr_estimatedrealisticassaytime += int(dur) + 4
+
+    pxrf.instr_currentphasedurations = phasedurations
+
+    # printAndLog(f'Current Phases: {instr_currentphases}')
+    ui_UpdateCurrentAppAndPhases()
+
+
+def xrfHandle_EditFields(data: dict):
+    """Response detailing the current 'Edit Fields' aka edit info fields aka notes."""
+    try:
+        instr_editfielddata = data["Response"]["EditFieldList"]
+    except KeyError:
+        instr_editfielddata = None
+    printAndLog("Info-Fields Data Retrieved.")
+    if instr_editfielddata is None:
+        printAndLog(
+            "NOTE: The Bruker OEM Protocol does not allow info-fields with blank values to be communicated over the protocol. If you cannot retrieve your info-fields properly, try filling the fields with some text on the instrument, then try retrieving it again.",
+            "INFO",
+        )
+    else:
+        if isinstance(instr_editfielddata["EditField"], list):
+            instr_editfielddata = instr_editfielddata["EditField"]
+        elif isinstance(instr_editfielddata["EditField"], dict):
+            instr_editfielddata = [instr_editfielddata["EditField"]]
+        fillEditInfoFields(instr_editfielddata)
+
+
+def xrfHandle_InfoReport(data: dict):
+    """INFO/WARNING - e.g. Sent when active app is changed or user adjusts settings in spectrometer mode setup screen. It displays the hardware configuration required by the active instrument setup."""
+    # printAndLog(data)
+    TxMsgID = data["InfoReport"]["@TxMsgID"]
+    isuseracknowldegable = data["InfoReport"]["@UserAckable"]  # 'Yes' or 'No'
+    infomsg = data["InfoReport"]["#text"]
+    # e.g. "Nose Door Open. Close it to Continue."
+    printAndLog(
+        f"Instrument INFO/WARNING: {infomsg}",
+        logbox_colour_tag="WARNING",
+        notify_slack=True,
+    )
+    if isuseracknowldegable == "Yes":
+        pxrf.acknowledge_error(TxMsgID)
+        printAndLog("Info/Warning Acknowledgment Sent. Attempting to resume...")
+    else:
+        printAndLog(
+            "WARNING: Info/Warning Message Cannot be Acknowledged Remotely. Please evaluate info/warning on instrument.",
+            logbox_colour_tag="WARNING",
+        )
+    if "Backscatter Limit Failure::Count Rate too Low" in infomsg:
+        # cancel repeat assays? 20240227 nat has expressed preference for this to NOT happen, so will be commented until it can be turned into a toggle!
+        # instr_assayrepeatsleft = 0
+        if gerdaCNC is not None:
+            printAndLog(
+                "'Count Rate Too Low' error occurred. Remaining GeRDA sample assays will be cancelled.",
+                logbox_colour_tag="ERROR",
+            )
+            gerdaCNC.stop_sample_sequence_immediately(reason="Count Rate Error")
+        # else:
+        #     printAndLog(
+        #         "'Count Rate Too Low' error occurred. Remaining repeat assays will NOT be cancelled.",
+        #         logbox_colour_tag="ERROR",
+        #     )
+        #     # i.e. GeRDA is not being used
+
+
+def xrfHandle_ErrorReport(data: dict):
+    """ERROR HAS OCCURRED"""
+    # Must respond to these. If an acknowledgement message is not received within 5 seconds ofthe initial transmission the message will be retransmitted. This process continues until an acknowledge is received or the message is transmitted 5 times.
+    TxMsgID = data["ErrorReport"]["@TxMsgID"]
+    isuseracknowldegable = data["ErrorReport"]["@UserAckable"]  # 'Yes' or 'No'
+    ErrorMsg = data["ErrorReport"]["#text"]
+    # e.g. "System temperature out of range."
+    printAndLog(
+        f"Instrument ERROR: {ErrorMsg}",
+        logbox_colour_tag="ERROR",
+        notify_slack=True,
+    )
+    if isuseracknowldegable == "Yes":
+        pxrf.acknowledge_error(TxMsgID)
+        printAndLog("Error Acknowledgment Sent. Attempting to resume...")
+    else:
+        printAndLog(
+            "ERROR: Error Message Cannot be Acknowledged Remotely. Please evaluate error on instrument."
+        )
+
+
+def xrfHandle_UncategorisedXML(data: dict):
+    printAndLog(f"WARNING: Uncategorised XML Packet Recieved: {data}")
+
+
+# 5a - RESPONSE XML PACKET, 'logged in' response etc, usually.
+def xrfHandle_LoginStateResponse(data: dict):
+    if data["Response"]["#text"] == "Yes":
+        pxrf.instr_isloggedin = True
+    elif data["Response"]["#text"] == "No":
+        pxrf.instr_isloggedin = False
+        pxrf.instr_isarmed = False
+
+
+def xrfHandle_ArmedStateResponse(data: dict):
+    if data["Response"]["#text"] == "Yes":
+        # print(data)
+        pxrf.instr_isarmed = True
+    elif data["Response"]["#text"] == "No":
+        pxrf.instr_isarmed = False
+
+
+def xrfHandle_NoseTemperatureResponse(data: dict):
+    pxrf.instr_currentnosetemp = data["Response"]["#text"]
+    printAndLog(f"Nose Temperature: {pxrf.instr_currentnosetemp}°C")
+
+
+def xrfHandle_NosePressureResponse(data: dict):
+    pxrf.instr_currentnosepressure = data["Response"]["#text"]
+    printAndLog(f"Nose Pressure: {pxrf.instr_currentnosepressure}mBar")
+
+
+def xrfHandle_PhaseTimesSetResponse(data: dict):
+    """phase times set response"""
+    if "Application successfully set to" in data["Response"]["#text"]:
+        xrfHandle_OtherResponse(data)
+        return
+    printAndLog(f"{data['Response']['#text']}")
+    pxrf.query_current_application_phase_times()
+
+
+def xrfHandle_VersionResponse(data: dict):
+    """s1 version response"""
+    try:
+        pxrf.instr_softwareS1version = data["Response"]["#text"]
+    except Exception as e:
+        print(f"s1 version message parsing failed ({repr(e)})")
+        pxrf.instr_softwareS1version = "UNKNOWN"
+    if pxrf.s1vermanuallyrequested:
+        printAndLog(f"Software: S1 Version {pxrf.instr_softwareS1version}")
+
+
+def setBooleanVarFromResponse(data: dict, var: ctk.BooleanVar):
+    """for yes/no responses to queries of instrument settings (e.g. store results, store spectra, proximity required)"""
+    if data["Response"]["#text"] in ["Yes", "yes"]:
+        var.set(True)
+    elif data["Response"]["#text"] in ["No", "no"]:
+        var.set(False)
+    else:
+        printAndLog(f"{data['Response']['@status']}: {data['Response']['#text']}")
 
+
+def xrfHandle_StoreResultsResponse(data: dict):
+    """Respose to if query if result files are stored on instrument (csv, tsv, etc)"""
+    setBooleanVarFromResponse(data, storeresultsoninstrument_var)
+
+
+def xrfHandle_StoreSpectraResponse(data: dict):
+    """Respose to if query if spectra files are stored on instrument (pdz)"""
+    setBooleanVarFromResponse(data, storespectraoninstrument_var)
+
+
+def xrfHandle_ProximityRequiredResponse(data: dict):
+    """Response to proximity sensor query"""
+    setBooleanVarFromResponse(data, proximitysensor_var)
+
+
+def xrfHandle_OtherResponse(data: dict):
+    """fallback for 'success' responses with no registered handler. these are matched on their text rather than parameter."""
+    # Response confirming app change
+    if "Application successfully set to" in data["Response"]["#text"]:
+        try:
+            s = data["Response"]["#text"].split("::")[-1]
+            # gets app name from #text string like 'Configure:Application successfully set to::Geo'
+            printAndLog(f"Application Changed to '{s}'")
+        except Exception as e:
+            print(f"Application set response message parsing failed. ({repr(e)})")
+        # sendCommand(xrf, bruker_query_currentapplicationinclmethods)
+        pxrf.query_current_application_incl_methods()
+        pxrf.query_current_application_phase_times()
+        # ui_UpdateCurrentAppAndPhases()
+
+    # Secondary Response for Assay Start and Stop for some instruments??? Idk why, should NOT RELY ON
+    elif "Assay St" in data["Response"]["#text"]:
+        if data["Response"]["#text"] == "Assay Start":
+            printAndLog("Response: Assay Start")
+            pxrf.instr_assayisrunning = True
+        elif data["Response"]["#text"] == "Assay Stop":
+            printAndLog("Response: Assay Stop")
+            # instr_assayisrunning = False
+
+    # Response Success log in OR already logged in
+    elif ("ogged in as" in data["Response"]["#text"]) and (
+        "success" in data["Response"]["@status"]
+    ):
+        pxrf.instr_isloggedin = True
+        printAndLog(f"{data['Response']['@status']}: {data['Response']['#text']}")
+
+    # Transmit results configuration change response ({'Response': {'@parameter': 'transmit spectra', '@status': 'success', '#text': 'Transmit Spectra configuration updated'}})
+    elif ("@parameter" in data["Response"]) and (
+        "transmit" in data["Response"]["@parameter"]
+    ):
+        printAndLog(f"{data['Response']['@status']}: {data['Response']['#text']}")
+
+    # Catchall for OTHER unimportant responses confirming configure changes (like time and date set, etc)
+    elif "Configure:" in data["Response"]["#text"]:
+        printAndLog(
+            f"{data['Response']['@status']}: {data['Response'].get('@parameter')}: {data['Response']['#text']}"
+        )
+
+    else:
+        printAndLog(data)
+
+
+# 5b - XML PACKET, Applications present response
+def xrfHandle_ApplicationsPresent(data: dict):
+    try:
+        pxrf.instr_applicationspresent = data["Response"]["ApplicationList"][
+            "Application"
+        ]
+        if isinstance(pxrf.instr_applicationspresent, str):
+            pxrf.instr_applicationspresent = [pxrf.instr_applicationspresent]
+        printAndLog(f"Applications Available: {pxrf.instr_applicationspresent}")
+    except Exception as e:
+        print(
+            f"Applications Available Error: Not Found - Was the instrument busy when it was connected? ({repr(e)})"
+        )
+
+
+# 5c - XML PACKET, Active Application and Methods present response
+def xrfHandle_ActiveApplication(data: dict):
+    try:
+        pxrf.instr_currentapplication = data["Response"]["Application"]
+        printAndLog(f"Current Application: {pxrf.instr_currentapplication}")
+    except Exception as e:
+        print(f"Current application could not be found. ({repr(e)})")
+        printAndLog("Current Application: Not Found / Spectrometer Mode")
+    try:
+        pxrf.instr_methodsforcurrentapplication = data["Response"]["MethodList"][
+            "Method"
+        ]
+        if isinstance(pxrf.instr_methodsforcurrentapplication, str):
+            pxrf.instr_methodsforcurrentapplication = [
+                pxrf.instr_methodsforcurrentapplication
+            ]
+        printAndLog(f"Methods Available: {pxrf.instr_methodsforcurrentapplication}")
+    except Exception as e:
+        pxrf.instr_methodsforcurrentapplication = [""]
+        print(f"Methods for current application could not be found. ({repr(e)})")
+        printAndLog("Methods Available: Not Found / Spectrometer Mode")
+    try:
+        pxrf.instr_currentmethod = data["Response"]["ActiveMethod"]
+        printAndLog(f"Current Method: {pxrf.instr_currentmethod}")
+    except Exception as e:
+        pxrf.instr_currentmethod = ""
+        print(f"Current method could not be found. ({repr(e)})")
+        printAndLog("Current Method: Not Found / Spectrometer Mode")
+    try:
+        methodselected_stringvar.set(pxrf.instr_currentmethod)
+        dropdown_method.configure(values=pxrf.instr_methodsforcurrentapplication)
+    except NameError as e:
+        print(f"Error updating method dropdown. ({repr(e)})")
+    except RuntimeError as e:
+        print(
+            f"Error: tried to set method stringvar too early. resuming... ({repr(e)})"
+        )
+    except AttributeError as e:
+        print(f"Error updating method dropdown. ({repr(e)})")
+
+
+def xrfHandle_Other(data):
+    """fallback for any packet with no registered handler"""
+    if data is not None:
+        printAndLog(data)
+
+
+def buildPacketDispatcher() -> PacketDispatcher:
+    """Returns a PacketDispatcher with all xrfHandle_ functions registered.
+    keys are (datatype, root tag, @parameter (lowercase)). None = any (fallback)."""
+    _dispatcher = PacketDispatcher(fallback=xrfHandle_Other)
+    # binary packets, no xml to inspect.
+    _dispatcher.register(COOKED_SPECTRUM, None, None, xrfHandle_CookedSpectrum)
+    _dispatcher.register(SPECTRUM_ENERGY_PACKET, None, None, xrfHandle_SpectrumEnergy)
+    _dispatcher.register(RAW_SPECTRUM, None, None, xrfHandle_RawSpectrum)
+    _dispatcher.register(PDZ_FILENAME, None, None, xrfHandle_PDZFilename)
+    _dispatcher.register(RESULTS_SET, None, None, xrfHandle_ResultsSet)
+    # status changes
+    _dispatcher.register(STATUS_CHANGE, "Status", "assay", xrfHandle_StatusAssay)
+    _dispatcher.register(
+        STATUS_CHANGE, "Status", "phase change", xrfHandle_StatusPhaseChange
+    )
+    _dispatcher.register(STATUS_CHANGE, "Status", "armed", xrfHandle_StatusArmed)
+    _dispatcher.register(STATUS_CHANGE, "Status", None, xrfHandle_StatusOther)
+    # xml packets
+    _dispatcher.register(
+        XML_PACKET, "Response", "instrument definition", xrfHandle_InstrumentDefinition
+    )
+    _dispatcher.register(XML_PACKET, "Response", "phase times", xrfHandle_PhaseTimes)
+    _dispatcher.register(XML_PACKET, "Response", "edit fields", xrfHandle_EditFields)
+    _dispatcher.register(XML_PACKET, "Data", None, xrfHandle_Results)
+    _dispatcher.register(XML_PACKET, "InfoReport", None, xrfHandle_InfoReport)
+    _dispatcher.register(XML_PACKET, "ErrorReport", None, xrfHandle_ErrorReport)
+    _dispatcher.register(XML_PACKET, None, None, xrfHandle_UncategorisedXML)
+    # xml 'success' responses
+    for _parameter, _handler in (
+        ("login state", xrfHandle_LoginStateResponse),
+        ("armed state", xrfHandle_ArmedStateResponse),
+        ("nose temperature", xrfHandle_NoseTemperatureResponse),
+        ("nose pressure", xrfHandle_NosePressureResponse),
+        ("phase times", xrfHandle_PhaseTimesSetResponse),
+        ("version", xrfHandle_VersionResponse),
+        ("store results", xrfHandle_StoreResultsResponse),
+        ("store spectra", xrfHandle_StoreSpectraResponse),
+        ("proximity required", xrfHandle_ProximityRequiredResponse),
+    ):
+        _dispatcher.register(XML_SUCCESS_RESPONSE, "Response", _parameter, _handler)
+    _dispatcher.register(XML_SUCCESS_RESPONSE, None, None, xrfHandle_OtherResponse)
+    _dispatcher.register(
+        XML_APPS_PRESENT_RESPONSE,
+        "Response",
+        "applications",
+        xrfHandle_ApplicationsPresent,
+    )
+    _dispatcher.register(
+        XML_ACTIVE_APP_RESPONSE,
+        "Response",
+        "activeapplication",
+        xrfHandle_ActiveApplication,
+    )
+    return _dispatcher
+
+
+# layout of the 208-byte cooked spectrum header (was struct format "<f4xLLL4xLLLL6xH78xhHxxLL8xfffff4xLihhhhhhffxxbxxxxx")
+# originally, struct.unpack('<f4xLLL4xLLLLLHH78xhH2xLLLLfffffLLihhhhhhff2xbbbbbb', data[0:208])
+COOKED_SPECTRUM_HEADER_DTYPE = np.dtype(
+    {
+        "names": [
+            "fEVPerChannel",
+            "iTDur",
+            "iRaw_Cnts",
+            "iValid_Cnts",
+            "iADur",
+            "iADead",
+            "iAReset",
+            "iALive",
+            "iPacket_Cnt",
+            "Det_Temp",
+            "Amb_Temp",
+            "iRaw_Cnts_Acc",
+            "iValid_Cnts_Acc",
+            "fTDur",
+            "fADur",
+            "fADead",
+            "fAReset",
+            "fALive",
+            "lPacket_Cnt",
+            "iFilterNum",
+            "fltElement1",
+            "fltThickness1",
+            "fltElement2",
+            "fltThickness2",
+            "fltElement3",
+            "fltThickness3",
+            "sngHVADC",
+            "sngCurADC",
+            "Toggle",
+        ],
+        "formats": [
+            "<f4",
+            "<u4",
+            "<u4",
+            "<u4",
+            "<u4",
+            "<u4",
+            "<u4",
+            "<u4",
+            "<u2",
+            "<i2",
+            "<u2",
+            "<u4",
+            "<u4",
+            "<f4",
+            "<f4",
+            "<f4",
+            "<f4",
+            "<f4",
+            "<u4",
+            "<i4",
+            "<i2",
+            "<i2",
+            "<i2",
+            "<i2",
+            "<i2",
+            "<i2",
+            "<f4",
+            "<f4",
+            "i1",
+        ],
+        "offsets": [
+            0,
+            8,
+            12,
+            16,
+            24,
+            28,
+            32,
+            36,
+            46,
+            126,
+            128,
+            132,
+            136,
+            148,
+            152,
+            156,
+            160,
+            164,
+            172,
+            176,
+            180,
+            182,
+            184,
+            186,
+            188,
+            190,
+            192,
+            196,
+            202,
+        ],
+        "itemsize": 208,
+    }
+)
+
+
+class CookedSpectrum:
+    """A cooked spectrum: the 208-byte header mapped once as a COOKED_SPECTRUM_HEADER_DTYPE record, and the counts as a uint32 array.
+    Header fields are only converted to python values when they are accessed.
+    Supports the dict-style access used throughout (e.g. spectrum["iRaw_Cnts"], spectrum["data"], "normalised_data" in spectrum).
+    Once compressed (see compress), data and normalised_data are decompressed/recalculated on access, via decompressed_spectrum_cache."""
+
+    __slots__ = (
+        "header",
+        "_data",
+        "_normalised_data",
+        "_compressed",
+        "_normalise_on_access",
+        "_fltDescription",
+    )
+
+    def __init__(self, header: np.void, data: np.ndarray):
+        self.header = header  # COOKED_SPECTRUM_HEADER_DTYPE record (may be a row of a larger array, see packSpectra)
+        self._data = data  # counts per channel
+        self._normalised_data = None  # see normaliseSpectrum
+        self._compressed: bytes = None  # see compress
+        self._normalise_on_access = False  # compressed spectra had normalised_data
+        self._fltDescription: str = None
+
+    @classmethod
+    def from_packet(cls, body) -> "CookedSpectrum":
+        """Returns a CookedSpectrum from a cooked spectrum packet body. the body is copied, so may be a view into a reused buffer."""
+        return cls(
+            np.frombuffer(bytearray(body[:208]), dtype=COOKED_SPECTRUM_HEADER_DTYPE)[0],
+            np.frombuffer(body, dtype="<u4", offset=208).copy(),
+        )
+
+    @classmethod
+    def from_compressed(cls, header: np.void, compressed: bytes) -> "CookedSpectrum":
+        """Returns a compressed CookedSpectrum (e.g. loaded from the AssayCatalogue) from its header record and compressSpectrumCounts bytes.
+        Its normalised data is calculated from the counts when accessed."""
+        _spectrum = cls(header, None)
+        _spectrum._compressed = compressed
+        _spectrum._normalise_on_access = True
+        return _spectrum
+
+    @property
+    def data(self) -> np.ndarray:
+        """Counts per channel (uint32 array)."""
+        if self._data is not None:
+            return self._data
+        return decompressed_spectrum_cache.get(
+            (self, "data"), lambda: decompressSpectrumCounts(self._compressed)
+        )
+
+    @data.setter
+    def data(self, value):
+        if self._compressed is not None:
+            # counts changed, so the compressed copy and anything calculated from it are out of date
+            decompressed_spectrum_cache.discard((self, "data"))
+            decompressed_spectrum_cache.discard((self, "normalised_data"))
+            self._compressed = None
+            self._normalise_on_access = False
+        self._data = value
+
+    @property
+    def normalised_data(self) -> np.ndarray:
+        if self._normalised_data is not None or not self._normalise_on_access:
+            return self._normalised_data
+        return decompressed_spectrum_cache.get(
+            (self, "normalised_data"), lambda: normaliseSpectrum(self.data, None)
+        )
+
+    @normalised_data.setter
+    def normalised_data(self, value):
+        if self._compressed is not None:
+            # normalised data is recalculated from the counts on access rather than kept
+            self._normalise_on_access = value is not None
+            decompressed_spectrum_cache.put((self, "normalised_data"), value)
+        else:
+            self._normalised_data = value
+
+    @property
+    def compressed(self) -> bool:
+        return self._compressed is not None
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by this spectrum's header, counts and normalised data (not counting arrays in decompressed_spectrum_cache)."""
+        _nbytes = self.header.nbytes
+        for _array in (self._data, self._normalised_data):
+            if _array is not None:
+                _nbytes += _array.nbytes
+        if self._compressed is not None:
+            _nbytes += len(self._compressed)
+        return _nbytes
+
+    def compressed_counts(self) -> bytes:
+        """Returns the counts as compressSpectrumCounts bytes (the compressed copy, if already compressed)."""
+        if self._compressed is not None:
+            return self._compressed
+        return compressSpectrumCounts(self._data)
+
+    def compress(self):
+        """Swaps the counts for a compressed copy (see compressSpectrumCounts) and drops the normalised data, which is recalculated when needed.
+        The arrays are handed to decompressed_spectrum_cache, so they're still there if used again soon (e.g. the assay being plotted on completion)."""
+        if self._compressed is not None:
+            return
+        self._compressed = compressSpectrumCounts(self._data)
+        decompressed_spectrum_cache.put((self, "data"), self._data)
+        if self._normalised_data is not None:
+            self._normalise_on_access = True
+            decompressed_spectrum_cache.put(
+                (self, "normalised_data"), self._normalised_data
+            )
+        self._data = None
+        self._normalised_data = None
+
+    @property
+    def fltDescription(self) -> str:
+        """Description of the filter used, e.g. '(Cu:75μm/Ti:25μm/Al:200μm)' or '(No Filter)'."""
+        if self._fltDescription is None:
+            e1 = elementZtoSymbol(int(self["fltElement1"]))
+            e2 = elementZtoSymbol(int(self["fltElement2"]))
+            e3 = elementZtoSymbol(int(self["fltElement3"]))
+
+            if self["fltThickness1"] == 0:
+                t1 = ""
             else:
-                # try: printAndLog(f"{data['Response']['@parameter']}: {data['Response']['#text']}")
-                # except: pass
-                # try: printAndLog(f"{data['Response']['@status']}: {data['Response']['#text']}")
-                # except:
-                #     printAndLog(data)
-                printAndLog(data)
-
-        # 5b - XML PACKET, Applications present response
-        elif datatype == XML_APPS_PRESENT_RESPONSE:
-            try:
-                pxrf.instr_applicationspresent = data["Response"]["ApplicationList"][
-                    "Application"
-                ]
-                if isinstance(pxrf.instr_applicationspresent, str):
-                    pxrf.instr_applicationspresent = [pxrf.instr_applicationspresent]
-                printAndLog(f"Applications Available: {pxrf.instr_applicationspresent}")
-            except Exception as e:
-                print(
-                    f"Applications Available Error: Not Found - Was the instrument busy when it was connected? ({repr(e)})"
-                )
+                t1 = f":{self['fltThickness1']}\u03bcm"
 
-        # 5c - XML PACKET, Active Application and Methods present response
-        elif datatype == XML_ACTIVE_APP_RESPONSE:
-            try:
-                pxrf.instr_currentapplication = data["Response"]["Application"]
-                printAndLog(f"Current Application: {pxrf.instr_currentapplication}")
-            except Exception as e:
-                print(f"Current application could not be found. ({repr(e)})")
-                printAndLog("Current Application: Not Found / Spectrometer Mode")
-            try:
-                pxrf.instr_methodsforcurrentapplication = data["Response"][
-                    "MethodList"
-                ]["Method"]
-                if isinstance(pxrf.instr_methodsforcurrentapplication, str):
-                    pxrf.instr_methodsforcurrentapplication = [
-                        pxrf.instr_methodsforcurrentapplication
-                    ]
-                printAndLog(
-                    f"Methods Available: {pxrf.instr_methodsforcurrentapplication}"
+            if self["fltThickness2"] == 0:
+                t2 = ""
+            else:
+                t2 = f":{self['fltThickness2']}\u03bcm"
+                t1 = f"{t1}/"
+
+            if self["fltThickness3"] == 0:
+                t3 = ""
+            else:
+                t3 = f":{self['fltThickness3']}\u03bcm"
+                t2 = f"{t2}/"
+
+            self._fltDescription = f"({e1}{t1}{e2}{t2}{e3}{t3})"
+            if self._fltDescription == "()":
+                self._fltDescription = "(No Filter)"
+        return self._fltDescription
+
+    def __getitem__(self, key: str):
+        if key == "data":
+            return self.data
+        if key == "normalised_data":
+            if self.normalised_data is None:
+                raise KeyError(key)
+            return self.normalised_data
+        if key == "fltDescription":
+            return self.fltDescription
+        if key not in COOKED_SPECTRUM_HEADER_DTYPE.fields:
+            raise KeyError(key)
+        return self.header[key].item()
+
+    def __setitem__(self, key: str, value):
+        if key == "data":
+            self.data = value
+        elif key == "normalised_data":
+            self.normalised_data = value
+        elif key in COOKED_SPECTRUM_HEADER_DTYPE.fields:
+            self.header[key] = value
+            self._fltDescription = None
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key: str) -> bool:
+        if key == "normalised_data":
+            return self._normalised_data is not None or self._normalise_on_access
+        return key in ("data", "fltDescription") or (
+            key in COOKED_SPECTRUM_HEADER_DTYPE.fields
+        )
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+def packSpectra(spectra: list[CookedSpectrum]):
+    """Moves the headers and counts of spectra (e.g. the phases of an assay) into one contiguous structured array and one 2D counts array,
+    and points each spectrum at its row. Returns tuple (headers, counts), or None if the spectra can't be packed (e.g. differing channel counts)."""
+    if not spectra or not all(isinstance(_s, CookedSpectrum) for _s in spectra):
+        return None
+    _channels = len(spectra[0].data)
+    if any(len(_s.data) != _channels for _s in spectra):
+        return None
+    _headers = np.empty(len(spectra), dtype=COOKED_SPECTRUM_HEADER_DTYPE)
+    _counts = np.empty((len(spectra), _channels), dtype="<u4")
+    for _i, _spectrum in enumerate(spectra):
+        _headers[_i] = _spectrum.header
+        _counts[_i] = _spectrum.data
+    for _i, _spectrum in enumerate(spectra):
+        _spectrum.header = _headers[_i]
+        _spectrum.data = _counts[_i]
+    return _headers, _counts
+
+
+SPECTRUM_CODECS = {
+    "zlib": (
+        lambda _b: zlib.compress(_b, SPECTRUM_COMPRESSION_LEVEL),
+        zlib.decompress,
+    ),
+    "lzma": (
+        lambda _b: lzma.compress(_b, preset=SPECTRUM_COMPRESSION_LEVEL),
+        lzma.decompress,
+    ),
+}
+
+
+def compressSpectrumCounts(counts: np.ndarray) -> bytes:
+    """Compresses a spectrum's counts (uint32 array) to bytes: the first byte is the channel codec used (see SPECTRUM_CODECS),
+    then the differences between neighbouring channels, zigzag encoded (so small negative differences stay small numbers) and byte-shuffled
+    (all the low bytes first, then the next etc, so the mostly-zero high bytes compress to almost nothing).
+    Typically ~2KB for a 2048 channel spectrum (8KB uncompressed)."""
+    _counts = np.ascontiguousarray(counts, dtype="<u4")
+    # uint32 arithmetic wraps, so this is exactly reversible with a cumulative sum
+    _deltas = np.diff(_counts, prepend=np.uint32(0)).view("<i4")
+    _zigzag = ((_deltas << 1) ^ (_deltas >> 31)).view("<u4")
+    _shuffled = _zigzag.view("u1").reshape(-1, 4).T.tobytes()
+    _codec = list(SPECTRUM_CODECS).index(SPECTRUM_COMPRESSION_CODEC)
+    return bytes([_codec]) + SPECTRUM_CODECS[SPECTRUM_COMPRESSION_CODEC][0](_shuffled)
+
+
+def decompressSpectrumCounts(compressed: bytes) -> np.ndarray:
+    """Reverses compressSpectrumCounts, returning the counts as a read-only uint32 array."""
+    _decompress = list(SPECTRUM_CODECS.values())[compressed[0]][1]
+    _shuffled = np.frombuffer(_decompress(compressed[1:]), dtype="u1")
+    _zigzag = np.ascontiguousarray(_shuffled.reshape(4, -1).T).view("<u4").ravel()
+    _deltas = (_zigzag >> 1) ^ (-(_zigzag & 1).view("<i4")).view("<u4")
+    _counts = np.cumsum(_deltas, dtype="<u4")
+    _counts.flags.writeable = False
+    return _counts
+
+
+class SpectrumArrayCache:
+    """Thread-safe LRU cache of the arrays of compressed spectra (see CookedSpectrum.compress), keyed by (spectrum, field).
+    Holds up to max_arrays arrays, discarding the least recently used. hits/misses are counted for checking the size is sensible."""
+
+    def __init__(self, max_arrays: int = SPECTRUM_CACHE_ARRAYS):
+        self.max_arrays = max_arrays
+        self.hits: int = 0
+        self.misses: int = 0
+        self._arrays = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, create):
+        """Returns the cached array for key, or calls create() to make it (outside the lock) and caches that."""
+        with self._lock:
+            _array = self._arrays.get(key)
+            if _array is not None:
+                self._arrays.move_to_end(key)
+                self.hits += 1
+                return _array
+            self.misses += 1
+        _array = create()
+        self.put(key, _array)
+        return _array
+
+    def put(self, key, array):
+        with self._lock:
+            if array is None:
+                self._arrays.pop(key, None)
+                return
+            self._arrays[key] = array
+            self._arrays.move_to_end(key)
+            while len(self._arrays) > self.max_arrays:
+                self._arrays.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._arrays.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(_array.nbytes for _array in self._arrays.values())
+
+
+decompressed_spectrum_cache = SpectrumArrayCache()
+
+
+def compressAssaySpectra(assay: Assay) -> tuple[int, int]:
+    """Compresses an assay's spectra in the catalogue (see CookedSpectrum.compress). Returns tuple of bytes held by its spectra (before, after)."""
+    _spectra = [_s for _s in assay.spectra if isinstance(_s, CookedSpectrum)]
+    _before = sum(_s.nbytes for _s in _spectra)
+    for _spectrum in _spectra:
+        _spectrum.compress()
+    return _before, sum(_s.nbytes for _s in _spectra)
+
+
+class AssayCatalogue:
+    """The completed assays of the session, kept on disk rather than in memory, with the same list-style access the catalogue has always had
+    (append, len, catalogue[i], slices and iteration, in the order assays were completed).
+    Each assay is stored as a row of a SQLite database ({path}.sqlite: a few columns for reference, the rest of the Assay pickled),
+    and its spectra appended to a blob file ({path}.spectra: the phases' headers, then their compressSpectrumCounts bytes).
+    Only the spectra file offsets of each assay and the CATALOGUE_CACHED_ASSAYS most recently used Assays are kept in memory,
+    and spectra loaded from disk are decompressed only when used. Changes to an assay after it is appended (e.g. re-checked sanity) are stored with save().
+    Assays are written on a background thread, in order, and kept in memory until they have been (so append doesn't wait on the disk).
+    open() is usually called once the log file is initialised; if an assay is appended before then, the catalogue is kept in a temporary folder instead."""
+
+    def __init__(
+        self, path: str = None, max_cached_assays: int = CATALOGUE_CACHED_ASSAYS
+    ):
+        self.path = None
+        self.max_cached_assays = max_cached_assays
+        self._temporary_folder: str = None
+        self._db: sqlite3.Connection = None
+        self._spectra_file = None
+        self._length: int = 0
+        # position: (offset, length) in the spectra file, of each assay written
+        self._offsets: dict[int, tuple[int, int]] = {}
+        # position: Assay, of assays appended but not written yet (or that couldn't be written)
+        self._unwritten: dict[int, Assay] = {}
+        self._cached = OrderedDict()  # position: Assay, most recently used last
+        # _io_lock (database and spectra file) is always acquired before _lock (everything else) when both are needed
+        self._io_lock = threading.RLock()
+        self._lock = threading.RLock()
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        if path is not None:
+            self.open(path)
+
+    def open(self, path: str):
+        """Opens (creating if needed) the catalogue files {path}.sqlite and {path}.spectra. Any assays already stored there are part of the catalogue."""
+        self.close()
+        with self._io_lock, self._lock:
+            self._open_files(path)
+            self._offsets = {
+                _position: (_offset, _length)
+                for _position, _offset, _length in self._db.execute(
+                    "SELECT position, spectra_offset, spectra_length FROM assays"
                 )
-            except Exception as e:
-                pxrf.instr_methodsforcurrentapplication = [""]
-                print(
-                    f"Methods for current application could not be found. ({repr(e)})"
+            }
+            self._length = max(self._offsets) + 1 if self._offsets else 0
+
+    def _open_files(self, path: str):
+        _folder = os.path.dirname(path)
+        if _folder and not os.path.exists(_folder):
+            os.makedirs(_folder)
+        self._db = sqlite3.connect(f"{path}.sqlite", check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS assays (position INTEGER PRIMARY KEY, assay_index TEXT, date_completed TEXT, time_completed TEXT, time_elapsed TEXT, "
+            "cal_application TEXT, sanity_check_passed TEXT, note TEXT, spectra_offset INTEGER, spectra_length INTEGER, details BLOB)"
+        )
+        self._db.commit()
+        self._spectra_file = open(
+            f"{path}.spectra", "r+b" if os.path.exists(f"{path}.spectra") else "w+b"
+        )
+        self.path = path
+
+    def close(self):
+        """Finishes writing any appended assays and closes the catalogue files. The catalogue is empty until opened again. A temporary catalogue's files are deleted."""
+        self.flush()
+        with self._io_lock, self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._spectra_file.close()
+            if self._temporary_folder is not None:
+                shutil.rmtree(self._temporary_folder, ignore_errors=True)
+            self._db = None
+            self._spectra_file = None
+            self._temporary_folder = None
+            self._length = 0
+            self._offsets = {}
+            self._unwritten = {}
+            self._cached.clear()
+            self.path = None
+
+    def flush(self):
+        """Waits for any queued writes."""
+        self._writer.submit(lambda: None).result()
+
+    def append(self, assay: Assay):
+        """Adds the assay (its spectra must be CookedSpectrums) to the end of the catalogue, and keeps it loaded as the most recently used.
+        It's written to disk on the background thread."""
+        with self._lock:
+            _position = self._length
+            self._length += 1
+            self._unwritten[_position] = assay
+            self._cache(_position, assay)
+        self._writer.submit(self._write, _position, assay)
+
+    def _write(self, position: int, assay: Assay):
+        try:
+            with self._io_lock:
+                if self._db is None:
+                    _folder = tempfile.mkdtemp(prefix="S1Control_")
+                    self._open_files(os.path.join(_folder, "S1Control_Catalogue"))
+                    self._temporary_folder = _folder
+                _headers = b"".join(_s.header.tobytes() for _s in assay.spectra)
+                _compressed = [_s.compressed_counts() for _s in assay.spectra]
+                self._spectra_file.seek(0, os.SEEK_END)
+                _offset = self._spectra_file.tell()
+                self._spectra_file.write(_headers)
+                for _c in _compressed:
+                    self._spectra_file.write(_c)
+                self._spectra_file.flush()
+                _length = self._spectra_file.tell() - _offset
+                self._db.execute(
+                    "INSERT INTO assays VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        position,
+                        assay.index,
+                        assay.date_completed,
+                        assay.time_completed,
+                        assay.time_elapsed,
+                        assay.cal_application,
+                        assay.sanity_check_passed,
+                        assay.note,
+                        _offset,
+                        _length,
+                        self._details(assay, [len(_c) for _c in _compressed]),
+                    ),
                 )
-                printAndLog("Methods Available: Not Found / Spectrometer Mode")
-            try:
-                pxrf.instr_currentmethod = data["Response"]["ActiveMethod"]
-                printAndLog(f"Current Method: {pxrf.instr_currentmethod}")
-            except Exception as e:
-                pxrf.instr_currentmethod = ""
-                print(f"Current method could not be found. ({repr(e)})")
-                printAndLog("Current Method: Not Found / Spectrometer Mode")
-            try:
-                methodselected_stringvar.set(pxrf.instr_currentmethod)
-                dropdown_method.configure(
-                    values=pxrf.instr_methodsforcurrentapplication
+                self._db.commit()
+                with self._lock:
+                    self._offsets[position] = (_offset, _length)
+                    del self._unwritten[position]
+        except Exception as e:
+            printAndLog(
+                f"Assay # {assay.index} could not be stored in the catalogue, so is only kept in memory (it won't be there if the session is resumed). ({repr(e)})",
+                "ERROR",
+            )
+
+    def save(self, assay: Assay):
+        """Stores changes to an assay already in the catalogue (found by its index), other than to its spectra. Written on the background thread, after any appends."""
+        self._writer.submit(self._save, assay)
+
+    def _save(self, assay: Assay):
+        try:
+            with self._io_lock:
+                (_position, _details) = self._db.execute(
+                    "SELECT position, details FROM assays WHERE assay_index = ?",
+                    (assay.index,),
+                ).fetchone()
+                self._db.execute(
+                    "UPDATE assays SET sanity_check_passed = ?, note = ?, details = ? WHERE position = ?",
+                    (
+                        assay.sanity_check_passed,
+                        assay.note,
+                        self._details(assay, pickle.loads(_details)["spectra_sizes"]),
+                        _position,
+                    ),
                 )
-            except NameError as e:
-                print(f"Error updating method dropdown. ({repr(e)})")
-            except RuntimeError as e:
-                print(
-                    f"Error: tried to set method stringvar too early. resuming... ({repr(e)})"
+                self._db.commit()
+        except Exception as e:
+            printAndLog(
+                f"Changes to Assay # {assay.index} could not be stored in the catalogue. ({repr(e)})",
+                "ERROR",
+            )
+
+    @staticmethod
+    def _details(assay: Assay, spectra_sizes: list[int]) -> bytes:
+        """Pickles the fields of the assay other than spectra, along with the sizes of its compressed spectra in the spectra file."""
+        _details = {
+            _name: getattr(assay, _name)
+            for _name in Assay.__dataclass_fields__
+            if _name != "spectra"
+        }
+        _details["spectra_sizes"] = spectra_sizes
+        return pickle.dumps(_details, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _load(self, position: int) -> Assay:
+        if position not in self._offsets:
+            raise IndexError(f"assay at catalogue position {position} was never stored")
+        (_details,) = self._db.execute(
+            "SELECT details FROM assays WHERE position = ?", (position,)
+        ).fetchone()
+        _details = pickle.loads(_details)
+        _sizes = _details.pop("spectra_sizes")
+        _offset, _length = self._offsets[position]
+        self._spectra_file.seek(_offset)
+        _blob = self._spectra_file.read(_length)
+        _headers_length = len(_sizes) * COOKED_SPECTRUM_HEADER_DTYPE.itemsize
+        _headers = np.frombuffer(
+            bytearray(_blob[:_headers_length]), dtype=COOKED_SPECTRUM_HEADER_DTYPE
+        )
+        _spectra = []
+        _start = _headers_length
+        for _header, _size in zip(_headers, _sizes):
+            _spectra.append(
+                CookedSpectrum.from_compressed(_header, _blob[_start : _start + _size])
+            )
+            _start += _size
+        return Assay(spectra=_spectra, **_details)
+
+    def _cache(self, position: int, assay: Assay):
+        self._cached[position] = assay
+        self._cached.move_to_end(position)
+        while len(self._cached) > self.max_cached_assays:
+            self._cached.popitem(last=False)
+
+    def _get(self, position: int) -> Assay:
+        with self._lock:
+            _assay = self._cached.get(position, self._unwritten.get(position))
+            if _assay is not None:
+                self._cache(position, _assay)
+                return _assay
+        # an assay is written before it's taken out of _unwritten, so it can be loaded if it wasn't there
+        with self._io_lock:
+            _assay = self._load(position)
+        with self._lock:
+            self._cache(position, _assay)
+        return _assay
+
+    def summaries(self) -> list[tuple]:
+        """Returns (index, application, time completed, time elapsed, sanity check, note) of every assay in order, as shown in the assays table.
+        Read from the database alone, without loading any assays."""
+        self.flush()
+        with self._io_lock:
+            if self._db is None:
+                return []
+            return self._db.execute(
+                "SELECT assay_index, cal_application, time_completed, time_elapsed, sanity_check_passed, note FROM assays ORDER BY position"
+            ).fetchall()
+
+    def cached(self) -> list[Assay]:
+        """Returns the assays currently loaded in memory (the most recently used), in catalogue order."""
+        with self._lock:
+            _assays = {**self._unwritten, **self._cached}
+            return [_assays[_position] for _position in sorted(_assays)]
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [
+                self._get(_position) for _position in range(*key.indices(len(self)))
+            ]
+        _position = key + len(self) if key < 0 else key
+        if not 0 <= _position < len(self):
+            raise IndexError("assay catalogue index out of range")
+        return self._get(_position)
+
+    def __iter__(self):
+        for _position in range(len(self)):
+            yield self._get(_position)
+
+
+class GrowableNpyArray:
+    """A .npy file that rows can be appended to, memory-mapped. Space for capacity rows is preallocated, and doubled when full.
+    The header's shape is kept at the number of rows appended, so np.load(path, mmap_mode="r") reads it at any time, and it's padded so it can be rewritten in place.
+    Opening an existing file carries on appending to it. Arrays from rows/append() are views of the current mapping, which is replaced when the file grows."""
+
+    def __init__(self, path: str, dtype, row_shape: tuple = (), capacity: int = 1):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self._row_bytes = self.dtype.itemsize * int(np.prod(self.row_shape, dtype=int))
+        # header is sized for a 15 digit length, so the shape can always be rewritten without moving the data
+        self._header_length = -(-(len(self._header_dict(10**15)) + 11) // 64) * 64
+        if os.path.exists(path):
+            self._file = open(path, "r+b")
+            np.lib.format.read_magic(self._file)
+            _shape, _, _dtype = np.lib.format.read_array_header_1_0(self._file)
+            if _dtype != self.dtype or tuple(_shape[1:]) != self.row_shape:
+                self._file.close()
+                raise ValueError(
+                    f"{path} holds {_dtype} rows of shape {_shape[1:]}, not {self.dtype} rows of shape {self.row_shape}"
                 )
-            except AttributeError as e:
-                print(f"Error updating method dropdown. ({repr(e)})")
+            self.length = _shape[0]
+            self.capacity = max(
+                (os.path.getsize(path) - self._header_length) // self._row_bytes,
+                self.length,
+                1,
+            )
+        else:
+            self._file = open(path, "w+b")
+            self.length = 0
+            self.capacity = max(int(capacity), 1)
+        self._write_header()
+        self._map()
+
+    def _header_dict(self, length: int) -> str:
+        return repr(
+            {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": (length,) + self.row_shape,
+            }
+        )
+
+    def _write_header(self):
+        _header = self._header_dict(self.length).ljust(self._header_length - 11) + "\n"
+        self._file.seek(0)
+        self._file.write(
+            np.lib.format.magic(1, 0)
+            + struct.pack("<H", len(_header))
+            + _header.encode("latin1")
+        )
+        self._file.flush()
+
+    def _map(self):
+        self._file.truncate(self._header_length + self.capacity * self._row_bytes)
+        self._array = np.memmap(
+            self._file,
+            dtype=self.dtype,
+            mode="r+",
+            offset=self._header_length,
+            shape=(self.capacity,) + self.row_shape,
+        )
+
+    def append(self) -> np.ndarray:
+        """Adds a row of zeros, returning it to be filled in (writing to it writes to the file)."""
+        if self.length == self.capacity:
+            self._array.flush()
+            # the old mapping has to be released before the file can be resized on windows
+            self._array = None
+            self.capacity *= 2
+            self._map()
+        _row = self._array[self.length]
+        self.length += 1
+        self._write_header()
+        return _row
+
+    @property
+    def rows(self) -> np.ndarray:
+        """The appended rows, as a (length, *row_shape) view of the file."""
+        return self._array[: self.length]
+
+    def flush(self):
+        self._array.flush()
+
+    def close(self):
+        """Flushes, and trims the file to the rows appended."""
+        self._array.flush()
+        self._array = None
+        self._file.truncate(self._header_length + self.length * self._row_bytes)
+        self._file.close()
+
+
+# per phase metadata in the SpectraArchive: the cooked spectrum header fields (as in COOKED_SPECTRUM_HEADER_DTYPE),
+# the phase's energy calibration packet (see setSpecEnergy), and whether the phase was present in the assay.
+SPECTRA_ARCHIVE_INFO_DTYPE = np.dtype(
+    {
+        "names": list(COOKED_SPECTRUM_HEADER_DTYPE.names)
+        + [
+            "specenergy_iPacketCount",
+            "specenergy_fEVChanStart",
+            "specenergy_fEVPerChannel",
+            "present",
+        ],
+        "formats": [
+            COOKED_SPECTRUM_HEADER_DTYPE.fields[_name][0]
+            for _name in COOKED_SPECTRUM_HEADER_DTYPE.names
+        ]
+        + ["<i4", "<f4", "<f4", "u1"],
+        "offsets": [
+            COOKED_SPECTRUM_HEADER_DTYPE.fields[_name][1]
+            for _name in COOKED_SPECTRUM_HEADER_DTYPE.names
+        ]
+        + [208, 212, 216, 220],
+        "itemsize": 224,
+    }
+)
 
-        # 7 - SPECTRUM ENERGY PACKET, contains the SpecEnergy structure, cal info (The instrument will transmit a SPECTRUM_ENERGY packet inmmediately before transmitting it’s associated COOKED_SPECTRUM packet. The SpecEnergy iPacketCount member contains an integer that associates the SpecEnergy values with the corresponding COOKED_SPECTRUM packet via the iPacket_Cnt member of the s1_cooked_header structure.)
-        elif datatype == SPECTRUM_ENERGY_PACKET:
-            pxrf.current_working_specenergies = setSpecEnergy(data)  # noqa: F841
 
+class SpectraArchive:
+    """Every phase spectrum of the session, in order, as two memory-mapped .npy files that anything can read whole sessions from with no parsing
+    (e.g. np.load(path, mmap_mode="r")), leaving the OS page cache to decide what stays in memory:
+    {path}_Counts.npy: uint32 (n_assays, max_phases, channels), and {path}_Info.npy: SPECTRA_ARCHIVE_INFO_DTYPE (n_assays, max_phases).
+    Row n is the nth assay appended (i.e. the same as the AssayCatalogue). Phases an assay doesn't have are zeros, with present = 0.
+    Nothing is archived until open() is called."""
+
+    def __init__(
+        self,
+        path: str = None,
+        max_phases: int = SPECTRA_ARCHIVE_MAX_PHASES,
+        channels: int = 2048,
+        initial_assays: int = SPECTRA_ARCHIVE_INITIAL_ASSAYS,
+    ):
+        self.path = None
+        self.max_phases = max_phases
+        self.channels = channels
+        self.initial_assays = initial_assays
+        self._counts: GrowableNpyArray = None
+        self._info: GrowableNpyArray = None
+        self._lock = threading.Lock()
+        if path is not None:
+            self.open(path)
+
+    def open(self, path: str):
+        """Opens (creating if needed) the archive files {path}_Counts.npy and {path}_Info.npy. Assays already in them are kept, and appended to."""
+        with self._lock:
+            self._close()
+            _folder = os.path.dirname(path)
+            if _folder and not os.path.exists(_folder):
+                os.makedirs(_folder)
+            self._counts = GrowableNpyArray(
+                f"{path}_Counts.npy",
+                "<u4",
+                (self.max_phases, self.channels),
+                self.initial_assays,
+            )
+            self._info = GrowableNpyArray(
+                f"{path}_Info.npy",
+                SPECTRA_ARCHIVE_INFO_DTYPE,
+                (self.max_phases,),
+                self.initial_assays,
+            )
+            self.path = path
+
+    @property
+    def is_open(self) -> bool:
+        return self._counts is not None
+
+    def append(self, spectra: list, specenergies: list):
+        """Archives an assay's phases (CookedSpectrums, and their specenergy dicts). Returns its row number, or None if the archive isn't open.
+        Phases beyond max_phases, or with a different number of channels, are left out (with a warning)."""
+        with self._lock:
+            if self._counts is None:
+                return None
+            _counts = self._counts.append()
+            _info = self._info.append()
+            for _p, (_spectrum, _specenergy) in enumerate(zip(spectra, specenergies)):
+                if _p >= self.max_phases or len(_spectrum.data) != self.channels:
+                    printAndLog(
+                        f"Spectra archive: phase {_p+1} of assay row {self._counts.length - 1} was left out ({len(_spectrum.data)} channels, max. {self.max_phases} phases).",
+                        "WARNING",
+                    )
+                    continue
+                _counts[_p] = _spectrum.data
+                # the header fields are at the same offsets in the info dtype, so the header record is copied as it is
+                _info[_p : _p + 1].view("u1")[: _spectrum.header.nbytes] = (
+                    np.frombuffer(_spectrum.header.tobytes(), dtype="u1")
+                )
+                _info[_p]["specenergy_iPacketCount"] = _specenergy["iPacketCount"]
+                _info[_p]["specenergy_fEVChanStart"] = _specenergy["fEVChanStart"]
+                _info[_p]["specenergy_fEVPerChannel"] = _specenergy["fEVPerChannel"]
+                _info[_p]["present"] = 1
+            return self._counts.length - 1
+
+    def __len__(self) -> int:
+        return 0 if self._counts is None else self._counts.length
+
+    @property
+    def counts(self) -> np.ndarray:
+        """(n_assays, max_phases, channels) uint32 view of the counts file. Don't keep hold of it, it's replaced when the archive grows."""
+        with self._lock:
+            return self._counts.rows
+
+    @property
+    def info(self) -> np.ndarray:
+        """(n_assays, max_phases) SPECTRA_ARCHIVE_INFO_DTYPE view of the info file. Don't keep hold of it, it's replaced when the archive grows."""
+        with self._lock:
+            return self._info.rows
+
+    def phases(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns tuple (counts (n_phases, channels), info (n_phases), assay row of each) of every phase present in the archive, in order."""
+        with self._lock:
+            _present = self._info.rows["present"].astype(bool)
+            _rows, _ = np.nonzero(_present)
+            return self._counts.rows[_present], self._info.rows[_present], _rows
+
+    def flush(self):
+        with self._lock:
+            if self._counts is not None:
+                self._counts.flush()
+                self._info.flush()
+
+    def _close(self):
+        if self._counts is not None:
+            self._counts.close()
+            self._info.close()
+        self._counts = None
+        self._info = None
+        self.path = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+class TimeResolvedSpectrumBuffer:
+    """Keeps every cooked spectrum packet of one assay phase (usually 1/second) as a row of a preallocated uint32 2D array, instead of only the last.
+    The instrument sends cumulative spectra: with store_deltas (default) each row holds the counts added since the previous packet, otherwise the cumulative counts.
+    Header values of each packet (live time, dead time, raw/valid counts etc.) are kept as rows of a COOKED_SPECTRUM_HEADER_DTYPE structured array.
+    Rows are preallocated for expected_packets, and capacity doubles if more arrive."""
+
+    def __init__(
+        self, expected_packets: int, channels: int = 2048, store_deltas: bool = True
+    ):
+        _capacity = max(int(expected_packets), 1)
+        self.store_deltas = store_deltas
+        self.length: int = 0
+        self._counts = np.zeros((_capacity, channels), dtype="<u4")
+        self._headers = np.zeros(_capacity, dtype=COOKED_SPECTRUM_HEADER_DTYPE)
+        # last cumulative spectrum, that deltas are taken from
+        self._last = np.zeros(channels, dtype="<u4")
+
+    def append(self, spectrum: CookedSpectrum):
+        if self.length == len(self._counts):
+            self._grow()
+        if self.store_deltas:
+            # uint32 arithmetic wraps, so cumulative() gives back the exact packets even if counts ever went down
+            np.subtract(spectrum.data, self._last, out=self._counts[self.length])
+            self._last[:] = spectrum.data
         else:
-            if (data is not None) and (datatype is not None):
-                printAndLog(data)
+            self._counts[self.length] = spectrum.data
+        self._headers[self.length] = spectrum.header
+        self.length += 1
+
+    def _grow(self):
+        _counts = np.zeros((len(self._counts) * 2, self._counts.shape[1]), "<u4")
+        _counts[: self.length] = self._counts[: self.length]
+        _headers = np.zeros(len(_counts), dtype=COOKED_SPECTRUM_HEADER_DTYPE)
+        _headers[: self.length] = self._headers[: self.length]
+        self._counts, self._headers = _counts, _headers
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def counts(self) -> np.ndarray:
+        """The stored rows (deltas or cumulative, see store_deltas), shape (packets, channels). A view, not a copy."""
+        return self._counts[: self.length]
+
+    @property
+    def headers(self) -> np.ndarray:
+        """Header values of each packet, e.g. buffer.headers["iValid_Cnts"]. A view, not a copy."""
+        return self._headers[: self.length]
+
+    def cumulative(self) -> np.ndarray:
+        """Returns the cumulative spectrum of each packet, as sent by the instrument, shape (packets, channels)."""
+        if self.store_deltas:
+            return np.cumsum(self.counts, axis=0, dtype="<u4")
+        return self.counts
+
+    def deltas(self) -> np.ndarray:
+        """Returns the counts added by each packet, shape (packets, channels)."""
+        if self.store_deltas:
+            return self.counts
+        return np.diff(
+            self.counts, axis=0, prepend=np.zeros((1, self.counts.shape[1]), "<u4")
+        )
+
+    def trim(self):
+        """Releases unused preallocated rows, e.g. once the phase is complete."""
+        self._counts = self._counts[: self.length].copy()
+        self._headers = self._headers[: self.length].copy()
+
+
+def startTimeResolvedPhase():
+    """If 'Keep Time-Resolved Spectra' is on, starts a new TimeResolvedSpectrumBuffer for the current phase, sized for its length (s)."""
+    if doKeepTimeResolvedSpectra_var.get():
+        # usually 1 packet/second, and a few extra in case
+        pxrf.current_timeresolved_buffer = TimeResolvedSpectrumBuffer(
+            pxrf.instr_currentphaselength_s + 5, pxrf.instr_totalspecchannels
+        )
+    else:
+        pxrf.current_timeresolved_buffer = None
+
+
+def endTimeResolvedPhase():
+    """Adds the current phase's time-resolved buffer (if any) to the current assay's."""
+    if pxrf.current_timeresolved_buffer is not None:
+        pxrf.current_timeresolved_buffer.trim()
+        pxrf.instr_currentassaytimeresolved.append(pxrf.current_timeresolved_buffer)
+        pxrf.current_timeresolved_buffer = None
 
-        # statusUpdateCheck()
-        # try:
-        #     print(f"{sys. getsizeof(assay_catalogue)=}")
-        # except:
-        #     pass
-        time.sleep(0.1)
-
-
-def setSpectrum(data):
-    _a = {}
-    (
-        _a["fEVPerChannel"],
-        _a["iTDur"],
-        _a["iRaw_Cnts"],
-        _a["iValid_Cnts"],
-        _a["iADur"],
-        _a["iADead"],
-        _a["iAReset"],
-        _a["iALive"],
-        _a["iPacket_Cnt"],
-        _a["Det_Temp"],
-        _a["Amb_Temp"],
-        _a["iRaw_Cnts_Acc"],
-        _a["iValid_Cnts_Acc"],
-        _a["fTDur"],
-        _a["fADur"],
-        _a["fADead"],
-        _a["fAReset"],
-        _a["fALive"],
-        _a["lPacket_Cnt"],
-        _a["iFilterNum"],
-        _a["fltElement1"],
-        _a["fltThickness1"],
-        _a["fltElement2"],
-        _a["fltThickness2"],
-        _a["fltElement3"],
-        _a["fltThickness3"],
-        _a["sngHVADC"],
-        _a["sngCurADC"],
-        _a["Toggle"],
-    ) = struct.unpack(
-        "<f4xLLL4xLLLL6xH78xhHxxLL8xfffff4xLihhhhhhffxxbxxxxx", data[0:208]
-    )
-    # originally, struct.unpack('<f4xLLL4xLLLLLHH78xhH2xLLLLfffffLLihhhhhhff2xbbbbbb', data[0:208])
-    txt = _a
-    _a["data"] = list(map(lambda x: x[0], struct.iter_unpack("<L", data[208:])))
+
+def setSpectrum(data) -> tuple[CookedSpectrum, list[CookedSpectrum]]:
+    _spectrum = CookedSpectrum.from_packet(data)
 
     # GET CURRENT TEMPS  - I think this is not working properly, or needs some offsets or something to be taken into account?
     # Operating under the assumption that the det temp is actually double what it should be (often reading -54 degrees) and ambient temp value is actually 1/10 of a degree F, (e.g. reading 1081 instead of 108.1)
-    pxrf.instr_currentambtemp = float(_a["Amb_Temp"])
+    pxrf.instr_currentambtemp = float(_spectrum["Amb_Temp"])
     pxrf.instr_currentambtemp_F = pxrf.instr_currentambtemp
     pxrf.instr_currentambtemp = round(
         (((pxrf.instr_currentambtemp / 10) - 32) * (5 / 9)), 2
     )
     # shifts decimal place one left (see above comment) and converts to C from F, then rounds to 2 dp.
-    pxrf.instr_currentdettemp = float(_a["Det_Temp"])
+    pxrf.instr_currentdettemp = float(_spectrum["Det_Temp"])
     pxrf.instr_currentdettemp = round((pxrf.instr_currentdettemp / 2), 2)
     # halves and rounds (halves because see above comment)
     # printAndLog(f'Temps: Detector {instr_currentdettemp}°C, Ambient {instr_currentambtemp}°F')
 
-    e1 = elementZtoSymbol(int(txt["fltElement1"]))
-    e2 = elementZtoSymbol(int(txt["fltElement2"]))
-    e3 = elementZtoSymbol(int(txt["fltElement3"]))
-
-    if txt["fltThickness1"] == 0:
-        t1 = ""
-    else:
-        t1 = f":{txt['fltThickness1']}\u03bcm"
-
-    if txt["fltThickness2"] == 0:
-        t2 = ""
-    else:
-        t2 = f":{txt['fltThickness2']}\u03bcm"
-        t1 = f"{t1}/"
-
-    if txt["fltThickness3"] == 0:
-        t3 = ""
-    else:
-        t3 = f":{txt['fltThickness3']}\u03bcm"
-        t2 = f"{t2}/"
-
-    txt["fltDescription"] = f"({e1}{t1}{e2}{t2}{e3}{t3})"
-    if txt["fltDescription"] == "()":
-        txt["fltDescription"] = "(No Filter)"
-
     idx = len(pxrf.current_working_spectra) - 1
-    if idx < 0 or _a["lPacket_Cnt"] == 1:
-        pxrf.current_working_spectra.append(_a)
+    if idx < 0 or _spectrum["lPacket_Cnt"] == 1:
+        pxrf.current_working_spectra.append(_spectrum)
     else:
-        pxrf.current_working_spectra[idx] = _a
+        pxrf.current_working_spectra[idx] = _spectrum
     # plotSpectra(spectra[-1]['data'])
-    return txt, pxrf.current_working_spectra
+    return _spectrum, pxrf.current_working_spectra
 
 
 def setSpecEnergy(data):
@@ -1965,73 +4059,195 @@ def setSpecEnergy(data):
     return pxrf.current_working_specenergies
 
 
+@lru_cache(maxsize=64)
+def getEnergyAxis(
+    ev_channel_start: float, ev_per_channel: float, channels: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns tuple (energies in eV, energies in keV) of each spectrum channel, for a spectrum's fEVChanStart, fEVPerChannel and number of channels.
+    Arrays are cached and shared by everything that needs them (plotting, sanity checks, CSV export), so are read-only - copy them before modifying.
+    eV values are accumulated channel by channel from the start energy (as the spectrum CSV export always has), keV is eV / 1000."""
+    _ev = np.cumsum([ev_channel_start] + [ev_per_channel] * (channels - 1))
+    _kev = _ev / 1000
+    _ev.flags.writeable = False
+    _kev.flags.writeable = False
+    return _ev, _kev
+
+
+def getSpectrumEnergyAxis(
+    specenergy: dict, channels: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the cached (eV, keV) energy axis for a spectrum, given its specenergy dict (fEVChanStart and fEVPerChannel) and number of channels."""
+    return getEnergyAxis(
+        specenergy["fEVChanStart"], specenergy["fEVPerChannel"], channels
+    )
+
+
 def normaliseSpectrum(spectrum_counts, time_in_milliseconds):
-    """Normalises 1 Spectrum by time and area(total counts). spectrum_counts should be list of counts (usually spectrum['data']) and spectrum time in ms (usually spectrum['fTDur']). Returns a normalised counts list that should probably be stored in spectrum['normalised_data']"""
+    """Normalises 1 Spectrum by time and area(total counts). spectrum_counts should be array (or list) of counts (usually spectrum['data']) and spectrum time in ms (usually spectrum['fTDur']). Returns a normalised counts array that should probably be stored in spectrum['normalised_data']"""
+    return normaliseSpectra(np.asarray(spectrum_counts)[np.newaxis, :])[0]
+
+
+def normaliseSpectra(spectra_counts, times_in_milliseconds=None) -> np.ndarray:
+    """Normalises a block of spectra (2D array, one spectrum of counts per row, e.g. (n_spectra, 2048)) by time and area(total counts) in one go.
+    Dividing by time cancels out of the area normalisation, so the times don't change the result and are optional.
+    Each row is counts / sum of counts * 100 (effective percentage, sum of all bins roughly equals 100), computed in float64 -
+    this gives the same floats as doing the division in Decimal. Rows with no counts at all are left as zeros."""
+    _counts = np.asarray(spectra_counts, dtype=np.float64)
+    _areas = _counts.sum(axis=1, keepdims=True)
+    _normalised = np.zeros_like(_counts)
+    np.divide(_counts, _areas, out=_normalised, where=_areas > 0)
+    _normalised *= 100
+    return _normalised
+
+
+def backfillNormalisedSpectra(spectra: list) -> int:
+    """Calculates normalised_data for every spectrum in the list (e.g. an assay's phases, or every spectrum in the catalogue) that doesn't have it yet, as one batch.
+    Returns the number of spectra normalised."""
+    _pending = [_s for _s in spectra if "normalised_data" not in _s]
+    # spectra can only be batched together if they have the same number of channels
+    _by_channels = {}
+    for _spectrum in _pending:
+        _by_channels.setdefault(len(_spectrum["data"]), []).append(_spectrum)
+    for _spectra in _by_channels.values():
+        _normalised = normaliseSpectra(np.stack([_s["data"] for _s in _spectra]))
+        for _spectrum, _row in zip(_spectra, _normalised):
+            _spectrum["normalised_data"] = _row
+    return len(_pending)
+
+
+def onNormaliseSpectraToggled():
+    """Called when the 'Normalise Spectra' option is changed. When turned on, normalises any spectra already in the assay catalogue
+    (assays taken while it was off) so they can be plotted normalised straight away.
+    Only assays loaded in memory need it, spectra loaded from the catalogue on disk are normalised when used."""
+    if not doNormaliseSpectra_var.get():
+        return
+    try:
+        _count = backfillNormalisedSpectra(
+            [_s for _assay in pxrf.assay_catalogue.cached() for _s in _assay.spectra]
+        )
+    except Exception as e:
+        printAndLog(f"Could not normalise existing spectra. ({repr(e)})", "ERROR")
+        return
+    if _count:
+        printAndLog(f"Normalised {_count} existing spectra.")
 
-    time_in_seconds = time_in_milliseconds / 1000
 
-    # normalise first by time, by dividing all bins by number of seconds spectrum was taken over
-    counts_per_second_spectrum = [
-        Decimal(b) / Decimal(time_in_seconds) for b in spectrum_counts
-    ]
+@dataclass
+class VitalsSnapshot:
+    packets: int  # number of packets the statistics are over (this phase)
+    latest: dict[str, float]  # values from the last packet, keyed by VITALS_METRICS
+    mean: dict[str, float]
+    std: dict[str, float]  # sample standard deviation (0 until 2 packets)
 
-    # then normalise by area, by dividing all bins by the sum of all bins
-    area_normalised_spectrum = [
-        Decimal(b) / Decimal(sum(counts_per_second_spectrum))
-        for b in counts_per_second_spectrum
-    ]
 
-    # Return as floats (not decimals) and multiply by 100 to get effective percentage (sum of all counts roughly equals 100)
-    float_area_normalised_spectrum = [float(b) * 100 for b in area_normalised_spectrum]
-
-    return float_area_normalised_spectrum
-
-
-def updateCurrentVitalsDisplay(spectra=None, override=None):
-    """given a spectra list dump from phase in progress (usually 1/second is sent), update the relevant display widget with the latest values"""
-    if not override:
-        # testing live counts per second readout
-        instantaneous_iRaw_Cnts = int(spectra[-1]["iRaw_Cnts"])
-        instantaneous_iValid_Cnts = int(spectra[-1]["iValid_Cnts"])
-        instantaneous_iADur = int(spectra[-1]["iADur"])
-        # instantaneous_iTDur = int(spectra[-1]["iTDur"])
-        # instantaneous_iALive = int(spectra[-1]["iALive"])
-        # instantaneous_iAReset = int(spectra[-1]["iAReset"])
-        instantaneous_sngHVADC = round(float(spectra[-1]["sngHVADC"]))
-        instantaneous_sngCurADC = round(float(spectra[-1]["sngCurADC"]), 2)
-
-        # as per BIT decomp:
-        # input counts per second seems to be (iRaw_Cnts / iADur) * 1000
-        # output counts per second seems to be (iValid_Cnts / iADur) * 1000
-        # dead % seems to be ((iRaw_Cnts - iValid_Cnts) / iRaw_Cnts) * 100
-
-        # print values each time this func is called. only temporary!
-        # printAndLog(f"Counts/Sec: {int((instantaneous_iRaw_Cnts / instantaneous_iADur) * 1000)}, Deadtime:{(((instantaneous_iRaw_Cnts - instantaneous_iValid_Cnts) / instantaneous_iRaw_Cnts) * 100):6.2f}%")
-        # printAndLog(f'{txt["sngHVADC"]}kV, {round(float(txt["sngCurADC"]),2)}\u03bcA')
-        # try-excepts in case of assay failure, can't divide by zero
-        try:
-            instr_countrate_stringvar.set(
-                f"{int((instantaneous_iRaw_Cnts / instantaneous_iADur) * 1000)}cps"
+class VitalsEngine:
+    """Running statistics of instrument vitals (input/output count rate, dead time %, tube kV and uA, detector temp) over each assay phase.
+    update() takes each cooked spectrum packet in O(1) (Welford's algorithm, all metrics at once). Thread-safe: updated from the listen loop,
+    read with snapshot() at whatever rate the UI wants. end_phase() closes off the phase and keeps its summary in phase_summaries."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phase_summaries: list[dict] = []
+        self._reset_phase()
+
+    def _reset_phase(self):
+        self._packets = 0
+        self._latest = np.zeros(len(VITALS_METRICS))
+        self._mean = np.zeros(len(VITALS_METRICS))
+        self._m2 = np.zeros(len(VITALS_METRICS))
+        self._last_spectrum: CookedSpectrum = None
+
+    def start_assay(self):
+        """Clears all statistics and phase summaries, for a new assay."""
+        with self._lock:
+            self.phase_summaries = []
+            self._reset_phase()
+
+    def update(self, spectrum: CookedSpectrum):
+        """Adds one cooked spectrum packet (usually 1/second). Count values in each packet are for that packet's acquisition time (iADur) only."""
+        _raw = spectrum["iRaw_Cnts"]
+        _valid = spectrum["iValid_Cnts"]
+        _adur_ms = spectrum["iADur"]
+        # as per BIT decomp: input cps = (iRaw_Cnts / iADur) * 1000, output cps = (iValid_Cnts / iADur) * 1000, dead % = ((iRaw_Cnts - iValid_Cnts) / iRaw_Cnts) * 100
+        _x = np.array(
+            (
+                (_raw / _adur_ms) * 1000 if _adur_ms > 0 else 0,
+                (_valid / _adur_ms) * 1000 if _adur_ms > 0 else 0,
+                ((_raw - _valid) / _raw) * 100 if _raw > 0 else 0,
+                spectrum["sngHVADC"],
+                spectrum["sngCurADC"],
+                spectrum["Det_Temp"]
+                / 2,  # det temp seems to be double what it should be, see setSpectrum
             )
-        except Exception as e:
-            print(f"Count rate stringvar could not be calculated. ({repr(e)})")
-            instr_countrate_stringvar.set("0cps")
-        try:
-            instr_deadtime_stringvar.set(
-                f"{(((instantaneous_iRaw_Cnts - instantaneous_iValid_Cnts) / instantaneous_iRaw_Cnts) * 100):6.2f}%dead"
+        )
+        with self._lock:
+            self._packets += 1
+            _delta = _x - self._mean
+            self._mean += _delta / self._packets
+            self._m2 += _delta * (_x - self._mean)
+            self._latest = _x
+            self._last_spectrum = spectrum
+
+    def snapshot(self) -> VitalsSnapshot:
+        with self._lock:
+            _std = (
+                np.sqrt(self._m2 / (self._packets - 1))
+                if self._packets > 1
+                else np.zeros(len(VITALS_METRICS))
+            )
+            return VitalsSnapshot(
+                packets=self._packets,
+                latest=dict(zip(VITALS_METRICS, self._latest.tolist())),
+                mean=dict(zip(VITALS_METRICS, self._mean.tolist())),
+                std=dict(zip(VITALS_METRICS, _std.tolist())),
             )
-        except Exception as e:
-            print(f"Dead time % stringvar could not be calculated. ({repr(e)})")
-            instr_deadtime_stringvar.set("0%dead")
 
+    def end_phase(self):
+        """Adds a summary of the current phase to phase_summaries (if any packets were received in it), and starts a new phase.
+        summary keys: packets, live_time_s, real_time_s (accumulated over the phase, from its last packet), then {metric}_mean and {metric}_std for each of VITALS_METRICS."""
+        _snapshot = self.snapshot()
+        with self._lock:
+            if self._packets:
+                _summary = {
+                    "packets": _snapshot.packets,
+                    "live_time_s": self._last_spectrum["fALive"] / 1000,
+                    "real_time_s": self._last_spectrum["fADur"] / 1000,
+                }
+                for _metric in VITALS_METRICS:
+                    _summary[f"{_metric}_mean"] = _snapshot.mean[_metric]
+                    _summary[f"{_metric}_std"] = _snapshot.std[_metric]
+                self.phase_summaries.append(_summary)
+            self._reset_phase()
+
+
+def updateCurrentVitalsDisplay(snapshot: VitalsSnapshot = None):
+    """Updates the count rate, dead time and tube voltage/current display widgets with the latest values of a VitalsSnapshot, or zeros if none given."""
+    if snapshot is not None and snapshot.packets:
+        _latest = snapshot.latest
+        instr_countrate_stringvar.set(f"{int(_latest['input_cps'])}cps")
+        instr_deadtime_stringvar.set(f"{_latest['dead_time_percent']:6.2f}%dead")
         instr_tubevoltagecurrent_stringvar.set(
-            f"{instantaneous_sngHVADC}kV / {instantaneous_sngCurADC}\u03bcA"
+            f"{round(_latest['voltage_kV'])}kV / {round(_latest['current_uA'], 2)}\u03bcA"
         )
     else:
+        # update current values to 0 if tube is off
         instr_countrate_stringvar.set("0cps")
         instr_deadtime_stringvar.set("0%dead")
         instr_tubevoltagecurrent_stringvar.set("0kV / 0\u03bcA")
-        # update current values if tube is off to 0/0
+
+
+def publishVitals():
+    """Shows the latest vitals from pxrf.vitals every VITALS_PUBLISH_INTERVAL_MS, while an assay is running and 'Display Count Rate and Dead Time %' is on. Runs on the main thread."""
+    if thread_halt:
+        return
+    try:
+        if doDisplayVitals_var.get() and pxrf.instr_assayisrunning:
+            updateCurrentVitalsDisplay(pxrf.vitals.snapshot())
+        else:
+            updateCurrentVitalsDisplay()
+    except Exception as e:
+        print(f"Vitals display could not be updated. ({repr(e)})")
+    gui.after(VITALS_PUBLISH_INTERVAL_MS, publishVitals)
 
 
 def completeAssay(
@@ -2043,50 +4259,42 @@ def completeAssay(
     assay_specenergies: list,
     assay_legends: list,
     assay_finaltemps: str,
+    assay_timeresolved: list = None,
+    assay_vitals: list = None,
 ):
     t = time.localtime()
     assay_sane = "N/A"
+    # store the phases' spectra contiguously, as they are kept in the catalogue
+    packSpectra(assay_spectra)
 
     if doNormaliseSpectra_var.get():
-        for i in range(len(assay_spectra)):
-            if "normalised_data" in assay_spectra[i]:
-                # Only calculate normalised spectra if it hasn't been done already
-                pass
-            else:
-                assay_spectra[i]["normalised_data"] = normaliseSpectrum(
-                    assay_spectra[i]["data"], assay_spectra[i]["fTDur"]
-                )
-
-    # perform assay sanity checks
-    any_phases_failed_sanity_check = False
-    if doSanityCheckSpectra_var.get():
-        for i in range(len(assay_spectra)):
-            _counts = assay_spectra[i]["data"]
-            _sourcevoltage = assay_spectra[i]["sngHVADC"]
-            _evchannelstart = assay_specenergies[i][
-                "fEVChanStart"
-            ]  # starting ev of spectrum channel 1
-            _evperchannel = assay_specenergies[i]["fEVPerChannel"]
-            # Use ev per channel etc for bins instead of basic 20
-            _energies = pxrf.specchannelsarray * _evperchannel
-            _energies = _energies + _evchannelstart
-            _energies = _energies / 1000  # TO GET keV instead of eV
-            if not sanityCheckSpectrum_SumMethod(
-                spectrum_counts=_counts,
-                spectrum_energies=_energies,
-                source_voltage_in_kV=_sourcevoltage,
-            ):
-                any_phases_failed_sanity_check = True
-                printAndLog(
-                    f"SPECTRA SANITY CHECK FAILED: Assay # {pxrf.assay_catalogue_num}, Phase {i+1}. Check Spectrum for Possible Incorrect Voltage or Zero-peak-only! Note: This function has no way of checking for sum peaks or low-fluorescence samples, so false positives may occur.",
-                    "WARNING",
-                    notify_slack=True,
-                )
-                break
-        if any_phases_failed_sanity_check:
-            assay_sane = "FAIL"
-        else:
+        # Only calculates normalised spectra if it hasn't been done already
+        backfillNormalisedSpectra(assay_spectra)
+
+    # perform assay sanity checks, all phases at once
+    if doSanityCheckSpectra_var.get() and assay_spectra:
+        _passed, _, _reasons = sanityCheckSpectra(
+            np.stack([_s["data"] for _s in assay_spectra]),
+            # Use ev per channel etc for bins instead of basic 20, in keV
+            np.stack(
+                [
+                    getSpectrumEnergyAxis(_e, len(_s["data"]))[1]
+                    for _s, _e in zip(assay_spectra, assay_specenergies)
+                ]
+            ),
+            [_s["sngHVADC"] for _s in assay_spectra],
+        )
+        if _passed.all():
             assay_sane = "PASS"
+        else:
+            assay_sane = "FAIL"
+            i = int(np.argmin(_passed))  # first failed phase
+            printAndLog(f"FAILED Sanity Check Details: {_reasons[i]}", "WARNING")
+            printAndLog(
+                f"SPECTRA SANITY CHECK FAILED: Assay # {pxrf.assay_catalogue_num}, Phase {i+1}. Check Spectrum for Possible Incorrect Voltage or Zero-peak-only! Note: This function has no way of checking for sum peaks or low-fluorescence samples, so false positives may occur.",
+                "WARNING",
+                notify_slack=True,
+            )
 
     # get notes / info fields data for notes column of assay table
     assay_notes_list = []
@@ -2119,6 +4327,8 @@ def completeAssay(
         temps=assay_finaltemps,
         note=assay_note,
         sanity_check_passed=assay_sane,
+        timeresolved=assay_timeresolved or None,
+        vitals=assay_vitals or None,
     )
 
     # increment catalogue index number for next assay
@@ -2127,8 +4337,34 @@ def completeAssay(
     # make new 'assay' var with results, spectra, time etc
     # assay = [assay_catalogue_num, assay_time, assay_application, assay_results, assay_spectra, assay_specenergies]
 
-    # add assay with all relevant info to catalogue for later recall
+    try:
+        labelPeaks([newassay])
+        _identified = newassay.peaks.loc[
+            newassay.peaks["Type"] == "Emission Line", "Element"
+        ].unique()
+        if len(_identified):
+            printAndLog(
+                f"Assay # {newassay.index} peaks identified: {', '.join(_identified)}"
+            )
+    except Exception as e:
+        printAndLog(f"Peak search failed. ({repr(e)})", "ERROR")
+
+    # spectra are only kept compressed from now on (the arrays stay cached for plotting), so the catalogue stores the same compressed copy
+    try:
+        compressAssaySpectra(newassay)
+    except Exception as e:
+        printAndLog(f"Assay spectra could not be compressed. ({repr(e)})", "ERROR")
+
+    # add assay with all relevant info to catalogue for later recall (stored to disk, so everything about it must be done by now)
     pxrf.assay_catalogue.append(newassay)
+    try:
+        pxrf.spectra_archive.append(newassay.spectra, newassay.specenergies)
+    except Exception as e:
+        printAndLog(f"Spectra could not be archived. ({repr(e)})", "ERROR")
+    try:
+        pxrf.roi_engine.update(pxrf.assay_catalogue)
+    except Exception as e:
+        printAndLog(f"ROI counts could not be calculated. ({repr(e)})", "ERROR")
 
     # add entry to assays table
     assaysTable.insert(
@@ -2158,23 +4394,41 @@ def completeAssay(
         f"Assay # {newassay.index} processed sucessfully ({newassay.time_elapsed})"
     )
 
+    try:
+        pxrf.results_store.add(newassay, pxrf.instr_serialnumber)
+    except Exception as e:
+        printAndLog(
+            f"Assay results could not be added to the results store. ({repr(e)})",
+            "ERROR",
+        )
     if enableautoassayCSV_var.get() == "on":
         saveAssayToCSV(newassay)
     if enableresultsCSV_var.get() == "on":
         addAssayToResultsCSV(newassay)
+        try:
+            saveROITableToCSV()
+        except Exception as e:
+            printAndLog(f"ROI table could not be saved. ({repr(e)})", "ERROR")
+    if enableautoassayCSV_var.get() == "on" and newassay.timeresolved:
+        try:
+            saveTimeResolvedSpectra(newassay)
+        except Exception as e:
+            printAndLog(
+                f"Assay # {newassay.index} time-resolved spectra could not be saved. ({repr(e)})",
+                "ERROR",
+            )
 
 
 def onInstrDisconnect():
     messagebox.showwarning(
         "Instrument Disconnected",
-        "Error: Connection to the XRF instrument has been lost. The software will be closed, and a log file will be saved.",
+        "Error: Connection to the XRF instrument has been lost, and could not be re-established. The software will be closed, and a log file will be saved.",
     )
     printAndLog(
-        "Connection to the XRF instrument was unexpectedly lost. Software will shut down and a log will be saved.",
+        "Connection to the XRF instrument was unexpectedly lost and could not be re-established. Software will shut down and a log will be saved.",
         "ERROR",
     )
     onClosing(force=False)
-    # TODO implement reconnection logic
 
 
 # Functions for Widgets
@@ -2209,8 +4463,6 @@ def statusUpdateChecker():
             if button_assay.cget("state") == "normal":
                 button_assay.configure(state="disabled")
 
-            updateCurrentVitalsDisplay(override=True)
-
         elif not pxrf.instr_isarmed:
             danger_stringvar.set("Not Armed!")
             status_label.configure(text_color=WHITEISH, fg_color=("#939BA2", "#454D50"))
@@ -2219,8 +4471,6 @@ def statusUpdateChecker():
             if button_assay.cget("state") == "normal":
                 button_assay.configure(state="disabled")
 
-            updateCurrentVitalsDisplay(override=True)
-
         elif pxrf.instr_assayisrunning:
             danger_stringvar.set("WARNING: X-RAYS")
             status_label.configure(text_color=WHITEISH, fg_color="#D42525")
@@ -2269,7 +4519,6 @@ def statusUpdateChecker():
             xraysonbar.configure(progress_color=("#939BA2", "#454D50"))
             if button_assay.cget("state") == "disabled":
                 button_assay.configure(state="normal")
-            updateCurrentVitalsDisplay(override=True)
 
         # print(f'assay is running: {instr_assayisrunning}')
         # print(f'instr is armed: {instr_isarmed}')
@@ -2356,13 +4605,8 @@ def plotSpectrum(spectrum, specenergy, colour, spectrum_legend):
         counts = spectrum["data"]
         spectra_ax.set_ylabel("Counts (Total)")
 
-    ev_channel_start = specenergy["fEVChanStart"]  # starting ev of spectrum channel 1
-    ev_per_channel = specenergy["fEVPerChannel"]
-
-    # Use ev per channel etc for bins instead of basic
-    bins = pxrf.specchannelsarray * ev_per_channel
-    bins = bins + ev_channel_start
-    bins = bins / 1000  # TO GET keV instead of eV
+    # Use ev per channel etc for bins instead of basic, in keV
+    _, bins = getSpectrumEnergyAxis(specenergy, len(counts))
 
     (plottedspectrum,) = spectra_ax.plot(
         bins, counts, color=colour, linewidth=1, label=spectrum_legend
@@ -2531,13 +4775,7 @@ def startPlotClickListener():  # Starts the listener for click on plot so it isn
 
 
 def getNearbyEnergies(energy, qty):
-    global energies_df
-    global energiesfirsttime
-    if energiesfirsttime:
-        energies_df = pd.read_csv(energiescsvpath)
-        energiesfirsttime = False
-
-    closest = energies_df.iloc[(energies_df["Energy"] - energy).abs().argsort()[:qty]]
+    closest = getEnergyLineIndex().nearest(energy, qty)
 
     closest["Element"] = closest["Element"].apply(elementSymboltoName)
     closest["Line"] = closest["Line"].str.replace("a", "\u03b1")  # replace a with alpha
@@ -2593,6 +4831,7 @@ def sanityCheckSpectrum_SumMethod(
     spectrum_counts: list[int],
     spectrum_energies: list[float],
     source_voltage_in_kV: int,
+    threshold_percent: float = SANITY_CHECK_THRESHOLD_PERCENT,
 ) -> bool:
     """Checks that a spectrum is 'sensible', and that the communicated voltage is accurate.
     This is required because of a 'voltage bug' in Bruker pXRF instrument software (or NSI tube firmware),
@@ -2607,33 +4846,519 @@ def sanityCheckSpectrum_SumMethod(
     `spectrum_energies` is a ordered list of 2048 floats representing the energy (keV) of each channel/bin of the detector.\n
     `source_voltage_in_kV` is the voltage of the source for the given spectrum, AS REPORTED BY THE OEM API AND IN THE PDZ FILE.\n
     Returns TRUE if sanity check passed, return FALSE if not.
-    NOW ALSO CHECKS FOR NULL SPECTRA, i.e. zero-peak only.
+    NOW ALSO CHECKS FOR NULL SPECTRA, i.e. zero-peak only. see sanityCheckSpectra to check many spectra at once.
     """
-    counts_sum = np.sum(spectrum_counts)
-    two_percent_counts_threshold = counts_sum * 0.02
-    sum_counting = 0
-    for i in range(len(spectrum_counts) - 1, 0, -1):
-        sum_counting += spectrum_counts[i]
-        if sum_counting > two_percent_counts_threshold:
-            abovethreshold_index = i
-            break
-    if spectrum_energies[abovethreshold_index] > source_voltage_in_kV:
-        # this point should be LOWER than source voltage always.
-        printAndLog(
-            f"FAILED Sanity Check Details: The 2%-total-counts threshold energy ({spectrum_energies[abovethreshold_index]:.2f}kV) was HIGHER than the Reported source voltage ({source_voltage_in_kV}kV).",
-            "WARNING",
+    _passed, _, _reasons = sanityCheckSpectra(
+        [spectrum_counts], spectrum_energies, [source_voltage_in_kV], threshold_percent
+    )
+    if not _passed[0]:
+        printAndLog(f"FAILED Sanity Check Details: {_reasons[0]}", "WARNING")
+    return bool(_passed[0])
+
+
+def sanityCheckSpectra(
+    spectra_counts,
+    spectra_energies,
+    source_voltages_in_kV,
+    threshold_percent: float = SANITY_CHECK_THRESHOLD_PERCENT,
+) -> tuple[np.ndarray, np.ndarray, list[str]]:
+    """Runs the sum-method sanity check (see sanityCheckSpectrum_SumMethod) on a block of spectra at once, e.g. all phases of an assay, or a whole session.
+    `spectra_counts` is 2D, one spectrum of counts per row (n_spectra, channels). `spectra_energies` is the keV of each channel,
+    either one row shared by all spectra or one row per spectrum. `source_voltages_in_kV` is one reported voltage per spectrum.
+    The threshold channel is found from the reverse cumulative sum of each spectrum (counts from that channel to the end of the spectrum):
+    the highest channel (excluding channel 0) above which more than threshold_percent of the total counts lie.
+    Returns tuple (passed bool array, threshold energy (keV) array, reasons list) - reasons are "" for spectra that passed.
+    Spectra with no counts above channel 0 (e.g. all zeros) fail as null spectra, with a threshold energy of nan."""
+    _counts = np.asarray(spectra_counts)
+    _energies = np.broadcast_to(spectra_energies, _counts.shape)
+    _voltages = np.asarray(source_voltages_in_kV, dtype=np.float64)
+    _thresholds = _counts.sum(axis=1, dtype=np.int64) * (threshold_percent / 100)
+    # counts from each channel to the end of the spectrum, highest channel first (channel 0 is never reached)
+    _reverse_cumsum = np.cumsum(_counts[:, :0:-1], axis=1, dtype=np.int64)
+    # rows are non-decreasing, so the first crossing is where searchsorted(row, threshold, side="right") would insert
+    _crossed = _reverse_cumsum > _thresholds[:, np.newaxis]
+    _found = _crossed.any(axis=1)
+    _threshold_channels = (_counts.shape[1] - 1) - _crossed.argmax(axis=1)
+    _threshold_energies = np.where(
+        _found,
+        np.take_along_axis(_energies, _threshold_channels[:, np.newaxis], axis=1)[:, 0],
+        np.nan,
+    )
+    _too_high = _found & (_threshold_energies > _voltages)
+    _too_low = ~_found | (_threshold_energies < 1)
+    _passed = ~(_too_high | _too_low)
+    _reasons = []
+    for _i in range(len(_counts)):
+        if _too_high[_i]:
+            _reasons.append(
+                f"The {threshold_percent:g}%-total-counts threshold energy ({_threshold_energies[_i]:.2f}kV) was HIGHER than the Reported source voltage ({source_voltages_in_kV[_i]}kV)."
+            )
+        elif not _found[_i]:
+            _reasons.append(
+                "The spectrum has no counts above the zero-peak channel. This occurs when the spectrum is null."
+            )
+        elif _too_low[_i]:
+            _reasons.append(
+                f"The {threshold_percent:g}%-total-counts threshold energy ({_threshold_energies[_i]:.2f}kV) was LOWER than 1 keV. This occurs when the spectrum is null (i.e. the only peak is the zero-peak.)"
+            )
+        else:
+            _reasons.append("")
+    return _passed, _threshold_energies, _reasons
+
+
+def sanityCheckSession(
+    assays: list[Assay], threshold_percent: float = SANITY_CHECK_THRESHOLD_PERCENT
+) -> list[str]:
+    """Re-runs the spectra sanity check over every phase of every given assay (e.g. a chunk of the session's, from pxrf.assay_catalogue) in one batch,
+    with the given threshold percentage. Updates each assay's sanity_check_passed ('PASS'/'FAIL', or 'N/A' if it has no spectra) and returns them in order.
+    Phases with a different number of channels to the first are checked in separate batches."""
+    _rows = [
+        (_a, _p)
+        for _a, _assay in enumerate(assays)
+        for _p in range(min(len(_assay.spectra), len(_assay.specenergies)))
+    ]
+    _by_channels = {}
+    for _a, _p in _rows:
+        _by_channels.setdefault(len(assays[_a].spectra[_p]["data"]), []).append(
+            (_a, _p)
+        )
+    _failures = {}  # assay index: (phase index, reason) of first failed phase
+    for _channels, _phases in _by_channels.items():
+        _spectra = [assays[_a].spectra[_p] for _a, _p in _phases]
+        _energies = np.stack(
+            [
+                getSpectrumEnergyAxis(assays[_a].specenergies[_p], _channels)[1]
+                for _a, _p in _phases
+            ]
         )
-        return False
-    elif spectrum_energies[abovethreshold_index] < 1:
-        # if the 2% threshold is below 1, then spectra is empty/null/zero-peak only.
-        printAndLog(
-            f"FAILED Sanity Check Details: The 2%-total-counts threshold energy ({spectrum_energies[abovethreshold_index]:.2f}kV) was LOWER than 1 keV. This occurs when the spectrum is null (i.e. the only peak is the zero-peak.)",
-            "WARNING",
+        _passed, _, _reasons = sanityCheckSpectra(
+            np.stack([_s["data"] for _s in _spectra]),
+            _energies,
+            [_s["sngHVADC"] for _s in _spectra],
+            threshold_percent,
+        )
+        for (_a, _p), _ok, _reason in zip(_phases, _passed, _reasons):
+            if not _ok and (_a not in _failures or _p < _failures[_a][0]):
+                _failures[_a] = (_p, _reason)
+    _checked = {_a for _a, _ in _rows}
+    for _a, _assay in enumerate(assays):
+        if _a not in _checked:
+            _assay.sanity_check_passed = "N/A"
+        elif _a in _failures:
+            _assay.sanity_check_passed = "FAIL"
+            printAndLog(
+                f"SPECTRA SANITY CHECK FAILED: Assay # {_assay.index}, Phase {_failures[_a][0]+1}. {_failures[_a][1]}",
+                "WARNING",
+            )
+        else:
+            _assay.sanity_check_passed = "PASS"
+    return [_assay.sanity_check_passed for _assay in assays]
+
+
+def recheckSessionSpectraSanity():
+    """Asks for a threshold percentage, then re-runs the spectra sanity check over all assays taken this session and updates the assays table."""
+    _dialog = ctk.CTkInputDialog(
+        text=f"Re-check spectra sanity for all assays this session.\nThreshold (% of total counts, default {SANITY_CHECK_THRESHOLD_PERCENT}):",
+        title="Re-check Session Spectra",
+    )
+    _input = _dialog.get_input()
+    if _input is None:
+        return
+    try:
+        _threshold_percent = (
+            float(_input) if _input.strip() else SANITY_CHECK_THRESHOLD_PERCENT
         )
-        return False
-    else:
-        # spectum passed checks
-        return True
+        if not 0 < _threshold_percent < 100:
+            raise ValueError("threshold must be between 0 and 100")
+    except ValueError as e:
+        printAndLog(f"Invalid sanity check threshold '{_input}'. ({repr(e)})", "ERROR")
+        return
+    _results = []
+    # in chunks, so only a chunk of the session's assays is loaded from the catalogue at once
+    for _start in range(0, len(pxrf.assay_catalogue), SANITY_RECHECK_CHUNK_ASSAYS):
+        _assays = pxrf.assay_catalogue[_start : _start + SANITY_RECHECK_CHUNK_ASSAYS]
+        _results += sanityCheckSession(_assays, _threshold_percent)
+        for _assay in _assays:
+            pxrf.assay_catalogue.save(_assay)
+            if assaysTable.exists(_assay.index):
+                assaysTable.set(
+                    _assay.index, "t_sanitycheck", _assay.sanity_check_passed
+                )
+        del _assays
+    printAndLog(
+        f"Session spectra re-checked at {_threshold_percent:g}% threshold: {_results.count('PASS')} passed, {_results.count('FAIL')} failed, {_results.count('N/A')} not checked.",
+        "INFO",
+    )
+
+
+def detectorFWHM_keV(energy_keV):
+    """Estimated detector resolution (FWHM, keV) at energy_keV (float or array), from ROI_DETECTOR_FWHM_MN_KA_EV.
+    FWHM^2 = electronic noise^2 + 2.355^2 * Fano factor (0.115) * energy per electron-hole pair in Si (3.85eV) * energy."""
+    _fano_ev2_per_ev = (2.355**2) * 0.115 * 3.85
+    _noise_ev2 = ROI_DETECTOR_FWHM_MN_KA_EV**2 - (_fano_ev2_per_ev * 5895)
+    return np.sqrt(_noise_ev2 + _fano_ev2_per_ev * np.asarray(energy_keV) * 1000) / 1000
+
+
+@dataclass
+class RegionOfInterest:
+    name: str  # name of the x-ray line in all_xray_lines, e.g. 'Fe Kα'
+    element: str  # element symbol, e.g. 'Fe'
+    line_keV: float  # energy of the line
+    low_keV: float  # window start
+    high_keV: float  # window end
+
+
+def defineROIs(
+    line_names: list[str] = None, width_fwhm: float = ROI_WIDTH_FWHM
+) -> list[RegionOfInterest]:
+    """Returns a RegionOfInterest for each of the named lines in all_xray_lines (default ROI_DEFAULT_LINES), e.g. ['Fe Kα', 'Zn Kα'],
+    each a window of +-(width_fwhm * detector FWHM at the line's energy). Raises ValueError for an unknown line name."""
+    _lines = {_name: (_symbol, _energy) for _symbol, _name, _energy in all_xray_lines}
+    _rois = []
+    for _name in line_names or ROI_DEFAULT_LINES:
+        if _name not in _lines:
+            raise ValueError(f"Unknown x-ray line '{_name}' (see all_xray_lines)")
+        _symbol, _energy = _lines[_name]
+        _half_width = width_fwhm * float(detectorFWHM_keV(_energy))
+        _rois.append(
+            RegionOfInterest(
+                _name, _symbol, _energy, _energy - _half_width, _energy + _half_width
+            )
+        )
+    return _rois
+
+
+def integrateROIs(
+    spectra_counts,
+    ev_channel_starts,
+    ev_per_channels,
+    rois: list[RegionOfInterest],
+) -> tuple[np.ndarray, np.ndarray]:
+    """Integrates every roi over every spectrum at once. spectra_counts is 2D (n_spectra, channels),
+    ev_channel_starts and ev_per_channels are each spectrum's calibration (fEVChanStart, fEVPerChannel) so spectra with different calibrations can be mixed.
+    Gross = sum of counts in the channels whose energy is within the roi. Net = gross - linear background under the roi,
+    estimated from the mean counts of the ROI_BACKGROUND_CHANNELS channels either side of it.
+    Returns tuple (gross, net), each (n_spectra, n_rois)."""
+    _counts = np.asarray(spectra_counts)
+    _channels = _counts.shape[1]
+    # cumulative counts with a leading 0, so the sum of channels a to b-1 is _cumulative[b] - _cumulative[a]
+    _cumulative = np.zeros((len(_counts), _channels + 1), dtype=np.int64)
+    np.cumsum(_counts, axis=1, out=_cumulative[:, 1:])
+    _start = np.asarray(ev_channel_starts, dtype=np.float64)[:, np.newaxis]
+    _per = np.asarray(ev_per_channels, dtype=np.float64)[:, np.newaxis]
+    _low = np.array([_r.low_keV for _r in rois]) * 1000
+    _high = np.array([_r.high_keV for _r in rois]) * 1000
+    # first channel in the roi, and first channel after it, for each spectrum and roi. channel i is at (start + i * per) eV
+    _a = np.clip(np.ceil((_low - _start) / _per), 0, _channels).astype(np.intp)
+    _b = np.clip(np.floor((_high - _start) / _per) + 1, 0, _channels).astype(np.intp)
+    _b = np.maximum(_a, _b)
+    _left = np.maximum(_a - ROI_BACKGROUND_CHANNELS, 0)
+    _right = np.minimum(_b + ROI_BACKGROUND_CHANNELS, _channels)
+
+    def _sum(a, b):
+        return np.take_along_axis(_cumulative, b, axis=1) - np.take_along_axis(
+            _cumulative, a, axis=1
+        )
+
+    _gross = _sum(_a, _b)
+    _background_per_channel = (
+        _sum(_left, _a) / np.maximum(_a - _left, 1)
+        + _sum(_b, _right) / np.maximum(_right - _b, 1)
+    ) / 2
+    _net = _gross - _background_per_channel * (_b - _a)
+    return _gross, _net
+
+
+class ROIEngine:
+    """Gross and net counts of each region of interest, for every phase of every assay in the catalogue, as a table with one row per assay phase.
+    update() integrates only the assays added since the last call (all of their phases in one integrateROIs call),
+    so element trends can be followed as assays complete (e.g. down a GeRDA core scan) without waiting for quantification. Thread-safe."""
+
+    def __init__(self, rois: list[RegionOfInterest] = None):
+        self._lock = threading.Lock()
+        self.set_rois(rois or defineROIs())
+
+    def set_rois(self, rois: list[RegionOfInterest]):
+        """Changes the regions of interest. The table is rebuilt from all assays on the next update()."""
+        with self._lock:
+            self.rois = rois
+            self._assays_integrated = 0
+            self._table = pd.DataFrame()
+
+    def update(self, assays: list[Assay]) -> int:
+        """Integrates the rois for assays not yet in the table (usually pxrf.assay_catalogue, which is only appended to). Returns the number of rows added."""
+        with self._lock:
+            _new = assays[self._assays_integrated :]
+            _phases = [
+                (_assay, _p)
+                for _assay in _new
+                for _p in range(min(len(_assay.spectra), len(_assay.specenergies)))
+            ]
+            _spectra = [_assay.spectra[_p] for _assay, _p in _phases]
+            _specenergies = [_assay.specenergies[_p] for _assay, _p in _phases]
+            # spectra can only be integrated together if they have the same number of channels
+            _by_channels = {}
+            for _i, _spectrum in enumerate(_spectra):
+                _by_channels.setdefault(len(_spectrum["data"]), []).append(_i)
+            _gross = np.zeros((len(_phases), len(self.rois)))
+            _net = np.zeros((len(_phases), len(self.rois)))
+            for _rows in _by_channels.values():
+                _gross[_rows], _net[_rows] = integrateROIs(
+                    np.stack([_spectra[_i]["data"] for _i in _rows]),
+                    [_specenergies[_i]["fEVChanStart"] for _i in _rows],
+                    [_specenergies[_i]["fEVPerChannel"] for _i in _rows],
+                    self.rois,
+                )
+            _columns = {
+                "Assay #": [_assay.index for _assay, _ in _phases],
+                "Phase": [_p + 1 for _, _p in _phases],
+                "Voltage (kV)": [_s["sngHVADC"] for _s in _spectra],
+                "Live Time (s)": [_s["fALive"] / 1000 for _s in _spectra],
+            }
+            for _r, _roi in enumerate(self.rois):
+                _columns[f"{_roi.name} Gross"] = _gross[:, _r]
+                _columns[f"{_roi.name} Net"] = _net[:, _r]
+            self._table = pd.concat(
+                [self._table, pd.DataFrame(_columns)], ignore_index=True
+            )
+            self._assays_integrated += len(_new)
+            return len(_phases)
+
+    def table(self) -> pd.DataFrame:
+        """Returns (a copy of) the roi table: Assay #, Phase, Voltage (kV), Live Time (s), then '{roi name} Gross' and '{roi name} Net' for each roi."""
+        with self._lock:
+            return self._table.copy()
+
+
+def saveROITableToCSV():
+    """Writes the roi table (pxrf.roi_engine) for this session to the ROIs CSV file in /Results, next to the results CSV. Only the new rows are written each time, like the results CSV (see IncrementalCSVWriter)."""
+    _roiFolderPath = rf"{os.getcwd()}/Results"
+    if not os.path.exists(_roiFolderPath):
+        os.makedirs(_roiFolderPath)
+    writeCSVIncrementally(
+        pxrf.roi_engine.table(),
+        rf"{_roiFolderPath}/S1Control_ROIs_{datetimeString}_{pxrf.instr_serialnumber}.csv",
+    )
+
+
+class EnergyLineIndex:
+    """The lines of energies.csv (emission lines, escape and sum peaks), sorted by energy into arrays, for looking up many energies at once with searchsorted."""
+
+    # preference when several lines are within tolerance of a peak: principal emission lines, then other emission lines, then escape and sum peaks.
+    _PRINCIPAL_LINES = ("Ka1", "La1")
+    _MAJOR_LINES = ("Ka2", "Kb1", "La2", "Lb1")
+
+    def __init__(self, path: str):
+        _df = pd.read_csv(path).sort_values("Energy", kind="stable")
+        self.energies: np.ndarray = _df["Energy"].to_numpy(dtype=np.float64)
+        self.elements: np.ndarray = _df["Element"].to_numpy()
+        self.lines: np.ndarray = _df["Line"].to_numpy()
+        self.types: np.ndarray = _df["Type"].to_numpy()
+        _emission = self.types == "Emission Line"
+        self.priorities: np.ndarray = np.select(
+            [
+                _emission & np.isin(self.lines, self._PRINCIPAL_LINES),
+                _emission & np.isin(self.lines, self._MAJOR_LINES),
+                _emission,
+                self.types == "Escape Peak (Si)",
+            ],
+            [0, 1, 2, 3],
+            default=4,
+        )
+
+    def _candidates(self, energies_keV, half_window: int) -> np.ndarray:
+        """indices of the half_window lines either side of each energy's position in the index, shape (n_energies, 2 * half_window), clipped to the index."""
+        _insert = np.searchsorted(self.energies, energies_keV)
+        _offsets = np.arange(-half_window, half_window)
+        return np.clip(_insert[:, np.newaxis] + _offsets, 0, len(self.energies) - 1)
+
+    def nearest(self, energy_keV: float, qty: int) -> pd.DataFrame:
+        """Returns the qty lines closest to energy_keV (closest first), as a DataFrame with columns Element, Line, Type, Energy."""
+        _candidates = np.unique(self._candidates(np.array([energy_keV]), qty)[0])
+        _closest = _candidates[
+            np.argsort(np.abs(self.energies[_candidates] - energy_keV), kind="stable")[
+                :qty
+            ]
+        ]
+        return self.frame(_closest)
+
+    def match(self, energies_keV, tolerances_keV, half_window: int = 16) -> np.ndarray:
+        """For each energy, returns the index of the best line within its tolerance (lowest priority, then closest), or -1 if none. Vectorised over energies."""
+        _energies = np.asarray(energies_keV, dtype=np.float64)
+        _candidates = self._candidates(_energies, half_window)
+        _distances = np.abs(self.energies[_candidates] - _energies[:, np.newaxis])
+        _within = _distances <= np.asarray(tolerances_keV)[..., np.newaxis]
+        # priority dominates, then distance (always < 1keV within tolerance)
+        _scores = np.where(_within, self.priorities[_candidates] + _distances, np.inf)
+        _best = np.argmin(_scores, axis=1)
+        return np.where(
+            _within.any(axis=1),
+            np.take_along_axis(_candidates, _best[:, np.newaxis], axis=1)[:, 0],
+            -1,
+        )
+
+    def frame(self, indices) -> pd.DataFrame:
+        """Returns the given lines as a DataFrame with columns Element, Line, Type, Energy."""
+        return pd.DataFrame(
+            {
+                "Element": self.elements[indices],
+                "Line": self.lines[indices],
+                "Type": self.types[indices],
+                "Energy": self.energies[indices],
+            }
+        )
+
+
+@lru_cache(maxsize=1)
+def getEnergyLineIndex() -> EnergyLineIndex:
+    """Returns the EnergyLineIndex of energies.csv, built on first use."""
+    return EnergyLineIndex(energiescsvpath)
+
+
+def findPeaks(
+    spectra_counts,
+    sigma_channels: float = PEAK_SEARCH_SIGMA_CHANNELS,
+    min_significance: float = PEAK_SEARCH_MIN_SIGNIFICANCE,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Finds peaks in a block of spectra (2D, one spectrum of counts per row) at once.
+    Each spectrum is convolved with a zero-sum negative second derivative of gaussian ('mexican hat') kernel, which is ~0 on a smooth background
+    and positive at peaks about as wide as sigma_channels. Its variance under poisson statistics is the counts convolved with the squared kernel,
+    so a peak is a local maximum of the response that is at least min_significance standard deviations above zero.
+    Returns tuple (spectrum row, peak position in channels (interpolated, float), significance), one entry per peak found."""
+    _counts = np.asarray(spectra_counts, dtype=np.float64)
+    _channels = _counts.shape[1]
+    _half = int(np.ceil(4 * sigma_channels))
+    _x = np.arange(-_half, _half + 1)
+    _kernel = (1 - (_x / sigma_channels) ** 2) * np.exp(
+        -0.5 * (_x / sigma_channels) ** 2
+    )
+    _kernel -= _kernel.mean()
+    _padded = np.pad(_counts, ((0, 0), (_half, _half)), mode="edge")
+    _response = np.empty_like(_counts)
+    _variance = np.empty_like(_counts)
+    # correlation as a sum of shifted slices, so there's no (n_spectra, channels, kernel) intermediate.
+    # the kernel is symmetric, so channels either side of the centre are added first and weighted together.
+    # done PEAK_SEARCH_BLOCK_ROWS spectra at a time.
+    for _r in range(0, len(_counts), PEAK_SEARCH_BLOCK_ROWS):
+        _block = _padded[_r : _r + PEAK_SEARCH_BLOCK_ROWS]
+        _block_response = _response[_r : _r + PEAK_SEARCH_BLOCK_ROWS]
+        _block_variance = _variance[_r : _r + PEAK_SEARCH_BLOCK_ROWS]
+        np.multiply(
+            _block[:, _half : _half + _channels], _kernel[_half], out=_block_response
+        )
+        np.multiply(
+            _block[:, _half : _half + _channels],
+            _kernel[_half] ** 2,
+            out=_block_variance,
+        )
+        _pair = np.empty_like(_block_response)
+        _weighted = np.empty_like(_block_response)
+        for _k in range(1, _half + 1):
+            np.add(
+                _block[:, _half - _k : _half - _k + _channels],
+                _block[:, _half + _k : _half + _k + _channels],
+                out=_pair,
+            )
+            _block_response += np.multiply(_pair, _kernel[_half + _k], out=_weighted)
+            _block_variance += np.multiply(
+                _pair, _kernel[_half + _k] ** 2, out=_weighted
+            )
+    _significance = _response / np.sqrt(np.maximum(_variance, 1))
+    _centre = _significance[:, 1:-1]
+    _is_peak = (
+        (_centre > _significance[:, :-2])
+        & (_centre >= _significance[:, 2:])
+        & (_centre >= min_significance)
+    )
+    _rows, _peak_channels = np.nonzero(_is_peak)
+    _peak_channels += 1
+    # refine position with a parabola through the response either side
+    _left = _response[_rows, _peak_channels - 1]
+    _middle = _response[_rows, _peak_channels]
+    _right = _response[_rows, _peak_channels + 1]
+    _curvature = _left - 2 * _middle + _right
+    _offsets = np.divide(
+        0.5 * (_left - _right),
+        _curvature,
+        out=np.zeros_like(_curvature),
+        where=_curvature < 0,
+    )
+    return (
+        _rows,
+        _peak_channels + np.clip(_offsets, -0.5, 0.5),
+        _significance[_rows, _peak_channels],
+    )
+
+
+def labelPeaks(assays: list[Assay]) -> list[pd.DataFrame]:
+    """Finds peaks in every phase of every given assay in one batch (see findPeaks), and labels each with the best matching line in energies.csv
+    (within PEAK_MATCH_TOLERANCE_FWHM of the detector resolution, see EnergyLineIndex.match). Sets and returns each assay's peaks:
+    a DataFrame with columns Phase, Energy (keV), Counts, Significance, Element, Line, Type, Line Energy (keV). Unmatched peaks have empty labels."""
+    _phases = [
+        (_a, _p)
+        for _a, _assay in enumerate(assays)
+        for _p in range(min(len(_assay.spectra), len(_assay.specenergies)))
+    ]
+    _spectra = [assays[_a].spectra[_p] for _a, _p in _phases]
+    _specenergies = [assays[_a].specenergies[_p] for _a, _p in _phases]
+    _rows, _positions, _significances = [], [], []
+    # spectra can only be searched together if they have the same number of channels
+    _by_channels = {}
+    for _i, _spectrum in enumerate(_spectra):
+        _by_channels.setdefault(len(_spectrum["data"]), []).append(_i)
+    for _indices in _by_channels.values():
+        _r, _c, _s = findPeaks(np.stack([_spectra[_i]["data"] for _i in _indices]))
+        _rows.append(np.asarray(_indices, dtype=np.intp)[_r])
+        _positions.append(_c)
+        _significances.append(_s)
+    _rows = np.concatenate(_rows) if _rows else np.zeros(0, dtype=np.intp)
+    _positions = np.concatenate(_positions) if _positions else np.zeros(0)
+    _significances = np.concatenate(_significances) if _significances else np.zeros(0)
+    _starts = np.array([_e["fEVChanStart"] for _e in _specenergies])[_rows]
+    _pers = np.array([_e["fEVPerChannel"] for _e in _specenergies])[_rows]
+    _energies = (_starts + _positions * _pers) / 1000
+    _keep = _energies >= PEAK_SEARCH_MIN_ENERGY_KEV
+    _rows, _positions, _significances, _energies = (
+        _rows[_keep],
+        _positions[_keep],
+        _significances[_keep],
+        _energies[_keep],
+    )
+    _index = getEnergyLineIndex()
+    _matches = _index.match(
+        _energies, PEAK_MATCH_TOLERANCE_FWHM * detectorFWHM_keV(_energies)
+    )
+    _labels = _index.frame(np.maximum(_matches, 0))
+    _unmatched = _matches < 0
+    _table = pd.DataFrame(
+        {
+            "Assay": np.array([_a for _a, _ in _phases], dtype=np.intp)[_rows],
+            "Phase": np.array([_p + 1 for _, _p in _phases], dtype=np.intp)[_rows],
+            "Energy (keV)": _energies.round(4),
+            "Counts": [
+                int(_spectra[_r]["data"][int(round(_c))])
+                for _r, _c in zip(_rows, _positions)
+            ],
+            "Significance": _significances.round(1),
+            "Element": np.where(_unmatched, "", _labels["Element"]),
+            "Line": np.where(
+                _unmatched,
+                "",
+                _labels["Line"].str.replace("a", "\u03b1").str.replace("b", "\u03b2"),
+            ),
+            "Type": np.where(_unmatched, "", _labels["Type"]),
+            "Line Energy (keV)": np.where(_unmatched, np.nan, _labels["Energy"]),
+        }
+    )
+    # split into one table per assay
+    _order = np.argsort(_table["Assay"].to_numpy(), kind="stable")
+    _bounds = np.searchsorted(
+        _table["Assay"].to_numpy()[_order], np.arange(len(assays) + 1)
+    )
+    _table = _table.iloc[_order].drop(columns="Assay")
+    for _a, _assay in enumerate(assays):
+        _assay.peaks = _table.iloc[_bounds[_a] : _bounds[_a + 1]].reset_index(drop=True)
+    return [_assay.peaks for _assay in assays]
 
 
 def clearResultsfromTable():  # Clears all data from results table
@@ -4034,6 +6759,11 @@ def onClosing(force: bool = False):
         )
         backup_log_bool = False
     printAndLog("S1Control software Closed.")
+    pxrf.assay_catalogue.close()
+    pxrf.spectra_archive.close()
+    for _writer in csv_writers.values():
+        _writer.close()
+    pxrf.results_store.close()
     if backup_log_bool:
         shutil.copyfile(logFilePath, logFileArchivePath)
     gui.after(100, sysExit)
@@ -4436,22 +7166,24 @@ def saveAssayToCSV(assay: Assay):
                 "Counts (Phase 3)",
             ]
         )
-        n = 0
-        inc = assay.specenergies[0]["fEVPerChannel"]
-        energy = assay.specenergies[0]["fEVChanStart"]
-
         phasect = len(assay.spectra)
-        for channel in assay.spectra[0]["data"]:
-            writer.writerow(
-                [
-                    energy,
-                    (assay.spectra[0]["data"][n] if 0 < phasect else ""),
-                    (assay.spectra[1]["data"][n] if 1 < phasect else ""),
-                    (assay.spectra[2]["data"][n] if 2 < phasect else ""),
-                ]
-            )
-            energy += inc
-            n += 1
+        channelct = len(assay.spectra[0]["data"])
+        # energy of each channel, accumulated channel by channel from the start energy
+        energies = getSpectrumEnergyAxis(assay.specenergies[0], channelct)[0].tolist()
+        # written column-wise as python ints/floats, so values are formatted as before
+        phasecounts = [
+            (np.asarray(assay.spectra[i]["data"]).tolist() if i < phasect else "")
+            for i in range(3)
+        ]
+        writer.writerows(
+            [
+                energies[n],
+                phasecounts[0][n] if 0 < phasect else "",
+                phasecounts[1][n] if 1 < phasect else "",
+                phasecounts[2][n] if 2 < phasect else "",
+            ]
+            for n in range(channelct)
+        )
 
         # writer.writerow(['']) want to put dead time % here?
 
@@ -4460,9 +7192,457 @@ def saveAssayToCSV(assay: Assay):
     printAndLog(f"Assay # {assay.index} saved as CSV file.")
 
 
+def saveTimeResolvedSpectra(assay: Assay, path: str = None) -> str:
+    """Saves an Assay's time-resolved spectra as a compressed .npz file, with arrays 'phaseN_counts' and 'phaseN_headers' for each phase N (from 1),
+    and 'store_deltas' (True if counts rows are per-packet deltas, False if cumulative). By default saved next to the assay's CSV file. Returns the path."""
+    if path is None:
+        assayFolderName = f"Assays_{datetimeString}_{pxrf.instr_serialnumber}"
+        assayFolderPath = rf"{os.getcwd()}/Results/{assayFolderName}"
+        if not os.path.exists(assayFolderPath):
+            os.makedirs(assayFolderPath)
+        path = rf"{assayFolderPath}/{assay.index}_{assay.cal_application}_{datetimeString}_TimeResolved.npz"
+    _arrays = {"store_deltas": np.array([_b.store_deltas for _b in assay.timeresolved])}
+    for _i, _buffer in enumerate(assay.timeresolved):
+        _arrays[f"phase{_i+1}_counts"] = _buffer.counts
+        _arrays[f"phase{_i+1}_headers"] = _buffer.headers
+    # opened with "x" so an existing file is never overwritten
+    with open(path, "xb") as _file:
+        np.savez_compressed(_file, **_arrays)
+    printAndLog(f"Assay # {assay.index} time-resolved spectra saved.")
+    return path
+
+
+class IncrementalCSVWriter:
+    """Keeps a CSV file the same as df.to_csv(path, index=False) for a DataFrame that only ever has rows added (e.g. the session's results),
+    without rewriting the whole file every time. Either append() the new rows, and the DataFrame is built up on the writer thread (as pd.concat would),
+    or update() with the whole DataFrame. If its columns and dtypes are unchanged since the last write, only the new rows are formatted
+    (by pandas, so exactly as a full to_csv would) and appended to the file. Otherwise (e.g. a new element column,
+    or a column of ints becoming floats because an assay didn't have it) the whole file is rewritten.
+    Writing is done in order on a background thread. If a write fails (e.g. the file is open in Excel), the next write rewrites the whole file.
+    df is what the file already holds, if anything (e.g. read back from it when a session is resumed); the first write always rewrites the whole file.
+    A DataFrame mustn't be modified after it's passed to update() (pd.concat makes a new one, so appending rows that way is fine)."""
+
+    def __init__(self, path: str, df: pd.DataFrame = None):
+        self.path = path
+        self.rows_appended: int = 0
+        self.rewrites: int = 0
+        # the whole DataFrame as of the last write. only used by the writer thread once started
+        self.df = pd.DataFrame() if df is None else df
+        self._columns: list = None  # of the file, None until first written
+        self._dtypes: pd.Series = None
+        self._write_failed = False
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def append(self, rows: pd.DataFrame):
+        """Adds rows to the end of the DataFrame (adding any new columns, as pd.concat does) and writes them."""
+        self._queue.put((None, rows))
+
+    def update(self, df: pd.DataFrame):
+        """Writes df, the whole DataFrame (the previous one with rows added)."""
+        self._queue.put((df, None))
+
+    def _run(self):
+        while True:
+            _item = self._queue.get()
+            if _item is None:
+                return
+            _df, _rows = _item
+            try:
+                if _df is None:
+                    _df = pd.concat([self.df, _rows], ignore_index=True)
+                self._write(_df)
+            except Exception as e:
+                printAndLog(
+                    f"Rows for '{os.path.basename(self.path)}' could not be added. ({repr(e)})",
+                    "ERROR",
+                )
+
+    def _write(self, df: pd.DataFrame):
+        _appendable = (
+            not self._write_failed
+            and self._columns == list(df.columns)
+            and self._dtypes.equals(df.dtypes)
+            and len(df) >= len(self.df)
+        )
+        _first_new_row = len(self.df)
+        self.df = df
+        self._columns = list(df.columns)
+        self._dtypes = df.dtypes
+        try:
+            if _appendable:
+                _new_rows = df.iloc[_first_new_row:]
+                with open(self.path, "a", newline="", encoding="utf-8") as _file:
+                    _file.write(_new_rows.to_csv(index=False, header=False))
+                self.rows_appended += len(_new_rows)
+            else:
+                df.to_csv(self.path, index=False)
+                self.rewrites += 1
+            self._write_failed = False
+        except Exception as e:
+            # Most likely, user has opened the file between readings, and it is unable to be written to.
+            self._write_failed = True
+            printAndLog(
+                f"S1Control was unable to write to '{os.path.basename(self.path)}'. This is likely due to the file being open in another program. The file will be saved again after the next assay. ({repr(e)})",
+                "ERROR",
+            )
+
+    def close(self):
+        """Finishes any queued writes, and stops the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+
+csv_writers: dict[str, IncrementalCSVWriter] = {}  # by path
+
+
+def writeCSVIncrementally(df: pd.DataFrame, path: str):
+    """Writes df (a DataFrame that only ever has rows added) to the CSV at path in the background, appending new rows where possible (see IncrementalCSVWriter)."""
+    if path not in csv_writers:
+        csv_writers[path] = IncrementalCSVWriter(path)
+    csv_writers[path].update(df)
+
+
+def appendRowsToCSV(rows: pd.DataFrame, path: str):
+    """Adds rows to the CSV at path in the background, as if they were pd.concat'ed to the DataFrame it holds and the whole thing rewritten (see IncrementalCSVWriter).
+    The DataFrame is built on the writer thread, so this doesn't take longer as the file grows."""
+    if path not in csv_writers:
+        csv_writers[path] = IncrementalCSVWriter(path)
+    csv_writers[path].append(rows)
+
+
+class ResultsStore:
+    """Every assay's results as typed columns, one file per session in a folder shared by all sessions (usually /Results/Store), for querying across months of sessions.
+    Files are parquet if pyarrow is installed, otherwise npz (one array per column). A resumed session carries on in the format its file is already in.
+    Columns are the assay details (COLUMNS: Assay # as int, Timestamp as datetime64, application etc. as strings),
+    then each compound's concentration and error (e.g. 'Fe2O3', 'Fe2O3 Err') as float64, NaN where an assay didn't report it.
+    The session's file is rewritten on a background thread after each assay (it's only a few hundred KB even for long sessions).
+    load() filters every session, e.g. load([("Fe2O3", ">", 5), ("Application", "==", "GeoExploration"), ("Timestamp", ">=", pd.Timestamp.now() - pd.Timedelta(days=7))]).
+    Parquet files whose column statistics show no row can match (e.g. sessions before the Timestamp range, or without the compound) aren't read at all,
+    and the rest are read with the filters and columns pushed down to pyarrow, so only the matching rows are loaded. npz files are read whole (and kept) then filtered.
+    Each query's results are kept per session file (see RESULTS_STORE_CACHED_QUERIES), so repeating it only re-reads files that have changed since."""
+
+    COLUMNS = {
+        "Session": str,
+        "Assay #": "int32",
+        "Serial #": str,
+        "Timestamp": "datetime64[s]",
+        "Application": str,
+        "Method": str,
+        "Duration (Actual) (s)": "float64",
+        "Sanity Check": str,
+        "Info Fields (Combined)": str,
+    }
+    # columns made categorical when loaded, so filtering on them is fast
+    CATEGORY_COLUMNS = ("Session", "Serial #", "Application", "Method", "Sanity Check")
+    FILTER_OPERATORS = {
+        "==": operator.eq,
+        "!=": operator.ne,
+        "<": operator.lt,
+        "<=": operator.le,
+        ">": operator.gt,
+        ">=": operator.ge,
+    }
+
+    def __init__(self):
+        self.folder: str = None
+        self.path: str = None  # this session's file
+        self._session: str = None
+        self._rows: list[dict] = []
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # path: ((mtime, size), DataFrame) of each npz file read by load()
+        self._loaded: dict[str, tuple] = {}
+        # path: ((mtime, size), metadata, columns, {column: (min, max)}) of each parquet file read by load(), ranges found as filters need them
+        self._statistics: dict[str, tuple] = {}
+        # (filters, columns): (per file {path: ((mtime, size), matching rows or None)}, (key, all matching rows)), most recently used last
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, folder: str, session: str):
+        """Starts storing this session's results in folder, as S1Control_Results_{session} (e.g. '20240710-101010_800N1234').
+        If that session already has a file (e.g. it's been resumed), its results are carried on from, in the same format.
+        A file that can't be read (e.g. parquet without pyarrow installed) is left as it is, and this session's results are stored in a new file next to it."""
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self._session = session
+        self.path = None
+        self._rows = []
+        _name = rf"{folder}/S1Control_Results_{session}"
+        _extensions = (".npz",) if pyarrow is None else (".parquet", ".npz")
+        for _path in (f"{_name}{_e}" for _e in (".parquet", ".npz")):
+            if not os.path.exists(_path):
+                continue
+            try:
+                if not _path.endswith(_extensions):
+                    raise ImportError("pyarrow is needed to read parquet files")
+                self._rows = [
+                    {_k: _v for _k, _v in _row.items() if not pd.isna(_v)}
+                    for _row in self._read(_path).to_dict("records")
+                ]
+                self.path = _path
+                return
+            except Exception as e:
+                printAndLog(
+                    f"Results store file {os.path.basename(_path)} could not be read, so won't be added to. ({repr(e)})",
+                    "WARNING",
+                )
+        self.path = f"{_name}{_extensions[0]}"
+        _n = 2
+        while os.path.exists(self.path):
+            self.path = f"{_name}-{_n}{_extensions[0]}"
+            _n += 1
+
+    def add(self, assay: Assay, serial_number: str):
+        """Adds the assay's results to this session's file. Does nothing if the store hasn't been opened."""
+        if self.path is None:
+            return
+        _row = {
+            "Session": self._session,
+            "Assay #": int(assay.index),
+            "Serial #": serial_number,
+            "Timestamp": np.datetime64(
+                f"{assay.date_completed.replace('/', '-')}T{assay.time_completed}", "s"
+            ),
+            "Application": assay.cal_application,
+            "Method": assay.cal_method,
+            "Duration (Actual) (s)": float(assay.time_elapsed.rstrip("s") or "nan"),
+            "Sanity Check": assay.sanity_check_passed,
+            "Info Fields (Combined)": assay.note,
+        }
+        for _compound, _concentration, _error in zip(
+            assay.results["Compound"],
+            assay.results["Concentration"],
+            assay.results["Error(1SD)"],
+        ):
+            _row[f"{_compound}"] = float(_concentration)
+            _row[f"{_compound} Err"] = float(_error)
+        self._rows.append(_row)
+        self._writer.submit(self._write, self.path, list(self._rows))
+
+    @classmethod
+    def frame(cls, rows: list[dict]) -> pd.DataFrame:
+        """Returns a typed DataFrame of result rows: the assay detail columns, then compound columns in the order they first appear."""
+        _df = pd.DataFrame.from_records(rows)
+        _compounds = [_c for _c in _df.columns if _c not in cls.COLUMNS]
+        _df = _df.reindex(columns=list(cls.COLUMNS) + _compounds)
+        for _column, _dtype in cls.COLUMNS.items():
+            if _dtype is str:
+                _df[_column] = _df[_column].fillna("").astype(str)
+            else:
+                _df[_column] = _df[_column].astype(_dtype)
+        return _df.astype({_c: "float64" for _c in _compounds})
+
+    def _write(self, path: str, rows: list[dict]):
+        try:
+            _df = self.frame(rows)
+            # written to a temporary file first, so load() never sees a half-written one
+            _temporary_path = f"{path}.tmp"
+            if path.endswith(".parquet"):
+                _df.to_parquet(_temporary_path, index=False)
+            else:
+                with open(_temporary_path, "wb") as _file:
+                    # strings saved as fixed-width unicode, so the file can be read without pickle
+                    np.savez(
+                        _file,
+                        __columns__=np.array(list(_df.columns), dtype=str),
+                        **{
+                            f"c{_i}": (
+                                _df[_c].to_numpy(dtype=str)
+                                if self.COLUMNS.get(_c) is str
+                                else _df[_c].to_numpy()
+                            )
+                            for _i, _c in enumerate(_df.columns)
+                        },
+                    )
+            os.replace(_temporary_path, path)
+        except Exception as e:
+            printAndLog(f"Results store could not be saved. ({repr(e)})", "ERROR")
+
+    @staticmethod
+    def _read(path: str) -> pd.DataFrame:
+        if path.endswith(".parquet"):
+            return pd.read_parquet(path)
+        with np.load(path, allow_pickle=False) as _npz:
+            return pd.DataFrame(
+                {
+                    _c: _npz[f"c{_i}"]
+                    for _i, _c in enumerate(_npz["__columns__"].tolist())
+                }
+            )
+
+    def flush(self):
+        """Waits for any queued writes."""
+        self._writer.submit(lambda: None).result()
+
+    def load(
+        self, filters: list[tuple] = None, columns: list[str] = None
+    ) -> pd.DataFrame:
+        """Returns the results of every session in the store's folder (one row per assay, oldest session first) matching all the filters,
+        each (column, operator, value) with operator one of ==, !=, <, <=, >, >=, or 'in' (value a list).
+        Rows where a compound filter's column is NaN (not reported) don't match. columns limits the columns returned."""
+        _filters = [
+            (_column, _operator, tuple(_value) if _operator == "in" else _value)
+            for _column, _operator, _value in filters or []
+        ]
+        _query = (tuple(_filters), None if columns is None else tuple(columns))
+        with self._lock:
+            self.flush()
+            _files = self._session_files()
+            _per_file, _combined = self._queries.pop(_query, ({}, (None, None)))
+            _per_file = {
+                _path: (
+                    _per_file[_path]
+                    if _per_file.get(_path, (None,))[0] == _version
+                    else (
+                        _version,
+                        self._read_matching(_path, _version, _filters, columns),
+                    )
+                )
+                for _path, _version in _files
+            }
+            if _combined[0] != _files:
+                _frames = [
+                    _frame for _, _frame in _per_file.values() if _frame is not None
+                ]
+                _df = (
+                    pd.concat(_frames, ignore_index=True)
+                    if _frames
+                    else self.frame([]).iloc[:0]
+                )
+                if columns is not None:
+                    _df = _df[[_c for _c in columns if _c in _df.columns]]
+                for _column in self.CATEGORY_COLUMNS:
+                    if _column in _df.columns:
+                        _df[_column] = _df[_column].astype("category")
+                _combined = (_files, _df)
+            self._queries[_query] = (_per_file, _combined)
+            while len(self._queries) > RESULTS_STORE_CACHED_QUERIES:
+                self._queries.popitem(last=False)
+            return _combined[1].copy(deep=False)
+
+    def _session_files(self) -> list[tuple[str, tuple]]:
+        """Returns (path, (mtime, size)) of every session file in the folder that can be read, in order."""
+        _files = []
+        for _name in sorted(os.listdir(self.folder)):
+            if _name.startswith("S1Control_Results_") and (
+                _name.endswith(".npz") or (_name.endswith(".parquet") and pyarrow)
+            ):
+                _stat = os.stat(rf"{self.folder}/{_name}")
+                _files.append(
+                    (rf"{self.folder}/{_name}", (_stat.st_mtime_ns, _stat.st_size))
+                )
+        return _files
+
+    def _read_matching(
+        self, path: str, version: tuple, filters: list[tuple], columns: list[str]
+    ) -> pd.DataFrame:
+        """Returns the rows of a session file matching the filters (with only the given columns, if any), or None if there are none."""
+        try:
+            if path.endswith(".parquet"):
+                if self._statistics.get(path, (None,))[0] != version:
+                    _metadata = pyarrow.parquet.read_metadata(path)
+                    self._statistics[path] = (
+                        version,
+                        _metadata,
+                        _metadata.schema.names,
+                        {},
+                    )
+                _, _metadata, _file_columns, _ranges = self._statistics[path]
+                for _column, _operator, _value in filters:
+                    # a column the file doesn't have matches nothing, so neither does the file
+                    if _column not in _file_columns:
+                        return None
+                    if _column not in _ranges:
+                        _ranges[_column] = self._parquet_range(
+                            _metadata, _file_columns.index(_column)
+                        )
+                    if not self._could_match(
+                        _ranges[_column], _column, _operator, _value
+                    ):
+                        return None
+                return pd.read_parquet(
+                    path,
+                    columns=(
+                        None
+                        if columns is None
+                        else [_c for _c in columns if _c in _file_columns]
+                    ),
+                    filters=[
+                        (
+                            _column,
+                            _operator,
+                            list(_value) if _operator == "in" else _value,
+                        )
+                        for _column, _operator, _value in filters
+                    ]
+                    or None,
+                )
+            if self._loaded.get(path, (None,))[0] != version:
+                self._loaded[path] = (version, self._read(path))
+            _df = self._loaded[path][1]
+            _mask = np.ones(len(_df), dtype=bool)
+            for _column, _operator, _value in filters:
+                if _column not in _df.columns:
+                    return None
+                if _operator == "in":
+                    _mask &= _df[_column].isin(_value).to_numpy()
+                else:
+                    _mask &= self.FILTER_OPERATORS[_operator](
+                        _df[_column], _value
+                    ).to_numpy(dtype=bool, na_value=False)
+            _df = _df.loc[_mask]
+            if columns is not None:
+                _df = _df[[_c for _c in columns if _c in _df.columns]]
+            return _df
+        except Exception as e:
+            printAndLog(
+                f"Results store file {os.path.basename(path)} could not be read. ({repr(e)})",
+                "WARNING",
+            )
+            return None
+
+    @staticmethod
+    def _parquet_range(metadata, column: int) -> tuple:
+        """Returns (min, max) of a parquet file's column from its row group statistics (read from the file's footer), or None if they don't give one."""
+        _mins, _maxes = [], []
+        for _group in range(metadata.num_row_groups):
+            _statistics = metadata.row_group(_group).column(column).statistics
+            if _statistics is None or not _statistics.has_min_max:
+                return None
+            _mins.append(_statistics.min)
+            _maxes.append(_statistics.max)
+        return (min(_mins), max(_maxes)) if _mins else None
+
+    @staticmethod
+    def _could_match(column_range: tuple, column: str, comparison: str, value) -> bool:
+        """Whether a filter could match any row of a file, given the (min, max) of the column in it. True if it can't be told."""
+        if column_range is None:
+            return True
+        _min, _max = column_range
+        _values = value if comparison == "in" else (value,)
+        try:
+            if column == "Timestamp":
+                _min, _max = pd.Timestamp(_min), pd.Timestamp(_max)
+                _values = [pd.Timestamp(_v) for _v in _values]
+            if comparison in ("==", "in"):
+                return any(_min <= _v <= _max for _v in _values)
+            if comparison == "!=":
+                return not (_min == _max == _values[0])
+            if comparison in ("<", "<="):
+                return ResultsStore.FILTER_OPERATORS[comparison](_min, _values[0])
+            return ResultsStore.FILTER_OPERATORS[comparison](_max, _values[0])
+        except TypeError:
+            return True
+
+    def close(self):
+        """Finishes any queued writes."""
+        self._writer.shutdown(wait=True)
+
+
 def addAssayToResultsCSV(assay: Assay):
     """given an Assay object, add the results of that assay to the results CSV file. designed to mimic results CSV output of instrument."""
-    global current_session_results_df
 
     resultsFileName = (
         f"S1Control_Results_{datetimeString}_{pxrf.instr_serialnumber}.csv"
@@ -4484,7 +7664,23 @@ def addAssayToResultsCSV(assay: Assay):
     new_assay_results_dict["Sanity Check"] = [assay.sanity_check_passed]
     # TODO: separate notes into individual columns
     new_assay_results_dict["Info Fields (Combined)"] = [assay.note]
-    # TODO: replace/add live times for each beam
+    # live time and mean vitals for each beam (phase)
+    for i, phase_vitals in enumerate(assay.vitals or []):
+        new_assay_results_dict[f"Phase {i+1} Live Time (s)"] = [
+            round(phase_vitals["live_time_s"], 2)
+        ]
+        new_assay_results_dict[f"Phase {i+1} Input CPS"] = [
+            round(phase_vitals["input_cps_mean"])
+        ]
+        new_assay_results_dict[f"Phase {i+1} Dead Time (%)"] = [
+            round(phase_vitals["dead_time_percent_mean"], 2)
+        ]
+        new_assay_results_dict[f"Phase {i+1} Voltage (kV)"] = [
+            round(phase_vitals["voltage_kV_mean"], 1)
+        ]
+        new_assay_results_dict[f"Phase {i+1} Current (uA)"] = [
+            round(phase_vitals["current_uA_mean"], 2)
+        ]
     # TODO: add notes fields?
 
     compound_names = assay.results["Compound"].tolist()
@@ -4499,28 +7695,9 @@ def addAssayToResultsCSV(assay: Assay):
     # convert new assay results dict to df
     new_assay_results_df = pd.DataFrame(data=new_assay_results_dict)
 
-    # update current session results df with new assay data. this will add new columns if needed (if element wasn't present before, etc)
-    current_session_results_df = pd.concat(
-        [current_session_results_df, new_assay_results_df], ignore_index=True
-    )
-
-    # Actually write to the CSV file
-    results_csv_not_saved = True
-    while results_csv_not_saved:
-        try:
-            current_session_results_df.to_csv(
-                rf"{resultsFolderPath}/{resultsFileName}", index=False
-            )
-            results_csv_not_saved = False
-        except PermissionError:
-            # Most likely, user has opened results file between readings, and it is unable to be overwritten.
-            if messagebox.askyesno(
-                title="Results File Overwrite Error",
-                message=f"S1Control was unable to write to '{resultsFileName}' with new assay result data. This is likely due to the file being open in another program. If you would like to try to save the new result data again, close the file or program and then click 'Yes' to reattempt. Otherwise click 'No', and the program will try to save the results at the end of the next assay.",
-            ):
-                results_csv_not_saved = True
-            else:
-                results_csv_not_saved = False
+    # add to the session's results, and write to the CSV file (appending the new row, unless there's a new column etc.) on the csv writer thread.
+    # this will add new columns if needed (if element wasn't present before, etc)
+    appendRowsToCSV(new_assay_results_df, _resultsFilePath)
 
     # with open((f'{resultsFolderPath}\{resultsFileName}'), 'x', newline='', encoding= 'utf-8') as resultsFile:
     #     resultsWriter = csv.writer(resultsFile)
@@ -5089,11 +8266,48 @@ if __name__ == "__main__":
     # get args if any
     # lightweight mode defaults to false
     lightweight_mode_requested = False
+    # instrument address can be overridden, e.g. '--instrument=127.0.0.1:55204' to connect to ancillary/S1Simulator.py
+    instrument_address_override: tuple[str, int] = None
+    # '--asyncio' uses the asyncio instrument connection instead of the blocking socket
+    use_asyncio_transport: bool = False
+    # '--record' records all instrument traffic to a .s1rec file in Logs (or '--record=path'), '--replay=path' plays one back instead of connecting to an instrument
+    # '--replay-speed=N' replays at N times the recorded speed (0 for as fast as possible)
+    session_recording_path: str = None
+    session_replay_path: str = None
+    session_replay_speed: float = 1.0
+    # '--resume' carries on the latest session with this instrument (e.g. after a restart mid GeRDA run), '--resume=path' a particular session's catalogue
+    resume_session_requested: bool = False
+    resume_session_path: str = None
     logFileName = ""
-    if len(sys.argv) > 1:
-        # print(f'Running S1Control with argument: {sys.argv[1]}')
-        if sys.argv[1] in ["lightweight", "l", "L", "lite"]:
+    for arg in sys.argv[1:]:
+        # print(f'Running S1Control with argument: {arg}')
+        if arg in ["lightweight", "l", "L", "lite"]:
             lightweight_mode_requested = True
+        elif arg.startswith("--instrument="):
+            try:
+                instrument_address_override = parseInstrumentAddress(
+                    arg.split("=", 1)[1]
+                )
+            except ValueError as e:
+                sys.exit(
+                    f"{e}. usage: --instrument=host:port or --instrument=host (port 55204), e.g. --instrument=127.0.0.1:55204"
+                )
+        elif arg == "--asyncio":
+            use_asyncio_transport = True
+        elif arg == "--record":
+            os.makedirs(rf"{os.getcwd()}/Logs", exist_ok=True)
+            session_recording_path = rf"{os.getcwd()}/Logs/S1Control_Session_{time.strftime('%Y%m%d-%H%M%S', time.localtime())}.s1rec"
+        elif arg.startswith("--record="):
+            session_recording_path = arg.split("=", 1)[1]
+        elif arg.startswith("--replay="):
+            session_replay_path = arg.split("=", 1)[1]
+        elif arg.startswith("--replay-speed="):
+            session_replay_speed = float(arg.split("=", 1)[1])
+        elif arg == "--resume":
+            resume_session_requested = True
+        elif arg.startswith("--resume="):
+            resume_session_requested = True
+            resume_session_path = arg.split("=", 1)[1]
 
     # GUI
     thread_halt: bool = False
@@ -5450,8 +8664,6 @@ if __name__ == "__main__":
 
     ui_firsttime = 1
 
-    energiesfirsttime = True
-
     emission_lines_to_plot = []
     extraticks = []
     extraticklabels = []
@@ -5483,19 +8695,6 @@ if __name__ == "__main__":
     logging.getLogger("matplotlib.font_manager").setLevel(logging.ERROR)
     driveFolderStr = ""
 
-    # Consts for datatypes on recv
-    COOKED_SPECTRUM = "1"
-    RESULTS_SET = "2"
-    RAW_SPECTRUM = "3"
-    PDZ_FILENAME = "4"
-    XML_PACKET = "5"
-    XML_SUCCESS_RESPONSE = "5a"
-    XML_APPS_PRESENT_RESPONSE = "5b"
-    XML_ACTIVE_APP_RESPONSE = "5c"
-    STATUS_CHANGE = "6"
-    SPECTRUM_ENERGY_PACKET = "7"
-    UNKNOWN_DATA = "0"
-
     # COLOURS FOR ELEMENT GROUPS
     ALKALI_METALS = "#FC8B12"  #'goldenrod1'
     ALKALINE_EARTH_METALS = "#FAA23E"  #'DarkOrange1'
@@ -5643,8 +8842,6 @@ if __name__ == "__main__":
         {"Z": [0], "Compound": ["No Results"], "Concentration": [0], "Error(1SD)": [0]}
     )
 
-    current_session_results_df = pd.DataFrame()
-
     # Frames
     LHSframe = ctk.CTkFrame(gui, width=340, corner_radius=0)
     LHSframe.pack(
@@ -6312,6 +9509,7 @@ if __name__ == "__main__":
         variable=doNormaliseSpectra_var,
         onvalue=True,
         offvalue=False,
+        command=onNormaliseSpectraToggled,
         font=ctk_jbm12,
     )
     checkbox_doNormaliseSpectra.grid(
@@ -6374,6 +9572,29 @@ if __name__ == "__main__":
     checkbox_doSanityCheckSpectra.grid(
         row=7, column=0, padx=4, pady=4, columnspan=2, sticky=tk.NSEW
     )
+    # FLAG TO CONTROL KEEPING EVERY SPECTRUM PACKET OF EACH PHASE (TIME-RESOLVED), NOT JUST THE LAST
+    doKeepTimeResolvedSpectra_var = ctk.BooleanVar(value=False)
+    checkbox_doKeepTimeResolvedSpectra = ctk.CTkCheckBox(
+        ctrltabview.tab("Options"),
+        text="Keep Time-Resolved Spectra (Every Packet)",
+        variable=doKeepTimeResolvedSpectra_var,
+        onvalue=True,
+        offvalue=False,
+        font=ctk_jbm12,
+    )
+    checkbox_doKeepTimeResolvedSpectra.grid(
+        row=10, column=0, padx=4, pady=4, columnspan=2, sticky=tk.NSEW
+    )
+
+    button_recheckSessionSpectra = ctk.CTkButton(
+        ctrltabview.tab("Options"),
+        text="Re-check Session Spectra Sanity...",
+        command=recheckSessionSpectraSanity,
+        font=ctk_jbm12,
+    )
+    button_recheckSessionSpectra.grid(
+        row=8, column=0, padx=4, pady=4, columnspan=2, sticky=tk.NSEW
+    )
 
     enableendofassaynotifications_var = ctk.StringVar(value="on")
     checkbox_enableendofassaynotifications = ctk.CTkCheckBox(
@@ -6754,22 +9975,42 @@ if __name__ == "__main__":
         print("S1CONTROL Launched in Lightweight-Mode.")
 
     # Begin Instrument Connection
-    pxrf: BrukerInstrument = BrukerInstrument()
+    if session_replay_path is not None:
+        pxrf: BrukerInstrument = BrukerInstrument(
+            replay=PacketReplayer(session_replay_path, speed=session_replay_speed)
+        )
+        print(f"Replaying session recording {session_replay_path}")
+    elif instrument_address_override is not None:
+        pxrf: BrukerInstrument = BrukerInstrument(
+            *instrument_address_override,
+            use_asyncio=use_asyncio_transport,
+            probe_alternates=False,
+        )
+    else:
+        pxrf: BrukerInstrument = BrukerInstrument(use_asyncio=use_asyncio_transport)
     # pxrf.open_tcp_connection(pxrf.ip, pxrf.port)
-    time.sleep(0.2)
+    if session_recording_path is not None:
+        pxrf.start_recording(session_recording_path)
+        print(f"Recording instrument traffic to {session_recording_path}")
+    packet_dispatcher: PacketDispatcher = buildPacketDispatcher()
+    packet_dispatcher.response_listener = pxrf.resolve_query
     xrfListenLoopThread_Start(None)
     # xrfListenLoopProcess_Start()
-    time.sleep(0.1)
-    instrument_GetStates()
-    time.sleep(0.1)
-    instrument_GetInfo()  # Get info from IDF for log file NAMING purposes
-    time.sleep(0.5)
-    initialiseLogFile()  # Must be called after instrument and listen loop are connected and started, and getinfo has been called once, and time has been allowed for loop to read all info into vars
-    time.sleep(0.2)
+    # all queries are sent at once, then waited on together - startup continues as soon as the instrument has answered
+    _startup_queries = instrument_GetStates()
+    _startup_queries += (
+        instrument_GetInfo()
+    )  # Get info from IDF for log file NAMING purposes
+    waitForQueries(_startup_queries)
+    rememberInstrumentEndpoint(pxrf.instr_serialnumber, pxrf.ip, pxrf.port)
+    initialiseLogFile()  # Must be called after instrument and listen loop are connected and started, and getinfo has been answered, so the serial number etc. are known
+    if not (resume_session_requested and resumeSession(resume_session_path)):
+        initialiseAssayCatalogue()
     # Get info to add to Log file
     instrument_GetInfo()
 
     statusUpdateCheckerLoop_Start(None)
+    publishVitals()
 
     try:
         gui.title(f"S1Control - {driveFolderStr}")
@@ -6780,9 +10021,7 @@ if __name__ == "__main__":
     if not pxrf.instr_isloggedin:
         pxrf.command_login()
 
-    time.sleep(0.05)
     instrument_SetImportantStartupConfigurables()
-    time.sleep(0.05)
     pxrf.query_current_application_phase_times()
 
     gui.protocol("WM_DELETE_WINDOW", onClosing)
@@ -6790,3 +10029,4 @@ if __name__ == "__main__":
     gui.mainloop()
 
     closeAllThreads()  # after gui mainloop has ended
+    pxrf.stop_recording()
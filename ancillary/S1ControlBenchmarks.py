@@ -0,0 +1,887 @@
+import os
+import sys
+import time
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import tracemalloc
+import xmltodict
+import numpy as np
+import pandas as pd
+from decimal import Decimal
+
+# allows importing S1Control from the parent directory, and S1Simulator from this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import S1Control  # noqa: E402
+from S1Simulator import S1Simulator, expectedSpectrumShape  # noqa: E402
+
+# Benchmarks for the performance-sensitive parts of S1Control.
+# usage: python S1ControlBenchmarks.py [benchmark names...]    (runs all if none given)
+#   'replay' replays a freshly recorded simulator session, or a given recording: python S1ControlBenchmarks.py replay=path/to/session.s1rec
+
+
+def makePacket(type_code: bytes, body: bytes) -> bytes:
+    """Frames a body as a Bruker OEM protocol packet (header + body + footer)."""
+    return (
+        b"\x03\x02\x00\x00"
+        + type_code
+        + len(body).to_bytes(4, "little")
+        + body
+        + b"\x06\x2a\xff\xff"
+    )
+
+
+def makeCookedSpectrumBody(packet_count: int = 1, counts_seed: int = 0) -> bytes:
+    """Returns a plausible cooked spectrum packet body: 208-byte header followed by 2048 uint32 counts."""
+    _header = bytearray(208)
+    struct.pack_into("<f", _header, 0, 20.0)  # fEVPerChannel
+    struct.pack_into("<L", _header, 8, 1000)  # iTDur
+    struct.pack_into("<h", _header, 126, -54)  # Det_Temp
+    struct.pack_into("<H", _header, 128, 1081)  # Amb_Temp
+    struct.pack_into("<f", _header, 148, 1000.0)  # fTDur
+    struct.pack_into("<f", _header, 164, 900.0)  # fALive
+    struct.pack_into("<L", _header, 172, packet_count)  # lPacket_Cnt
+    _counts = struct.pack(
+        "<2048L", *((((i * 7919) + counts_seed) % 5000) for i in range(2048))
+    )
+    return bytes(_header) + _counts
+
+
+def makePacketStream() -> tuple[bytes, int]:
+    """Returns a representative chunk of instrument traffic (one second of an assay phase) and the number of packets in it."""
+    _packets = [
+        makePacket(b"\x0b\x80", struct.pack("<iff", 1, 0.0, 20.0)),
+        makePacket(b"\x01\x80", makeCookedSpectrumBody()),
+        makePacket(
+            b"\x18\x80",
+            b'<?xml version="1.0" encoding="utf-8"?><Status parameter="Assay">Start</Status>',
+        ),
+    ]
+    return b"".join(_packets), len(_packets)
+
+
+class LegacyChunkReader:
+    """The original list-of-chunks framing used by BrukerInstrument.receive_data, kept here for comparison."""
+
+    def __init__(self, sock: socket.socket):
+        self.socket = sock
+
+    def receive_chunks(self, expected_len) -> bytes:
+        chunks = []
+        recv_len = 0
+        while recv_len < expected_len:
+            chunk = self.socket.recv(expected_len - recv_len)
+            if chunk == b"":
+                raise Exception("XRF Socket connection broken")
+            chunks.append(chunk)
+            recv_len = recv_len + len(chunk)
+        return b"".join(chunks)
+
+    def read_packet(self) -> tuple[bytes, bytes, bytes]:
+        _header = self.receive_chunks(10)
+        _data_size = int.from_bytes(_header[6:10], "little")
+        _data = self.receive_chunks(_data_size)
+        _footer = self.receive_chunks(4)
+        return _header, _data, _footer
+
+
+def runReader(reader_class, repeats: int, trace_allocations: bool = False) -> dict:
+    """Streams `repeats` copies of the representative traffic through a socketpair and reads every packet with reader_class.
+    Returns dict of packets/s, and (if trace_allocations) the mean transient bytes allocated per packet."""
+    _stream, _packets_per_stream = makePacketStream()
+    _total_packets = _packets_per_stream * repeats
+    _rx, _tx = socket.socketpair()
+
+    def _send():
+        for _ in range(repeats):
+            _tx.sendall(_stream)
+
+    _sender = threading.Thread(target=_send, daemon=True)
+    _reader = reader_class(_rx)
+    _transient_bytes = 0
+    if trace_allocations:
+        tracemalloc.start()
+    _sender.start()
+    _t0 = time.perf_counter()
+    for _ in range(_total_packets):
+        if trace_allocations:
+            _before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        _header, _body, _footer = _reader.read_packet()
+        if trace_allocations:
+            _, _peak = tracemalloc.get_traced_memory()
+            _transient_bytes += _peak - _before
+        del _header, _body, _footer
+    _elapsed = time.perf_counter() - _t0
+    if trace_allocations:
+        tracemalloc.stop()
+    _sender.join()
+    _rx.close()
+    _tx.close()
+    _result = {"packets_per_s": _total_packets / _elapsed}
+    if trace_allocations:
+        _result["bytes_allocated_per_packet"] = _transient_bytes / _total_packets
+    return _result
+
+
+def benchmarkPacketReader(repeats: int = 20000):
+    """Compares the preallocated recv_into FramedPacketReader against the legacy list-of-chunks framing."""
+    print("=== Packet framing: FramedPacketReader vs legacy receive_chunks ===")
+    for _name, _reader_class in (
+        ("legacy receive_chunks", LegacyChunkReader),
+        ("FramedPacketReader", S1Control.FramedPacketReader),
+    ):
+        _speed = runReader(_reader_class, repeats)
+        _allocs = runReader(_reader_class, repeats // 10, trace_allocations=True)
+        print(
+            f"{_name:>24}: {_speed['packets_per_s']:>10.0f} packets/s, {_allocs['bytes_allocated_per_packet']:>8.0f} bytes allocated per packet (tracemalloc peak)"
+        )
+
+
+def customAssayCommandPacket(duration_s: int) -> bytes:
+    _command = f'<?xml version="1.0" encoding="utf-8"?><Command parameter="Assay"><StartParameters><Filter></Filter><HighVoltage>40.0</HighVoltage><AnodeCurrent>15.0</AnodeCurrent><AssayDuration>{duration_s}</AssayDuration><BackScatterLimit>0</BackScatterLimit><RejectPackets>1</RejectPackets></StartParameters></Command>'
+    return makePacket(b"\x17\x80", _command.encode("utf-8"))
+
+
+def benchmarkTransport(duration_s: int = 200, rate: float = 10):
+    """Streams a custom spectrum assay from the simulator (as fast as possible) through the blocking socket reader and the asyncio connection."""
+    print(
+        "=== Transport: blocking socket vs asyncio connection (simulator, max speed) ==="
+    )
+    for _name in ("blocking socket", "asyncio"):
+        _simulator = S1Simulator(port=0, speed=0, rate=rate).start()
+        if _name == "asyncio":
+            _connection = S1Control.AsyncInstrumentConnection(
+                "127.0.0.1", _simulator.port
+            )
+            _connection.connect()
+            _send, _read = _connection.send, _connection.read_packet
+        else:
+            _sock = socket.create_connection(("127.0.0.1", _simulator.port))
+            _reader = S1Control.FramedPacketReader(_sock)
+            _send, _read = _sock.sendall, _reader.read_packet
+        _t0 = time.perf_counter()
+        _send(customAssayCommandPacket(duration_s))
+        _packets = 0
+        while True:
+            _header, _body, _footer = _read()
+            _packets += 1
+            if _header[4:6] == b"\x18\x80" and b"Complete" in bytes(_body):
+                break
+        _elapsed = time.perf_counter() - _t0
+        print(
+            f"{_name:>24}: {_packets / _elapsed:>10.0f} packets/s ({_packets} packets)"
+        )
+        if _name == "asyncio":
+            _connection.close()
+        else:
+            _sock.close()
+        _simulator.stop()
+
+
+def makeResultsPacketBody(n_elements: int) -> bytes:
+    """Returns a results (<Data>) packet body with n_elements ElementData entries."""
+    _elements = "".join(
+        f'<ElementData><Compound>E{_i}</Compound><AtomicNumber Type="Element">{(_i % 90) + 3}</AtomicNumber><Concentration>{0.0123 * (_i + 1):.6f}</Concentration><Error>{0.0004 * (_i + 1):.6f}</Error></ElementData>'
+        for _i in range(n_elements)
+    )
+    return f'<?xml version="1.0" encoding="utf-8"?><Data><AnalysisMode>Oxide3Phase</AnalysisMode><Elements>{_elements}</Elements></Data>'.encode(
+        "utf-8"
+    )
+
+
+def legacyResultsToDataFrame(body: bytes) -> pd.DataFrame:
+    """The original results path: xmltodict.parse, then map(lambda) over ElementData dicts (wt% display units)."""
+    _data = xmltodict.parse(str(body, "utf-8"))
+    _elementdata = _data["Data"]["Elements"]["ElementData"]
+    if isinstance(_elementdata, dict):
+        _elementdata = [_elementdata]
+    _chemistry = list(
+        map(
+            lambda x: {
+                "Z": int(x["AtomicNumber"]["#text"]),
+                "Compound": x["Compound"],
+                "Concentration": np.around(float(x["Concentration"]), 4),
+                "Error(1SD)": np.around(float(x["Error"]), 4),
+            },
+            _elementdata,
+        )
+    )
+    return pd.DataFrame.from_dict(_chemistry)
+
+
+def resultsToDataFrame(body: bytes) -> pd.DataFrame:
+    """The current results path: classify from bytes, decode with expat into arrays, build DataFrame from columns (wt% display units)."""
+    _root, _ = S1Control.classifyXMLPacket(body)
+    _results = S1Control.decodeResultsPacket(body)
+    return pd.DataFrame(
+        {
+            "Z": _results.z,
+            "Compound": _results.compounds,
+            "Concentration": np.around(_results.concentrations, 4),
+            "Error(1SD)": np.around(_results.errors, 4),
+        }
+    )
+
+
+def timePerCall(func, arg, min_seconds: float = 0.5) -> float:
+    """Returns mean seconds per call of func(arg), repeating for at least min_seconds."""
+    _calls = 0
+    _t0 = time.perf_counter()
+    while True:
+        func(arg)
+        _calls += 1
+        _elapsed = time.perf_counter() - _t0
+        if _elapsed >= min_seconds:
+            return _elapsed / _calls
+
+
+def benchmarkXMLDecoding():
+    """Compares xmltodict-based parsing against the byte-level classifier and typed decoders, for status and results packets."""
+    print("=== XML packets: xmltodict vs classifier + typed decoders ===")
+    _status_body = b'<?xml version="1.0" encoding="utf-8"?><Status parameter="Phase Change">2</Status>'
+    _legacy = timePerCall(lambda b: xmltodict.parse(str(b, "utf-8")), _status_body)
+    _new = timePerCall(
+        lambda b: (S1Control.classifyXMLPacket(b), S1Control.decodeStatusPacket(b)),
+        _status_body,
+    )
+    print(
+        f"{'status packet':>24}: xmltodict {_legacy * 1e6:8.1f}us, classifier+decoder {_new * 1e6:8.1f}us ({_legacy / _new:.1f}x)"
+    )
+    for _n in (10, 40, 80):
+        _body = makeResultsPacketBody(_n)
+        assert legacyResultsToDataFrame(_body).equals(resultsToDataFrame(_body))
+        _legacy = timePerCall(legacyResultsToDataFrame, _body)
+        _new = timePerCall(resultsToDataFrame, _body)
+        _legacy_parse = timePerCall(lambda b: xmltodict.parse(str(b, "utf-8")), _body)
+        _new_parse = timePerCall(S1Control.decodeResultsPacket, _body)
+        print(
+            f"{f'results, {_n} elements':>24}: parse only: xmltodict {_legacy_parse * 1e6:8.1f}us, expat decoder {_new_parse * 1e6:8.1f}us ({_legacy_parse / _new_parse:.1f}x) | to DataFrame: legacy {_legacy * 1e6:8.1f}us, new {_new * 1e6:8.1f}us ({_legacy / _new:.1f}x)"
+        )
+
+
+def legacySpectrumCounts(body) -> list:
+    """The original setSpectrum counts decoding: a list of 2048 python ints."""
+    return list(map(lambda x: x[0], struct.iter_unpack("<L", body[208:])))
+
+
+def spectrumCounts(body) -> np.ndarray:
+    """The current setSpectrum counts decoding: one copy into a uint32 array."""
+    return np.frombuffer(body, dtype="<u4", offset=208).copy()
+
+
+COOKED_HEADER_KEYS = [
+    "fEVPerChannel",
+    "iTDur",
+    "iRaw_Cnts",
+    "iValid_Cnts",
+    "iADur",
+    "iADead",
+    "iAReset",
+    "iALive",
+    "iPacket_Cnt",
+    "Det_Temp",
+    "Amb_Temp",
+    "iRaw_Cnts_Acc",
+    "iValid_Cnts_Acc",
+    "fTDur",
+    "fADur",
+    "fADead",
+    "fAReset",
+    "fALive",
+    "lPacket_Cnt",
+    "iFilterNum",
+    "fltElement1",
+    "fltThickness1",
+    "fltElement2",
+    "fltThickness2",
+    "fltElement3",
+    "fltThickness3",
+    "sngHVADC",
+    "sngCurADC",
+    "Toggle",
+]
+
+
+def legacySpectrumDict(body) -> dict:
+    """The original setSpectrum record: all header values struct-unpacked into a dict (with the counts array and filter description added)."""
+    _a = dict(
+        zip(
+            COOKED_HEADER_KEYS,
+            struct.unpack(
+                "<f4xLLL4xLLLL6xH78xhHxxLL8xfffff4xLihhhhhhffxxbxxxxx", body[0:208]
+            ),
+        )
+    )
+    _a["data"] = np.frombuffer(body, dtype="<u4", offset=208).copy()
+    _a["fltDescription"] = "(No Filter)"
+    return _a
+
+
+def retainedBytesPerItem(func, arg, n: int = 1000) -> float:
+    """Returns mean bytes still allocated per result, when n results of func(arg) are kept (as they are in the assay catalogue)."""
+    tracemalloc.start()
+    _before, _ = tracemalloc.get_traced_memory()
+    _kept = [func(arg) for _ in range(n)]
+    _after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del _kept
+    return (_after - _before) / n
+
+
+def benchmarkSpectrumDecoding():
+    """Compares decoding the counts of a cooked spectrum packet into a list of ints against np.frombuffer, for parse speed and memory kept per spectrum."""
+    print("=== Cooked spectrum counts: list of ints vs np.frombuffer ===")
+    _body = memoryview(makeCookedSpectrumBody())
+    assert legacySpectrumCounts(_body) == spectrumCounts(_body).tolist()
+    for _name, _func in (
+        ("list(struct.iter_unpack)", legacySpectrumCounts),
+        ("np.frombuffer().copy()", spectrumCounts),
+    ):
+        _seconds = timePerCall(_func, _body)
+        print(
+            f"{_name:>24}: {1 / _seconds:>10.0f} spectra/s, {retainedBytesPerItem(_func, _body):>8.0f} bytes kept per spectrum"
+        )
+    print("=== Cooked spectrum record: dict of header values vs CookedSpectrum ===")
+    _legacy = legacySpectrumDict(_body)
+    _spectrum = S1Control.CookedSpectrum.from_packet(_body)
+    assert all(_legacy[_k] == _spectrum[_k] for _k in COOKED_HEADER_KEYS)
+    for _name, _func in (
+        ("dict", legacySpectrumDict),
+        ("CookedSpectrum", S1Control.CookedSpectrum.from_packet),
+    ):
+        _seconds = timePerCall(_func, _body)
+        print(
+            f"{_name:>24}: {1 / _seconds:>10.0f} spectra/s, {retainedBytesPerItem(_func, _body):>8.0f} bytes kept per spectrum"
+        )
+
+
+def legacyNormaliseSpectrum(spectrum_counts, time_in_milliseconds) -> list:
+    """The original normaliseSpectrum: Decimal arithmetic per bin, with the total re-summed for every bin (O(n^2))."""
+    time_in_seconds = time_in_milliseconds / 1000
+    counts_per_second_spectrum = [
+        Decimal(int(b)) / Decimal(time_in_seconds) for b in spectrum_counts
+    ]
+    area_normalised_spectrum = [
+        Decimal(b) / Decimal(sum(counts_per_second_spectrum))
+        for b in counts_per_second_spectrum
+    ]
+    return [float(b) * 100 for b in area_normalised_spectrum]
+
+
+def benchmarkNormalisation(n_spectra: int = 500):
+    """Compares the original Decimal normaliseSpectrum against the NumPy version, per spectrum and as one (n_spectra, 2048) batch."""
+    print("=== Spectrum normalisation: Decimal vs NumPy ===")
+    _counts = np.stack(
+        [
+            spectrumCounts(makeCookedSpectrumBody(counts_seed=_i))
+            for _i in range(n_spectra)
+        ]
+    )
+    assert legacyNormaliseSpectrum(_counts[0], 20000) == (
+        S1Control.normaliseSpectrum(_counts[0], 20000).tolist()
+    )
+    for _name, _func in (
+        ("Decimal", lambda c: legacyNormaliseSpectrum(c, 20000)),
+        ("normaliseSpectrum", lambda c: S1Control.normaliseSpectrum(c, 20000)),
+    ):
+        _seconds = timePerCall(_func, _counts[0])
+        print(f"{_name:>24}: {1 / _seconds:>10.0f} spectra/s")
+    _seconds = timePerCall(S1Control.normaliseSpectra, _counts)
+    print(
+        f"{'normaliseSpectra (batch)':>24}: {n_spectra / _seconds:>10.0f} spectra/s ({n_spectra} per call)"
+    )
+
+
+def legacySanityCheckThresholdIndex(spectrum_counts) -> int:
+    """The original sanityCheckSpectrum_SumMethod search: walks backwards from the last channel, summing counts until 2% of the total is passed."""
+    two_percent_counts_threshold = np.sum(spectrum_counts) * 0.02
+    sum_counting = 0
+    for i in range(len(spectrum_counts) - 1, 0, -1):
+        sum_counting += spectrum_counts[i]
+        if sum_counting > two_percent_counts_threshold:
+            return i
+
+
+def benchmarkSanityCheck(n_spectra: int = 300):
+    """Compares the original per-spectrum python loop sanity check search against sanityCheckSpectra on an (n_spectra, 2048) block."""
+    print("=== Spectra sanity check: python loop vs batched cumulative sum ===")
+    _counts = np.stack(
+        [
+            spectrumCounts(makeCookedSpectrumBody(counts_seed=_i))
+            for _i in range(n_spectra)
+        ]
+    )
+    # no counts above 30keV (channel 1500), as in a spectrum taken at 30kV: the python loop has to walk through those channels first
+    _counts[:, 1500:] = 0
+    _, _kev = S1Control.getEnergyAxis(0.0, 20.0, _counts.shape[1])
+    _voltages = [30] * n_spectra
+    _, _energies, _ = S1Control.sanityCheckSpectra(_counts, _kev, _voltages)
+    assert [_kev[legacySanityCheckThresholdIndex(_c)] for _c in _counts] == (
+        _energies.tolist()
+    )
+    _seconds = timePerCall(
+        lambda c: [legacySanityCheckThresholdIndex(_c) for _c in c], _counts
+    )
+    print(f"{'python loop':>24}: {n_spectra / _seconds:>10.0f} spectra/s")
+    _seconds = timePerCall(
+        lambda c: S1Control.sanityCheckSpectra(c, _kev, _voltages), _counts
+    )
+    print(
+        f"{'sanityCheckSpectra':>24}: {n_spectra / _seconds:>10.0f} spectra/s ({n_spectra} per call)"
+    )
+
+
+def makeCatalogue(
+    n_assays: int, voltages: tuple = (15, 40, 50), total_counts: float = 2e6
+) -> list:
+    """Returns n_assays Assays with one synthetic (simulator-shaped, poisson noise) spectrum per voltage, at 20eV/channel."""
+    _rng = np.random.default_rng(0)
+    _shapes = [expectedSpectrumShape(_kv) * total_counts for _kv in voltages]
+    _specenergies = {"iPacketCount": 1, "fEVChanStart": 0.0, "fEVPerChannel": 20.0}
+    return [
+        S1Control.Assay(
+            index=str(_i + 1).zfill(4),
+            date_completed="",
+            time_completed="",
+            time_elapsed="",
+            time_total_set=0,
+            cal_application="",
+            cal_method="",
+            results=None,
+            spectra=[{"data": _rng.poisson(_s).astype("<u4")} for _s in _shapes],
+            specenergies=[_specenergies] * len(_shapes),
+            legends=[],
+            temps="",
+            note="",
+            sanity_check_passed="N/A",
+        )
+        for _i in range(n_assays)
+    ]
+
+
+def benchmarkPeakSearch(n_assays: int = 540):
+    """Times labelPeaks (batched peak search + line matching) for one assay, as run after each assay, and for a whole catalogue of n_assays (e.g. a 540 sample GeRDA run)."""
+    print("=== Peak search and line labelling (3 phases per assay) ===")
+    S1Control.energiescsvpath = S1Control.resource_path("energies.csv")
+    _catalogue = makeCatalogue(n_assays)
+    _seconds = timePerCall(S1Control.labelPeaks, _catalogue[:1])
+    print(f"{'1 assay':>24}: {_seconds * 1000:>10.2f} ms")
+    _t0 = time.perf_counter()
+    _peaks = S1Control.labelPeaks(_catalogue)
+    _seconds = time.perf_counter() - _t0
+    print(
+        f"{f'{n_assays} assays (batch)':>24}: {_seconds * 1000:>10.2f} ms ({sum(len(_p) for _p in _peaks)} peaks)"
+    )
+
+
+def benchmarkSpectrumCompression(n_assays: int = 540):
+    """Reports bytes held per 3 phase assay in the catalogue before and after its spectra are compressed (with normalised data, as with 'Normalise Spectra' on),
+    and times compressing an assay, and reading its spectra back (as when it is selected) both from decompressed_spectrum_cache and after being evicted."""
+    print("=== Catalogue spectrum compression (3 phases per assay) ===")
+    _codec = S1Control.SPECTRUM_COMPRESSION_CODEC
+    _header = np.zeros(1, dtype=S1Control.COOKED_SPECTRUM_HEADER_DTYPE)[0]
+    for _name in S1Control.SPECTRUM_CODECS:
+        S1Control.SPECTRUM_COMPRESSION_CODEC = _name
+        _catalogue = makeCatalogue(n_assays)
+        for _assay in _catalogue:
+            _assay.spectra = [
+                S1Control.CookedSpectrum(_header.copy(), _s["data"])
+                for _s in _assay.spectra
+            ]
+            S1Control.backfillNormalisedSpectra(_assay.spectra)
+        _t0 = time.perf_counter()
+        _sizes = [S1Control.compressAssaySpectra(_assay) for _assay in _catalogue]
+        _compress_seconds = (time.perf_counter() - _t0) / n_assays
+        _before = sum(_b for _b, _ in _sizes) / n_assays
+        _after = sum(_a for _, _a in _sizes) / n_assays
+        print(
+            f"{_name:>24}: {_before / 1024:>7.1f}KB -> {_after / 1024:.1f}KB per assay ({_before / _after:.1f}x), {_compress_seconds * 1000:.2f} ms to compress"
+        )
+
+        def _select(assay):
+            return [(_s["data"], _s["normalised_data"]) for _s in assay.spectra]
+
+        S1Control.decompressed_spectrum_cache.clear()
+        _seconds = timePerCall(lambda a: [_select(_assay) for _assay in a], _catalogue)
+        print(
+            f"{'select (evicted)':>24}: {_seconds / n_assays * 1000:>10.3f} ms per assay"
+        )
+        _seconds = timePerCall(_select, _catalogue[-1])
+        print(f"{'select (cached)':>24}: {_seconds * 1000:>10.3f} ms per assay")
+    S1Control.SPECTRUM_COMPRESSION_CODEC = _codec
+
+
+def benchmarkAssayCatalogue(n_assays: int = 2000):
+    """Appends n_assays 3 phase assays (with 40 element results) to an AssayCatalogue in a temporary folder (waiting for the background writes), then times loading random assays
+    that aren't cached, as when selecting an old assay in the assays table of a long GeRDA run."""
+    print("=== Assay catalogue on disk (3 phases per assay) ===")
+    _header = np.zeros(1, dtype=S1Control.COOKED_SPECTRUM_HEADER_DTYPE)[0]
+    _results = pd.DataFrame(
+        {
+            "Z": np.arange(12, 52),
+            "Compound": [S1Control.elementZtoSymbol(_z) for _z in range(12, 52)],
+            "Concentration": np.linspace(0.001, 20, 40),
+            "Error(1SD)": np.linspace(0.0001, 0.2, 40),
+        }
+    )
+    _catalogue_folder = tempfile.mkdtemp()
+    _catalogue = S1Control.AssayCatalogue(os.path.join(_catalogue_folder, "benchmark"))
+    _assays = makeCatalogue(n_assays)
+    for _assay in _assays:
+        _assay.spectra = [
+            S1Control.CookedSpectrum(_header.copy(), _s["data"])
+            for _s in _assay.spectra
+        ]
+        _assay.results = _results
+    _t0 = time.perf_counter()
+    for _assay in _assays:
+        _catalogue.append(_assay)
+    _queued_seconds = time.perf_counter() - _t0
+    _catalogue.flush()
+    _seconds = time.perf_counter() - _t0
+    del _assays
+    print(
+        f"{'append':>24}: {_seconds / n_assays * 1000:>10.3f} ms per assay ({_queued_seconds / n_assays * 1000:.3f} ms on the calling thread)"
+    )
+    _bytes = sum(
+        os.path.getsize(os.path.join(_catalogue_folder, _f))
+        for _f in os.listdir(_catalogue_folder)
+    )
+    print(
+        f"{'on disk':>24}: {_bytes / n_assays / 1024:>10.1f} KB per assay ({len(_catalogue.cached())} assays in memory)"
+    )
+    _rng = np.random.default_rng(0)
+    _times = []
+    # none of these are cached (only the last appended are)
+    for _position in _rng.choice(
+        n_assays - S1Control.CATALOGUE_CACHED_ASSAYS, 200, replace=False
+    ):
+        _t0 = time.perf_counter()
+        _assay = _catalogue[int(_position)]
+        [(_s["data"], _s["normalised_data"]) for _s in _assay.spectra]
+        _times.append(time.perf_counter() - _t0)
+    print(
+        f"{'load + decompress':>24}: {np.median(_times) * 1000:>10.3f} ms median, {np.max(_times) * 1000:.3f} ms max"
+    )
+    # as when resuming the session after a restart: reopen, read the assays table rows, and load the last assay to plot
+    _catalogue.close()
+    _t0 = time.perf_counter()
+    _catalogue = S1Control.AssayCatalogue(os.path.join(_catalogue_folder, "benchmark"))
+    _summaries = _catalogue.summaries()
+    [(_s["data"], _s["normalised_data"]) for _s in _catalogue[-1].spectra]
+    _seconds = time.perf_counter() - _t0
+    print(
+        f"{'reopen (resume)':>24}: {_seconds * 1000:>10.3f} ms ({len(_summaries)} assay summaries + last assay)"
+    )
+    _catalogue.close()
+    shutil.rmtree(_catalogue_folder, ignore_errors=True)
+
+
+def benchmarkSpectraArchive(n_assays: int = 2000):
+    """Times reading every spectrum of a session of n_assays 3 phase assays (e.g. for a whole-session ROI integration),
+    from the memory-mapped SpectraArchive versus loading each assay from the AssayCatalogue."""
+    print("=== Whole session spectra: archive vs catalogue (3 phases per assay) ===")
+    _header = np.zeros(1, dtype=S1Control.COOKED_SPECTRUM_HEADER_DTYPE)[0]
+    _folder = tempfile.mkdtemp()
+    _catalogue = S1Control.AssayCatalogue(os.path.join(_folder, "benchmark"))
+    _archive = S1Control.SpectraArchive(os.path.join(_folder, "benchmark"))
+    for _assay in makeCatalogue(n_assays):
+        _assay.spectra = [
+            S1Control.CookedSpectrum(_header.copy(), _s["data"])
+            for _s in _assay.spectra
+        ]
+        _catalogue.append(_assay)
+        _archive.append(_assay.spectra, _assay.specenergies)
+    _rois = S1Control.defineROIs()
+
+    def _fromCatalogue(catalogue):
+        _spectra = [_s for _assay in catalogue for _s in _assay.spectra]
+        _counts = np.stack([_s["data"] for _s in _spectra])
+        return S1Control.integrateROIs(
+            _counts, np.zeros(len(_counts)), np.full(len(_counts), 20.0), _rois
+        )
+
+    def _fromArchive(archive):
+        _counts, _info, _ = archive.phases()
+        return S1Control.integrateROIs(
+            _counts,
+            _info["specenergy_fEVChanStart"],
+            _info["specenergy_fEVPerChannel"],
+            _rois,
+        )
+
+    assert np.array_equal(_fromCatalogue(_catalogue)[0], _fromArchive(_archive)[0])
+    for _name, _func, _source in (
+        ("catalogue", _fromCatalogue, _catalogue),
+        ("archive (memory-mapped)", _fromArchive, _archive),
+    ):
+        _seconds = timePerCall(_func, _source)
+        print(
+            f"{_name:>24}: {_seconds * 1000:>10.1f} ms to read + integrate {len(_rois)} ROIs over {n_assays * 3} spectra"
+        )
+    _catalogue.close()
+    _archive.close()
+    shutil.rmtree(_folder, ignore_errors=True)
+
+
+def benchmarkResultsCSV(n_assays: int = 1000):
+    """Times writing the results CSV after each of n_assays assays (40 element columns each): rewriting the whole file (as before) versus IncrementalCSVWriter,
+    given the whole DataFrame (update) or just the new row (append, as addAssayToResultsCSV does). Times are for the writes themselves, i.e. the incremental writer's background thread is waited for."""
+    print("=== Results CSV written after every assay ===")
+    _row = {
+        "Assay #": ["0001"],
+        "Serial #": ["800N0000"],
+        "Application": ["GeoExploration"],
+    }
+    for _z in range(12, 52):
+        _row[S1Control.elementZtoSymbol(_z)] = [0.5]
+        _row[f"{S1Control.elementZtoSymbol(_z)} Err"] = [0.01]
+    _rng = np.random.default_rng(0)
+    _rows = []
+    _frames = []
+    _df = pd.DataFrame()
+    for _i in range(n_assays):
+        _new = pd.DataFrame(data=_row)
+        _new.iloc[0, 3:] = _rng.random(len(_row) - 3)
+        _df = pd.concat([_df, _new], ignore_index=True)
+        _rows.append(_new)
+        _frames.append(_df)
+    _folder = tempfile.mkdtemp()
+    _t0 = time.perf_counter()
+    for _frame in _frames:
+        _frame.to_csv(os.path.join(_folder, "rewrite.csv"), index=False)
+    _seconds = time.perf_counter() - _t0
+    print(
+        f"{'rewrite whole file':>24}: {_seconds / n_assays * 1000:>10.2f} ms per assay"
+    )
+    _writer = S1Control.IncrementalCSVWriter(os.path.join(_folder, "incremental.csv"))
+    _t0 = time.perf_counter()
+    for _frame in _frames:
+        _writer.update(_frame)
+    _queued_seconds = time.perf_counter() - _t0
+    _writer.close()
+    _seconds = time.perf_counter() - _t0
+    print(
+        f"{'IncrementalCSVWriter':>24}: {_seconds / n_assays * 1000:>10.2f} ms per assay ({_queued_seconds / n_assays * 1000:.2f} ms on the calling thread)"
+    )
+    # as addAssayToResultsCSV: just the new row is handed over, the DataFrame is built on the writer thread
+    _writer = S1Control.IncrementalCSVWriter(os.path.join(_folder, "appended.csv"))
+    _t0 = time.perf_counter()
+    for _new in _rows:
+        _writer.append(_new)
+    _queued_seconds = time.perf_counter() - _t0
+    _writer.close()
+    _seconds = time.perf_counter() - _t0
+    print(
+        f"{'append (row per assay)':>24}: {_seconds / n_assays * 1000:>10.2f} ms per assay ({_queued_seconds / n_assays * 1000:.3f} ms on the calling thread)"
+    )
+    for _name in ("incremental.csv", "appended.csv"):
+        with open(os.path.join(_folder, "rewrite.csv"), "rb") as _a, open(
+            os.path.join(_folder, _name), "rb"
+        ) as _b:
+            assert _a.read() == _b.read()
+    shutil.rmtree(_folder, ignore_errors=True)
+
+
+def benchmarkResultsStore(n_sessions: int = 180, assays_per_session: int = 300):
+    """Times a query across n_sessions sessions of results (40 element columns each): reading every session's results CSV with pandas and filtering,
+    versus ResultsStore.load: the first time (reading the session files that could match), again (nothing changed, so nothing is re-read),
+    and after another assay is added to the latest session (so only its file is re-read)."""
+    print(
+        f"=== Query across {n_sessions} sessions of {assays_per_session} assays ({'parquet' if S1Control.pyarrow else 'npz'}) ==="
+    )
+    _rng = np.random.default_rng(0)
+    _folder = tempfile.mkdtemp()
+    _store = S1Control.ResultsStore()
+    _store.open(_folder, "00000000-000000_800N0000")
+    _applications = ["GeoExploration", "GeoMining", "Alloys 2"]
+    _start = np.datetime64("2026-01-01T08:00:00", "s")
+    for _s in range(n_sessions):
+        _session = (
+            f"{pd.Timestamp(_start + np.timedelta64(_s, 'D')):%Y%m%d-%H%M%S}_800N0000"
+        )
+        _rows = []
+        for _a in range(assays_per_session):
+            _row = {
+                "Session": _session,
+                "Assay #": _a + 1,
+                "Serial #": "800N0000",
+                "Timestamp": _start
+                + np.timedelta64(_s, "D")
+                + np.timedelta64(_a * 90, "s"),
+                "Application": _applications[_a % 3],
+                "Method": "",
+                "Duration (Actual) (s)": 60.0,
+                "Sanity Check": "PASS",
+                "Info Fields (Combined)": "",
+            }
+            for _z, _value in zip(range(12, 52), _rng.random(40) * 10):
+                _row[S1Control.elementZtoSymbol(_z)] = _value
+                _row[f"{S1Control.elementZtoSymbol(_z)} Err"] = _value / 50
+            _rows.append(_row)
+        _store._write(
+            rf"{_folder}/S1Control_Results_{_session}{os.path.splitext(_store.path)[1]}",
+            _rows,
+        )
+        S1Control.ResultsStore.frame(_rows).to_csv(
+            rf"{_folder}/Results_{_session}.csv", index=False
+        )
+    _since = _start + np.timedelta64(n_sessions // 2, "D")
+
+    _t0 = time.perf_counter()
+    _df = pd.concat(
+        [
+            pd.read_csv(rf"{_folder}/{_name}")
+            for _name in sorted(os.listdir(_folder))
+            if _name.endswith(".csv")
+        ],
+        ignore_index=True,
+    )
+    _csv_matches = _df[
+        (_df["Fe"] > 5)
+        & (_df["Application"] == "GeoExploration")
+        & (pd.to_datetime(_df["Timestamp"]) >= _since)
+    ]
+    _seconds = time.perf_counter() - _t0
+    print(f"{'read every CSV':>24}: {_seconds * 1000:>10.1f} ms (half the sessions)")
+    _filters = [
+        ("Fe", ">", 5),
+        ("Application", "==", "GeoExploration"),
+        ("Timestamp", ">=", _since),
+    ]
+    _last_week = [
+        ("Fe", ">", 5),
+        ("Timestamp", ">=", _start + np.timedelta64(n_sessions - 7, "D")),
+    ]
+    _columns = ["Session", "Assay #", "Timestamp", "Fe", "Fe Err"]
+    for _label, _query, _query_columns in (
+        ("last 7 days, 5 columns", _last_week, _columns),
+        ("half the sessions", _filters, None),
+        ("same again", _filters, None),
+    ):
+        _t0 = time.perf_counter()
+        _matches = _store.load(_query, _query_columns)
+        _seconds = time.perf_counter() - _t0
+        print(
+            f"{_label:>24}: {_seconds * 1000:>10.1f} ms ({len(_matches)} of {n_sessions * assays_per_session} assays match)"
+        )
+        if _query is _filters:
+            assert len(_matches) == len(_csv_matches)
+    # as after an assay of the current session: only its file is read again
+    _store._write(
+        rf"{_folder}/S1Control_Results_{_session}{os.path.splitext(_store.path)[1]}",
+        _rows + _rows[-1:],
+    )
+    _t0 = time.perf_counter()
+    _matches = _store.load(_filters)
+    _seconds = time.perf_counter() - _t0
+    print(
+        f"{'after another assay':>24}: {_seconds * 1000:>10.1f} ms ({len(_matches)} of {n_sessions * assays_per_session + 1} assays match)"
+    )
+    _store.close()
+    shutil.rmtree(_folder, ignore_errors=True)
+
+
+def recordSimulatorSession(path: str, assays: int = 3, rate: float = 10) -> int:
+    """Records `assays` normal assays streamed from the simulator (at max speed) to a .s1rec file. Returns the number of packets received."""
+    _simulator = S1Simulator(port=0, speed=0, rate=rate).start()
+    _sock = socket.create_connection(("127.0.0.1", _simulator.port))
+    _reader = S1Control.FramedPacketReader(_sock)
+    _recorder = S1Control.PacketRecorder(path)
+    _assay_command = makePacket(
+        b"\x17\x80",
+        b'<?xml version="1.0" encoding="utf-8"?><Command parameter="Assay">Start</Command>',
+    )
+    _packets = 0
+    for _ in range(assays):
+        _recorder.record(S1Control.S1REC_SENT, _assay_command)
+        _sock.sendall(_assay_command)
+        while True:
+            _header, _body, _footer = _reader.read_packet()
+            _recorder.record(S1Control.S1REC_RECEIVED, _header, _body, _footer)
+            _packets += 1
+            if _header[4:6] == b"\x18\x80" and b"Complete" in bytes(_body):
+                break
+    _recorder.close()
+    _sock.close()
+    _simulator.stop()
+    return _packets
+
+
+def benchmarkReplay(path: str = None):
+    """Replays a .s1rec session recording (by default, a freshly recorded simulator session) at max speed through BrukerInstrument.receive_data and the PacketDispatcher.
+    Handlers are replaced with no-ops, so the numbers are parse + dispatch throughput only."""
+    print("=== Session replay: receive_data + dispatch throughput (max speed) ===")
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), "benchmark.s1rec")
+        recordSimulatorSession(path)
+    _total_packets = sum(
+        1
+        for _, _direction, _ in S1Control.readRecording(path)
+        if _direction == S1Control.S1REC_RECEIVED
+    )
+    _dispatcher = S1Control.buildPacketDispatcher()
+
+    def _noop(data):
+        pass
+
+    _dispatcher.handlers = {_key: _noop for _key in _dispatcher.handlers}
+    _dispatcher.fallback = _noop
+    _pxrf = S1Control.BrukerInstrument(replay=S1Control.PacketReplayer(path, speed=0))
+    _receive_seconds = 0
+    _dispatch_seconds = 0
+    for _ in range(_total_packets):
+        _t0 = time.perf_counter()
+        _data, _datatype = _pxrf.receive_data()
+        _t1 = time.perf_counter()
+        _dispatcher.dispatch(_data, _datatype)
+        _t2 = time.perf_counter()
+        _receive_seconds += _t1 - _t0
+        _dispatch_seconds += _t2 - _t1
+    print(
+        f"{'receive_data':>24}: {_total_packets / _receive_seconds:>10.0f} packets/s ({_total_packets} packets)"
+    )
+    print(f"{'dispatch':>24}: {_total_packets / _dispatch_seconds:>10.0f} packets/s")
+    print(
+        f"{'total':>24}: {_total_packets / (_receive_seconds + _dispatch_seconds):>10.0f} packets/s"
+    )
+
+
+BENCHMARKS = {
+    "reader": benchmarkPacketReader,
+    "transport": benchmarkTransport,
+    "xml": benchmarkXMLDecoding,
+    "replay": benchmarkReplay,
+    "spectrum": benchmarkSpectrumDecoding,
+    "normalise": benchmarkNormalisation,
+    "sanity": benchmarkSanityCheck,
+    "peaks": benchmarkPeakSearch,
+    "compress": benchmarkSpectrumCompression,
+    "catalogue": benchmarkAssayCatalogue,
+    "archive": benchmarkSpectraArchive,
+    "resultscsv": benchmarkResultsCSV,
+    "resultsstore": benchmarkResultsStore,
+}
+
+
+def main():
+    _selected = sys.argv[1:] or list(BENCHMARKS)
+    for _name in _selected:
+        # benchmark=argument, e.g. replay=session.s1rec
+        _name, _, _argument = _name.partition("=")
+        if _name not in BENCHMARKS:
+            print(f"Unknown benchmark '{_name}'. Available: {', '.join(BENCHMARKS)}")
+            continue
+        if _argument:
+            BENCHMARKS[_name](_argument)
+        else:
+            BENCHMARKS[_name]()
+        print()
+
+
+if __name__ == "__main__":
+    main()
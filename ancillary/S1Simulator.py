@@ -0,0 +1,594 @@
+import sys
+import time
+import socket
+import struct
+import argparse
+import threading
+import numpy as np
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+# Offline stand-in for a Bruker S1 TITAN/Tracer speaking the Bruker OEM protocol over TCP.
+# Answers Login/Query/Configure/Command packets and streams multi-phase assays of 2048-channel cooked spectra,
+# so S1Control (listen loop, parsing, CSV export, GeRDA sequences) can be exercised and benchmarked without an instrument.
+# usage: python S1Simulator.py [--host 127.0.0.1] [--port 55204] [--speed 10] [--rate 1]
+#   then: python S1Control.py --instrument=127.0.0.1:55204
+
+HEADER_START = b"\x03\x02\x00\x00"
+FOOTER = b"\x06\x2a\xff\xff"
+TYPE_XML = b"\x17\x80"
+TYPE_COOKED_SPECTRUM = b"\x01\x80"
+TYPE_STATUS = b"\x18\x80"
+TYPE_SPECTRUM_ENERGY = b"\x0b\x80"
+
+COOKED_HEADER_FORMAT = "<f4xLLL4xLLLL6xH78xhHxxLL8xfffff4xLihhhhhhffxxbxxxxx"
+SPECTRUM_CHANNELS = 2048
+EV_PER_CHANNEL = 20.0
+
+# (name, kV, uA, filter description, [(filter element Z, thickness um), ...])
+ILLUMINATIONS = {
+    "Exploration_15": (15, 17.4, "", []),
+    "Exploration_40": (
+        40,
+        15.0,
+        "Cu 75um:Ti 25um:Al 200um",
+        [(29, 75), (22, 25), (13, 200)],
+    ),
+    "Exploration_50": (50, 23.5, "Ti 25um:Al 300um", [(22, 25), (13, 300)]),
+}
+
+APPLICATIONS = {
+    "GeoExploration": {
+        "methods": ["Oxide3Phase", "Geo3Phase"],
+        "phases": [
+            ["1", "Exploration_15", 20],
+            ["2", "Exploration_40", 20],
+            ["3", "Exploration_50", 20],
+        ],
+    },
+    "GeoMining": {
+        "methods": ["Oxide2Phase"],
+        "phases": [["1", "Exploration_15", 30], ["2", "Exploration_40", 30]],
+    },
+}
+
+# (compound, Z, line energy keV, relative intensity, typical wt%)
+SAMPLE_COMPOSITION = [
+    ("SiO2", 14, 1.740, 0.8, 58.2),
+    ("Al2O3", 13, 1.487, 0.4, 14.9),
+    ("K2O", 19, 3.314, 0.6, 2.91),
+    ("CaO", 20, 3.692, 1.0, 5.12),
+    ("TiO2", 22, 4.511, 0.5, 0.71),
+    ("MnO", 25, 5.899, 0.4, 0.12),
+    ("Fe2O3", 26, 6.404, 3.0, 6.95),
+    ("Zn", 30, 8.639, 0.6, 0.0089),
+    ("Rb", 37, 13.395, 0.5, 0.0121),
+    ("Sr", 38, 14.165, 0.7, 0.0342),
+    ("Zr", 40, 15.775, 0.8, 0.0215),
+]
+TUBE_LINES_KEV = [2.697, 20.216, 22.724]  # Rh La, Ka, Kb (scatter)
+
+
+def frame(type_code: bytes, body: bytes) -> bytes:
+    """Frames a body as a Bruker OEM protocol packet."""
+    return HEADER_START + type_code + len(body).to_bytes(4, "little") + body + FOOTER
+
+
+def xmlPacket(xml: str) -> bytes:
+    return frame(
+        TYPE_XML, ('<?xml version="1.0" encoding="utf-8"?>' + xml).encode("utf-8")
+    )
+
+
+def statusPacket(parameter: str, text: str) -> bytes:
+    return frame(
+        TYPE_STATUS,
+        f'<?xml version="1.0" encoding="utf-8"?><Status parameter="{parameter}">{text}</Status>'.encode(
+            "utf-8"
+        ),
+    )
+
+
+def response(parameter: str, text: str, status: str = "success") -> bytes:
+    return xmlPacket(
+        f'<Response parameter="{parameter}" status="{status}">{escape(text)}</Response>'
+    )
+
+
+def expectedSpectrumShape(voltage_kv: float) -> np.ndarray:
+    """Returns a normalised (sums to 1) synthetic spectrum shape for a given tube voltage: bremsstrahlung continuum, sample fluorescence lines and tube scatter peaks."""
+    _e = (np.arange(SPECTRUM_CHANNELS) * EV_PER_CHANNEL) / 1000
+    _e_safe = np.maximum(_e, 0.05)
+    # kramers' law continuum, with low energy absorption
+    _shape = np.clip((voltage_kv - _e_safe) / _e_safe, 0, None) * (
+        1 - np.exp(-((_e_safe / 1.8) ** 3))
+    )
+    _shape = _shape / _shape.max() * 0.02
+    _lines = [(_kev, _intensity) for _, _, _kev, _intensity, _ in SAMPLE_COMPOSITION]
+    _lines += [(_kev, 0.8) for _kev in TUBE_LINES_KEV]
+    for _kev, _intensity in _lines:
+        if _kev >= voltage_kv * 0.9:
+            continue
+        # excitation efficiency falls off for low energy lines at high voltage
+        _excitation = _intensity * min(1.0, 12 / voltage_kv) ** (0.5 if _kev > 5 else 2)
+        _sigma = np.sqrt(0.09**2 + 0.0018 * _kev) / 2.355
+        _shape += _excitation * np.exp(-0.5 * ((_e - _kev) / _sigma) ** 2)
+    return _shape / _shape.sum()
+
+
+class S1Simulator:
+    """TCP server imitating a Bruker pXRF instrument. serve() blocks; start() runs it in a daemon thread.
+    speed: multiple of real time to stream assays at (<=0 for as fast as possible).
+    rate: cooked spectrum packets per instrument-second (real instruments send 1)."""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 55204,
+        speed: float = 1.0,
+        rate: float = 1.0,
+        serial_number: str = "800N9999",
+        seed: int = 0,
+    ):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.rate = rate
+        self.serial_number = serial_number
+        self.rng = np.random.default_rng(seed)
+        self.application = "GeoExploration"
+        self.method = APPLICATIONS[self.application]["methods"][0]
+        self.phases = {
+            _app: [list(_p) for _p in _d["phases"]] for _app, _d in APPLICATIONS.items()
+        }
+        self.edit_fields: dict = {}
+        self.settings = {
+            "proximity required": "No",
+            "store results": "Yes",
+            "store spectra": "Yes",
+        }
+        self.logged_in = False
+        self.assays_completed = 0
+        self.server_socket: socket.socket = None
+        self.client_socket: socket.socket = None
+        self._send_lock = threading.Lock()
+        self._assay_thread: threading.Thread = None
+        self._assay_stop = threading.Event()
+        self._halt = threading.Event()
+
+    # server
+    def start(self) -> "S1Simulator":
+        """Binds and starts serving in a background thread. returns self, so port=0 can be used and the bound port read back."""
+        self._bind()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def serve(self):
+        self._bind()
+        self._accept_loop()
+
+    def stop(self):
+        self._halt.set()
+        self._assay_stop.set()
+        for _sock in (self.client_socket, self.server_socket):
+            try:
+                _sock.close()
+            except Exception:
+                pass
+
+    def drop_client(self):
+        """Closes the current client connection (as if the cable was pulled), to exercise S1Control's reconnection."""
+        _client = (
+            self.client_socket
+        )  # (may be replaced by a reconnecting client as soon as it's shut down)
+        try:
+            _client.shutdown(socket.SHUT_RDWR)
+            _client.close()
+        except Exception:
+            pass
+
+    def _bind(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.port = self.server_socket.getsockname()[1]
+        self.server_socket.listen(1)
+        print(f"S1Simulator listening on {self.host}:{self.port}")
+
+    def _accept_loop(self):
+        while not self._halt.is_set():
+            try:
+                _client, _address = self.server_socket.accept()
+            except OSError:
+                break
+            print(f"S1Simulator: client connected from {_address[0]}:{_address[1]}")
+            self.client_socket = _client
+            self._client_loop(_client)
+            self._assay_stop.set()
+            print("S1Simulator: client disconnected")
+
+    def _client_loop(self, client: socket.socket):
+        while not self._halt.is_set():
+            try:
+                _header = self._recv_exact(client, 10)
+                _body = self._recv_exact(
+                    client, int.from_bytes(_header[6:10], "little")
+                )
+                self._recv_exact(client, 4)
+            except (OSError, ConnectionError):
+                return
+            if _header[4:6] != TYPE_XML:
+                continue
+            try:
+                self.handle_command(_body.decode("utf-8"))
+            except (OSError, ConnectionError):
+                return
+
+    @staticmethod
+    def _recv_exact(client: socket.socket, n: int) -> bytes:
+        _buf = bytearray()
+        while len(_buf) < n:
+            _chunk = client.recv(n - len(_buf))
+            if not _chunk:
+                raise ConnectionError("client disconnected")
+            _buf += _chunk
+        return bytes(_buf)
+
+    def send(self, packet: bytes):
+        with self._send_lock:
+            self.client_socket.sendall(packet)
+
+    # command handling
+    def handle_command(self, xml: str):
+        _root = ET.fromstring(xml)
+        _param = _root.get("parameter", "")
+        _text = (_root.text or "").strip()
+        if _root.tag == "Command":
+            self._handle_command(_root, _param, _text)
+        elif _root.tag == "Query":
+            self._handle_query(_param.lower(), _text)
+        elif _root.tag == "Configure":
+            self._handle_configure(_root, _param, _text)
+        elif _root.tag == "Acknowledge":
+            pass
+        else:
+            self.send(
+                response(_param.lower(), f"Unknown request {_root.tag}", "failure")
+            )
+
+    def _handle_command(self, root: ET.Element, param: str, text: str):
+        if text == "Login" or param == "Login":
+            self.logged_in = True
+            self.send(response("login", "Logged in as Simulator"))
+        elif param == "Assay" and text == "Stop":
+            self._assay_stop.set()
+            self.send(response("assay", "Assay Stop"))
+        elif param == "Assay":
+            _start_params = root.find("StartParameters")
+            if _start_params is not None:
+                # custom spectrum assay: single phase with the given parameters
+                _filter = _start_params.findtext("Filter") or ""
+                _phases = [
+                    (
+                        int(_start_params.findtext("AssayDuration")),
+                        float(_start_params.findtext("HighVoltage")),
+                        float(_start_params.findtext("AnodeCurrent")),
+                        filterElementsFromDescription(_filter),
+                    )
+                ]
+            else:
+                _phases = []
+                for _, _name, _duration in self.phases[self.application]:
+                    _kv, _ua, _, _filter_elements = ILLUMINATIONS[_name]
+                    _phases.append((int(_duration), _kv, _ua, _filter_elements))
+            self.send(response("assay", "Assay Start"))
+            # each assay gets its own stop event, so one still winding down can't be restarted by this one
+            self._assay_stop.set()
+            self._assay_stop = threading.Event()
+            self._assay_thread = threading.Thread(
+                target=self._run_assay,
+                args=(_phases, _start_params is None, self._assay_stop),
+                daemon=True,
+            )
+            self._assay_thread.start()
+
+    def _handle_query(self, param: str, text: str):
+        if param == "login state":
+            self.send(response(param, "Yes" if self.logged_in else "No"))
+        elif param == "armed state":
+            self.send(response(param, "Yes" if self.logged_in else "No"))
+        elif param == "instrument definition":
+            self.send(xmlPacket(self.instrument_definition_xml()))
+        elif param == "applications":
+            _apps = "".join(f"<Application>{_a}</Application>" for _a in APPLICATIONS)
+            self.send(
+                xmlPacket(
+                    f'<Response parameter="applications" status="success"><ApplicationList>{_apps}</ApplicationList></Response>'
+                )
+            )
+        elif param == "activeapplication":
+            _methods = "".join(
+                f"<Method>{_m}</Method>"
+                for _m in APPLICATIONS[self.application]["methods"]
+            )
+            self.send(
+                xmlPacket(
+                    f'<Response parameter="activeapplication" status="success"><Application>{self.application}</Application><ActiveMethod>{self.method}</ActiveMethod><MethodList>{_methods}</MethodList></Response>'
+                )
+            )
+        elif param == "phase times":
+            _phases = "".join(
+                f'<Phase number="{_num}"><Name>{_name}</Name><Duration>{_duration}</Duration></Phase>'
+                for _num, _name, _duration in self.phases[self.application]
+            )
+            self.send(
+                xmlPacket(
+                    f'<Response parameter="phase times" status="success"><Application>{self.application}</Application><PhaseList>{_phases}</PhaseList></Response>'
+                )
+            )
+        elif param == "version":
+            self.send(response(param, "1.7.9.SIM"))
+        elif param == "nose temperature":
+            self.send(response(param, "38.1"))
+        elif param == "nose pressure":
+            self.send(response(param, "1013"))
+        elif param == "edit fields":
+            if self.edit_fields:
+                _fields = "".join(
+                    f'<EditField FieldName="{escape(_n)}">{escape(_v)}</EditField>'
+                    for _n, _v in self.edit_fields.items()
+                )
+                self.send(
+                    xmlPacket(
+                        f'<Response parameter="edit fields" status="success"><EditFieldList>{_fields}</EditFieldList></Response>'
+                    )
+                )
+            else:
+                self.send(
+                    xmlPacket('<Response parameter="edit fields" status="success"/>')
+                )
+        elif param in self.settings:
+            self.send(response(param, self.settings[param]))
+        else:
+            self.send(response(param, f"Query:{param} not simulated"))
+
+    def _handle_configure(self, root: ET.Element, param: str, text: str):
+        _param = param.lower()
+        if _param == "application":
+            if text in APPLICATIONS:
+                self.application = text
+                self.method = APPLICATIONS[text]["methods"][0]
+                self.send(
+                    response(
+                        _param, f"Configure:Application successfully set to::{text}"
+                    )
+                )
+            else:
+                self.send(
+                    response(
+                        _param, f"Configure:Application {text} not found", "failure"
+                    )
+                )
+        elif _param == "method":
+            self.method = text
+            self.send(response(_param, f"Configure:Method successfully set to::{text}"))
+        elif _param == "phase times":
+            for _phase in root.iter("Phase"):
+                for _p in self.phases[self.application]:
+                    if _p[0] == _phase.get("number"):
+                        _p[2] = int(_phase.findtext("Duration"))
+            self.send(response(_param, "Configure:Phase Times successfully set"))
+        elif _param == "edit fields":
+            if text == "Reset":
+                self.edit_fields = {}
+            for _field in root.iter("Field"):
+                self.edit_fields[_field.findtext("Name")] = (
+                    _field.findtext("Value") or ""
+                )
+            self.send(response(_param, "Configure:Edit Fields updated"))
+        elif _param.startswith("transmit"):
+            self.send(response(_param, f"{param} configuration updated"))
+        elif _param in self.settings:
+            self.settings[_param] = text
+            self.send(response(_param, f"Configure:{param} updated"))
+        else:
+            self.send(response(_param, f"Configure:{param} updated"))
+
+    # assay streaming
+    def _run_assay(self, phases: list, send_results: bool, stop: threading.Event):
+        try:
+            self._stream_assay(phases, send_results, stop)
+        except OSError:
+            pass  # client disconnected mid-assay
+
+    def _stream_assay(self, phases: list, send_results: bool, stop: threading.Event):
+        self.send(statusPacket("Assay", "Start"))
+        _packet_interval = 1 / self.rate
+        _wall_interval = _packet_interval / self.speed if self.speed > 0 else 0
+        _packet_num = 0
+        for _phase_index, (_duration, _kv, _ua, _filter_elements) in enumerate(phases):
+            _shape = expectedSpectrumShape(_kv)
+            _cps = _kv * _ua * 90
+            _dead_fraction = _cps / (_cps + 400000)
+            _counts = np.zeros(SPECTRUM_CHANNELS, dtype=np.uint32)
+            _acc_raw = 0
+            _acc_valid = 0
+            _next_send = time.perf_counter()
+            for _phase_packet in range(1, int(_duration * self.rate) + 1):
+                if stop.is_set():
+                    return
+                _packet_num += 1
+                _new = self.rng.poisson(
+                    _shape * (_cps * (1 - _dead_fraction) * _packet_interval)
+                )
+                _counts += _new.astype(np.uint32)
+                _valid = int(_new.sum())
+                _raw = int(_valid / (1 - _dead_fraction))
+                _acc_raw += _raw
+                _acc_valid += _valid
+                _adur_ms = _packet_interval * 1000
+                _tdur_ms = _adur_ms * _phase_packet
+                self.send(
+                    frame(
+                        TYPE_SPECTRUM_ENERGY,
+                        struct.pack("<iff", _packet_num, 0.0, EV_PER_CHANNEL),
+                    )
+                )
+                self.send(
+                    frame(
+                        TYPE_COOKED_SPECTRUM,
+                        self.cooked_spectrum_body(
+                            _counts,
+                            _packet_num,
+                            _phase_packet,
+                            _adur_ms,
+                            _tdur_ms,
+                            _raw,
+                            _valid,
+                            _acc_raw,
+                            _acc_valid,
+                            _dead_fraction,
+                            _kv,
+                            _ua,
+                            _filter_elements,
+                        ),
+                    )
+                )
+                if _wall_interval:
+                    _next_send += _wall_interval
+                    _sleep = _next_send - time.perf_counter()
+                    if _sleep > 0:
+                        time.sleep(_sleep)
+            if _phase_index < len(phases) - 1:
+                self.send(statusPacket("Phase Change", str(_phase_index + 2)))
+        if send_results:
+            self.send(xmlPacket(self.results_xml()))
+        self.send(statusPacket("Assay", "Complete"))
+        self.assays_completed += 1
+
+    def cooked_spectrum_body(
+        self,
+        counts: np.ndarray,
+        packet_num: int,
+        phase_packet: int,
+        adur_ms: float,
+        tdur_ms: float,
+        raw: int,
+        valid: int,
+        acc_raw: int,
+        acc_valid: int,
+        dead_fraction: float,
+        kv: float,
+        ua: float,
+        filter_elements: list,
+    ) -> bytes:
+        _filters = (list(filter_elements) + [(0, 0)] * 3)[:3]
+        _header = struct.pack(
+            COOKED_HEADER_FORMAT,
+            EV_PER_CHANNEL,  # fEVPerChannel
+            int(adur_ms),  # iTDur
+            raw,  # iRaw_Cnts
+            valid,  # iValid_Cnts
+            int(adur_ms),  # iADur
+            int(adur_ms * dead_fraction),  # iADead
+            0,  # iAReset
+            int(adur_ms * (1 - dead_fraction)),  # iALive
+            packet_num & 0xFFFF,  # iPacket_Cnt
+            -54,  # Det_Temp (half-degrees C)
+            1000,  # Amb_Temp (tenths of a degree F)
+            acc_raw,  # iRaw_Cnts_Acc
+            acc_valid,  # iValid_Cnts_Acc
+            tdur_ms,  # fTDur
+            tdur_ms,  # fADur
+            tdur_ms * dead_fraction,  # fADead
+            0.0,  # fAReset
+            tdur_ms * (1 - dead_fraction),  # fALive
+            phase_packet,  # lPacket_Cnt
+            len(filter_elements),  # iFilterNum
+            _filters[0][0],
+            _filters[0][1],
+            _filters[1][0],
+            _filters[1][1],
+            _filters[2][0],
+            _filters[2][1],
+            kv,  # sngHVADC
+            ua,  # sngCurADC
+            0,  # Toggle
+        )
+        return _header + counts.astype("<u4").tobytes()
+
+    def results_xml(self) -> str:
+        _elements = []
+        for _compound, _z, _, _, _conc in SAMPLE_COMPOSITION:
+            _measured = max(0.0, self.rng.normal(_conc, _conc * 0.02))
+            _elements.append(
+                f'<ElementData><Compound>{_compound}</Compound><AtomicNumber Type="Element">{_z}</AtomicNumber><Concentration>{_measured:.6f}</Concentration><Error>{_conc * 0.02:.6f}</Error></ElementData>'
+            )
+        return f"<Data><AnalysisMode>{self.method}</AnalysisMode><Elements>{''.join(_elements)}</Elements></Data>"
+
+    def instrument_definition_xml(self) -> str:
+        _illuminations = "".join(
+            f'<IlluminationDefinition><ID>{_name}</ID><HighVoltage>{_kv}</HighVoltage><AnodeCurrent default="Yes">{_ua}</AnodeCurrent><FilterPosition>{_filter}</FilterPosition><TestSample>Cu 1100</TestSample><CountRangeMin>0</CountRangeMin><CountRangeMax>0</CountRangeMax><ActualCounts>0</ActualCounts></IlluminationDefinition>'
+            for _name, (_kv, _ua, _filter, _) in ILLUMINATIONS.items()
+        )
+        _filter_positions = "".join(
+            f'<FilterPosition number="{_i}">{_filter}</FilterPosition>'
+            for _i, _filter in enumerate(
+                ["", "Cu 75um:Ti 25um:Al 200um", "Ti 25um:Al 300um", "Al 38um"], start=1
+            )
+        )
+        return (
+            '<Response parameter="instrument definition" status="success"><InstrumentDefinition>'
+            f"<Model>S1 TITAN 800 (Simulated)</Model><SerialNumber>{self.serial_number}</SerialNumber><BuildNumber>SPX-SIM-0001</BuildNumber>"
+            "<Detector><DetectorModel>SIM SDD</DetectorModel><BerylliumWindowThicknessInuM>8</BerylliumWindowThicknessInuM><TypicalResolutionIneV>140</TypicalResolutionIneV><OperatingTempMaxInC>-25</OperatingTempMaxInC><OperatingTempMinInC>-29</OperatingTempMinInC></Detector>"
+            "<XrayTube><Manufacturer>Simulated</Manufacturer><TargetElementNumber>45</TargetElementNumber>"
+            "<OperatingLimits><MaxHighVoltage>50</MaxHighVoltage><MinHighVoltage>6</MinHighVoltage><MaxAnodeCurrentInuA>200</MaxAnodeCurrentInuA><MinAnodeCurrentInuA>5</MinAnodeCurrentInuA><MaxOutputPowerInmW>4000</MaxOutputPowerInmW></OperatingLimits>"
+            f"{_illuminations}</XrayTube>"
+            "<SpotSize><Size>5</Size></SpotSize><HasChangeableCollimator>No</HasChangeableCollimator>"
+            f"<Filter>{_filter_positions}</Filter>"
+            "<SUP><FirmwareVersion>SIM</FirmwareVersion></SUP><UUP><FirmwareVersion>SIM</FirmwareVersion></UUP><DPP><XilinxFirmwareVersion>SIM</XilinxFirmwareVersion></DPP><OMAP><KernelVersion>SIM</KernelVersion></OMAP>"
+            "</InstrumentDefinition></Response>"
+        )
+
+
+def filterElementsFromDescription(description: str) -> list:
+    """Converts a filter description like 'Cu 75um:Ti 25um:Al 200um' to a list of (Z, thickness um) tuples for the cooked spectrum header."""
+    _symbols = {"Al": 13, "Ti": 22, "Fe": 26, "Cu": 29, "Ag": 47}
+    _elements = []
+    for _part in description.split(":"):
+        _bits = _part.strip().split(" ")
+        if len(_bits) == 2 and _bits[0] in _symbols:
+            _elements.append((_symbols[_bits[0]], int(_bits[1].replace("um", ""))))
+    return _elements
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline Bruker OEM protocol instrument simulator for S1Control."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=55204)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="multiple of real time to stream assays at (0 = as fast as possible)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=1.0,
+        help="cooked spectrum packets per instrument-second",
+    )
+    parser.add_argument("--serial", default="800N9999")
+    args = parser.parse_args()
+    simulator = S1Simulator(args.host, args.port, args.speed, args.rate, args.serial)
+    try:
+        simulator.serve()
+    except KeyboardInterrupt:
+        simulator.stop()
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()